@@ -83,3 +83,19 @@ POINT_RANGE = 0.05
 
 ################################################## MAIN CONSTANTS ####################################
 TRAJ_DIR = './data/examples/'
+
+# road network graphs cached by tile (see modules/metadata/generate_metadata/graph_cache.py)
+GRAPH_CACHE_DIR = './data/graph_cache/'
+
+# HMM map matcher (see modules/map_matching/hmm_matcher.py), distances in meters
+MATCH_PADDING = 1000        # around the trace, for the road network graph
+HMM_SIGMA = 10              # GPS error
+HMM_BETA = 30               # route vs straight line distance difference
+HMM_RADIUS = 50             # max distance from a point to its candidate edges
+HMM_MAX_ROUTE = 3000        # max route distance between the matches of consecutive points
+HMM_CACHE_SIZE = 4096       # nodes whose shortest path distances are cached
+
+# trace preprocessing before map matching (see modules/map_matching/preprocess.py), 0 to turn a step off
+TRACE_MIN_TIME = 5          # seconds between kept points
+TRACE_MIN_DIST = 10         # meters between kept points
+TRACE_TOLERANCE = 5         # meters of the Douglas-Peucker simplification
@@ -32,7 +32,7 @@ def on_button_click(event):
     print("Button clicked!")
 
 # Create the button
-match_button = pn.widgets.Button(name='Match One Trajectory', description='Wait for 5 minutes')
+match_button = pn.widgets.Button(name='Match One Trajectory', description='Wait for a few seconds')
 
 # Attach the function to the button's click event
 match_button.on_click(on_button_click)
\ No newline at end of file
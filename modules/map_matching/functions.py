@@ -7,13 +7,24 @@ Description: contains the Panel code that generates the map-matching webpage/das
              Calls functions in module-scripts/map-matching, and utils folders.
 Author: Mohamed Hemdan
 '''
+import math
 import pandas as pd
-from visualization import (plot_matches_on_pyleaflet)
-
-from mappymatch.constructs.trace import Trace
-from mappymatch.constructs.geofence import Geofence
-from mappymatch.maps.nx.nx_map import NxMap, NetworkType
-from mappymatch.matchers.lcss.lcss import LCSSMatcher
+from visualization import (plot_path_on_pyleaflet)
+from constants import (GRAPH_CACHE_DIR,
+                       NETWORK_TYPE,
+                       MATCH_PADDING,
+                       HMM_SIGMA,
+                       HMM_BETA,
+                       HMM_RADIUS,
+                       HMM_MAX_ROUTE,
+                       HMM_CACHE_SIZE,
+                       TRACE_MIN_TIME,
+                       TRACE_MIN_DIST,
+                       TRACE_TOLERANCE,
+                      )
+from modules.metadata.generate_metadata.graph_cache import GraphCache
+from .hmm_matcher import HMMMatcher
+from .preprocess import preprocess_trace
 import random
 
 ########################################## SIDEBAR ELEMENTS ########################################## 
@@ -33,17 +44,25 @@ def map_match(traj_filename, map):
     sub_df = df[df["Vehicle ID"] == one_id]
     sub_df.sort_values(by=['Position Date Time'], inplace=True)    
 
+    # Drop the redundant points of the trace
+    print("Preprocessing the trace!")
+    sub_df, _ = preprocess_trace(sub_df, 'lat', 'long', 'Position Date Time',
+                                 min_time=TRACE_MIN_TIME, min_dist=TRACE_MIN_DIST, tolerance=TRACE_TOLERANCE, verbose=True)
+
     # Do Map Matching
-    print("Getting the trace!")
-    trace = Trace.from_dataframe(dataframe=sub_df, xy=True, lat_column='lat', lon_column='long')
-    print("Getting the geofence!")
-    geofence = Geofence.from_trace(trace, padding=1e3)
+    latitude = sub_df['lat'].to_numpy()
+    longitude = sub_df['long'].to_numpy()
     print("Getting the underlying road network!")
-    nx_map = NxMap.from_geofence(geofence, network_type=NetworkType.DRIVE)
+    # road network of the bounds of the trace (plus MATCH_PADDING meters) from the tile cache, instead of downloading it every time
+    pad_lat = MATCH_PADDING / 111320
+    pad_long = pad_lat / math.cos(math.radians(latitude.mean()))
+    north, south = latitude.max() + pad_lat, latitude.min() - pad_lat
+    east, west = longitude.max() + pad_long, longitude.min() - pad_long
+    graph = GraphCache(GRAPH_CACHE_DIR, network_type=NETWORK_TYPE).get_graph(north, south, east, west, retain_all=False, truncate_by_edge=False)
     print("Matching the trace to the road network!")
-    matcher = LCSSMatcher(nx_map)
-    match_result = matcher.match_trace(trace)
+    matcher = HMMMatcher(graph, sigma=HMM_SIGMA, beta=HMM_BETA, radius=HMM_RADIUS, max_route=HMM_MAX_ROUTE, cache_size=HMM_CACHE_SIZE)
+    matches, paths = matcher.match(latitude, longitude)
 
     # Plotting the match result
     print("Now Plotting the matches...!")
-    plot_matches_on_pyleaflet(matches=match_result.matches, map=map)
\ No newline at end of file
+    plot_path_on_pyleaflet(latitude, longitude, matches, paths, graph, map=map)
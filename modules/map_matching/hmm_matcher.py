@@ -0,0 +1,198 @@
+'''
+File name: modules/map_matching/hmm_matcher.py
+
+Description: Hidden Markov model map matcher (Newson and Krumm, 2009) that matches the points of a trip
+             to a continuous path of edges of an OSMnx graph.
+
+             The candidates of a point are the edges within radius meters of it, found for all the points with
+             one query of the nearest edge/node index of the graph. The emission score of a candidate is a Gaussian
+             of its distance to the point, and the transition score between candidates of consecutive points is an
+             exponential of the difference between their route distance on the network and the straight line
+             distance between the points. Viterbi scores all the candidate pairs of two consecutive points as one
+             numpy matrix.
+
+             Route distances use the shortest path distances from the end node of an edge, kept in a bounded LRU
+             cache by node, so the points of a trip (and the trips matched with the same matcher) share them.
+             Dijkstra only goes as far as a route between two consecutive points can go and still score well
+             (their straight line distance plus 2 radius plus 10 beta, rounded up to a power of 2 times 100 meters
+             so the cached distances are reused), and never farther than max route meters.
+
+             If no candidate of a point can be reached from the candidates of the previous point, the path breaks
+             there and the matching starts again. Points without candidates are not matched.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import math
+from functools import lru_cache
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from modules.metadata.generate_metadata.nearest import NearestIndex
+
+########################################## FUNCTIONS ##########################################
+class HMMMatcher:
+    '''
+    Map matcher of the trips on graph G:
+        sigma (float) - standard deviation (meters) of the GPS error
+        beta (float) - scale (meters) of the difference between route and straight line distances
+        radius (float) - max distance (meters) from a point to its candidate edges
+        max_route (float) - max route distance (meters) between the matches of consecutive points
+        cache_size (int) - max number of nodes whose shortest path distances are cached
+    '''
+
+    def __init__(self, G, sigma=10, beta=30, radius=50, max_route=3000, cache_size=4096):
+        self.G = G
+        self.sigma = sigma
+        self.beta = beta
+        self.radius = radius
+        self.max_route = max_route
+
+        self.index = NearestIndex(G)
+        self.edge_u = np.array([e[0] for e in self.index.edges])
+        self.edge_v = np.array([e[1] for e in self.index.edges])
+
+        # shortest of the parallel edges between two nodes, for the shortest paths
+        self.D = nx.DiGraph()
+        for u, v, length in G.edges(data='length'):
+            if not self.D.has_edge(u, v) or length < self.D[u][v]['length']:
+                self.D.add_edge(u, v, length=length)
+
+        self.get_shortest_paths = lru_cache(maxsize=cache_size)(self.shortest_paths)
+
+    def shortest_paths(self, source, cutoff):
+        '''
+        Returns the distances (meters) of the nodes within cutoff meters of source
+        '''
+        return nx.single_source_dijkstra_path_length(self.D, source, cutoff=cutoff, weight='length')
+
+    def get_cutoff(self, line):
+        '''
+        Returns the max route distance (meters) between the matches of two points line meters apart
+        '''
+        needed = line + 2 * self.radius + 10 * self.beta
+
+        return min(self.max_route, 100 * 2 ** math.ceil(math.log2(needed / 100)))
+
+    def get_route_distances(self, a, b, cand_edge, cand_offset, cutoff):
+        '''
+        IN: a, b (numpy arrays) - candidates of two consecutive points
+            cand_edge, cand_offset (numpy arrays) - edge (position in the index) and offset (meters) of every candidate
+            cutoff (float) - max route distance (meters)
+
+        OUT: route (numpy array) - route distance (meters) from each candidate of a to each candidate of b (inf if too far)
+        '''
+        edge_a, edge_b = cand_edge[a], cand_edge[b]
+        offset_a, offset_b = cand_offset[a], cand_offset[b]
+
+        # from the end of the edge of a to the start of the edge of b
+        route = np.empty((len(a), len(b)))
+        for r, v in enumerate(self.edge_v[edge_a]):
+            dist = self.get_shortest_paths(v, cutoff)
+            route[r] = [dist.get(u, np.inf) for u in self.edge_u[edge_b]]
+        route += (self.index.edge_lengths[edge_a] - offset_a)[:, None] + offset_b[None, :]
+
+        # along the same edge (a vehicle that stops can seem to move back a little because of the GPS error,
+        # the difference of two GPS errors is about 1.4 sigma)
+        forward = offset_b[None, :] - offset_a[:, None]
+        same = (edge_a[:, None] == edge_b[None, :]) & (forward >= -2 * self.sigma)
+        route[same] = np.maximum(forward[same], 0)
+
+        return route
+
+    def get_edge_path(self, a_edge, a_offset, b_edge, b_offset):
+        '''
+        Returns the edges from edge a_edge to edge b_edge (both included) along the shortest path
+        '''
+        if a_edge == b_edge and b_offset - a_offset >= -2 * self.sigma:
+            return [self.index.edges[a_edge]]
+
+        # nodes of the shortest path from the end of a_edge to the start of b_edge
+        nodes = nx.bidirectional_dijkstra(self.D, self.edge_v[a_edge], self.edge_u[b_edge], weight='length')[1]
+
+        path = [self.index.edges[a_edge]]
+        for u, v in zip(nodes[:-1], nodes[1:]):
+            key = min(self.G[u][v], key=lambda k: self.G[u][v][k]['length'])
+            path.append((u, v, key))
+        path.append(self.index.edges[b_edge])
+
+        return path
+
+    def match(self, latitude, longitude):
+        '''
+        IN: latitude, longitude (array-like) - coordinates of the points of a trip, in time order
+
+        OUT: matches (pandas DataFrame) - Edge ((u, v, key), None if not matched) and Distance (meters) of each point
+             paths (list) - continuous paths of edges (u, v, key) of the trip (more than one if the path breaks)
+        '''
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        n = len(latitude)
+
+        # candidates of all the points, sorted by point
+        cand_point, cand_edge, cand_dist, cand_offset = self.index.candidate_edges(latitude, longitude, self.radius)
+        starts = np.searchsorted(cand_point, np.arange(n + 1))
+        x, y = self.index.project(latitude, longitude)
+
+        emission = -0.5 * (cand_dist / self.sigma) ** 2
+        score = np.full(len(cand_edge), -np.inf)    # Viterbi score of the best path to each candidate
+        back = np.full(len(cand_edge), -1)          # previous candidate on that path
+
+        # Viterbi, one candidate matrix per pair of consecutive points with candidates
+        ends = []
+        prev, prev_i = None, None
+        for i in range(n):
+            cur = np.arange(starts[i], starts[i + 1])
+            if len(cur) == 0:
+                continue
+
+            if prev is not None:
+                line = np.hypot(x[i] - x[prev_i], y[i] - y[prev_i])
+                route = self.get_route_distances(prev, cur, cand_edge, cand_offset, self.get_cutoff(line))
+                total = score[prev][:, None] - np.abs(route - line) / self.beta
+
+                best = np.argmax(total, axis=0)
+                best_total = total[best, np.arange(len(cur))]
+
+            if prev is None or np.isneginf(best_total).all():
+                # first point, or no candidate can be reached: the path breaks here
+                if prev is not None:
+                    ends.append(prev)
+                score[cur] = emission[cur]
+            else:
+                score[cur] = best_total + emission[cur]
+                back[cur] = np.where(np.isneginf(best_total), -1, prev[best])
+
+            prev, prev_i = cur, i
+
+        if prev is not None:
+            ends.append(prev)
+
+        # follow the best paths back from the last point of each part
+        matched = np.full(n, -1)
+        paths = []
+        for end in ends:
+            c = end[np.argmax(score[end])]
+            part = []
+            while c != -1:
+                part.append(c)
+                c = back[c]
+            part.reverse()
+            matched[cand_point[part]] = part
+
+            path = [self.index.edges[cand_edge[part[0]]]]
+            for a, b in zip(part[:-1], part[1:]):
+                path += self.get_edge_path(cand_edge[a], cand_offset[a], cand_edge[b], cand_offset[b])[1:]
+            paths.append([e for k, e in enumerate(path) if k == 0 or e != path[k - 1]])
+
+        is_matched = matched != -1
+        edges = np.full(n, None, dtype=object)
+        edges[is_matched] = self.index.edges[cand_edge[matched[is_matched]]]
+        dist = np.full(n, np.nan)
+        dist[is_matched] = cand_dist[matched[is_matched]]
+
+        matches = pd.DataFrame({'Edge': edges, 'Distance': dist})
+
+        return matches, paths
@@ -0,0 +1,134 @@
+'''
+File name: modules/map_matching/preprocess.py
+
+Description: Preprocessing of the GPS trace of a trip before it is map matched.
+
+             The points are projected to the UTM zone of the trace with one pyproj call. Then the trace is
+             thinned (a point is dropped if it is less than min time seconds or less than min dist meters after
+             the last point that is kept) and simplified with Douglas-Peucker (a point is dropped if the trace
+             without it stays within tolerance meters of it). The first and last points are always kept.
+             A 1 Hz feed has many points on the same stretch of road, that only make the matching slower.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import numpy as np
+import pandas as pd
+from pyproj import CRS, Transformer
+
+########################################## FUNCTIONS ##########################################
+def get_utm_crs(latitude, longitude):
+    '''
+    Returns the UTM zone CRS of the middle of the points
+    '''
+    lat, long = np.mean(latitude), np.mean(longitude)
+    zone = int((long + 180) // 6) % 60 + 1
+
+    return CRS.from_epsg((32700 if lat < 0 else 32600) + zone)
+
+def project_trace(latitude, longitude, crs=None):
+    '''
+    IN: latitude, longitude (array-like) - coordinates of the points
+        crs (pyproj CRS) - metric CRS to project to (UTM zone of the points if None)
+
+    OUT: x, y (numpy arrays) - coordinates (meters) of the points
+         crs (pyproj CRS)
+    '''
+    if crs is None:
+        crs = get_utm_crs(latitude, longitude)
+
+    x, y = Transformer.from_crs('EPSG:4326', crs, always_xy=True).transform(np.asarray(longitude, dtype=float),
+                                                                          np.asarray(latitude, dtype=float))
+
+    return np.asarray(x), np.asarray(y), crs
+
+def thin_trace(x, y, t, min_time=0, min_dist=0):
+    '''
+    IN: x, y (numpy arrays) - coordinates (meters) of the points, in time order
+        t (numpy array) - time (seconds) of the points
+        min_time (float) - seconds
+        min_dist (float) - meters
+
+    OUT: keep (numpy array) - True for the points that are min_time seconds and min_dist meters after the last kept point
+    '''
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+
+    last = 0
+    keep[0] = True
+    for i in range(1, n - 1):
+        if t[i] - t[last] >= min_time and np.hypot(x[i] - x[last], y[i] - y[last]) >= min_dist:
+            keep[i] = True
+            last = i
+    keep[-1] = True
+
+    return keep
+
+def simplify_trace(x, y, tolerance):
+    '''
+    IN: x, y (numpy arrays) - coordinates (meters) of the points, in time order
+        tolerance (float) - meters
+
+    OUT: keep (numpy array) - True for the points that Douglas-Peucker keeps
+    '''
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[[0, -1]] = True
+
+    # sections of the trace (first, last point) still to split
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        # distances from the points in between to the segment from first to last
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length2 = dx ** 2 + dy ** 2
+        if length2 == 0:
+            dist = np.hypot(px, py)
+        else:
+            s = np.clip((px * dx + py * dy) / length2, 0, 1)
+            dist = np.hypot(px - s * dx, py - s * dy)
+
+        i = np.argmax(dist)
+        if dist[i] > tolerance:
+            keep[first + 1 + i] = True
+            stack += [(first, first + 1 + i), (first + 1 + i, last)]
+
+    return keep
+
+def preprocess_trace(df, lat_col, long_col, time_col, min_time=0, min_dist=0, tolerance=0, verbose=False):
+    '''
+    IN: df (pandas DataFrame) - points of a trip, in time order
+        lat_col, long_col, time_col (str) - column names of the latitude, longitude and timestamp of the points
+        min_time (float) - seconds between kept points (0 to not thin by time)
+        min_dist (float) - meters between kept points (0 to not thin by distance)
+        tolerance (float) - meters of the Douglas-Peucker simplification (0 to not simplify)
+        verbose (boolean) - True to print how many points were dropped
+
+    OUT: df (pandas DataFrame) - the points that are kept
+         report (dict) - number of points, points dropped by the thinning and by the simplification, and points kept
+    '''
+    x, y, _ = project_trace(df[lat_col].to_numpy(), df[long_col].to_numpy())
+    t = pd.to_datetime(df[time_col]).to_numpy().astype('datetime64[ns]').astype(np.int64) / 1e9
+
+    keep = thin_trace(x, y, t, min_time=min_time, min_dist=min_dist)
+    thinned = len(df) - keep.sum()
+
+    if tolerance > 0:
+        idx = np.flatnonzero(keep)
+        keep[idx[~simplify_trace(x[idx], y[idx], tolerance)]] = False
+    simplified = len(df) - thinned - keep.sum()
+
+    report = {'points': len(df), 'thinned': int(thinned), 'simplified': int(simplified), 'kept': int(keep.sum())}
+    if verbose:
+        print(f"Dropped {report['points'] - report['kept']} of {report['points']} points "
+              f"({report['thinned']} thinned, {report['simplified']} simplified)")
+
+    return df[keep], report
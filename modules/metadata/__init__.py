@@ -15,48 +15,30 @@ import matplotlib
 matplotlib.use('agg')
 
 import pandas as pd
-import os
 import panel as pn
-import time
+from functools import partial
 
 import matplotlib.pyplot as plt
-import threading
 import param
 
 pn.extension()
 
-from .functions import get_metadata, display_data #display_node_data, display_edge_data
+from .functions import get_metadata, display_data, get_edge_labels, get_metadata_store #display_node_data, display_edge_data
 from .visualization import generate_markdown
-########################################## DATA CONSTANTS ########################################## 
-# Get Data Directory
-# Get the directory of the current file
-current_file_dir = os.path.dirname(os.path.abspath(__file__))
-
-# Generalize the target directory path
-# Assuming the target path is ../../data/output relative to the current file
-generalized_path = os.path.join(current_file_dir, '..', '..', 'data', 'output')
-
-# Normalize the path to ensure it's in the correct format
-metadata_dir  = os.path.normpath(generalized_path)
-
-# File names
-c_e_f_file = 'c_edge_f.csv'
-c_e_s_file = 'c_edge_s.csv'
-c_n_f_file = 'c_node_f.csv'
-c_n_s_file = 'c_node_s.csv'
-
 ########################################## CONSTANTS ########################################## 
-# Instantiate global vars
-config = None
-
 ########################################## MAIN FUNCTION ########################################## 
 
 # Function that edits website column to add metadata functionality
 def add_metadata_widgets(column, row, c):
 
-    # read in config variable
-    global config
-    config = c
+    # the plot updater and the widgets belong to this session (panel serve runs the app once per session),
+    # so exploring a region only updates the dropdowns and plots of the session that explored it
+    plot_updater = PlotUpdater()
+    node_select, edge_select = create_select_widgets(plot_updater)
+
+    # Create the drawing button and attach the function to the button's click
+    drawing_button = pn.widgets.Button(name='Explore Region', description='Draw a box on the map')
+    drawing_button.on_click(partial(on_button_click, config=c, plot_updater=plot_updater))
 
     # edit panel column object
     column[:] = [
@@ -90,29 +72,30 @@ def add_metadata_widgets(column, row, c):
 
 ########################################## HELPER FUNCTIONS ########################################## 
 
-##### -------------------- Create Drawing Button and Link to Event -------------------- #####
+##### -------------------- Drawing Button Event -------------------- #####
 # Define function called when drawing button is clicked
-def on_button_click(event):
+def on_button_click(event, config, plot_updater):
     print(f'\nButton clicked! Getting Metadata...')
-    get_metadata(config.map, config.bounding_box)
+    # the whole query uses the current version of the metadata, even if a new version is swapped in meanwhile
+    store = get_metadata_store()
+    filtered = get_metadata(config.map, config.bounding_box, store)
 
-# Create the drawing button
-drawing_button = pn.widgets.Button(name='Explore Region', description='Draw a box on the map')
-
-# Attach the function to the button's click
-drawing_button.on_click(on_button_click)
+    # hand the filtered metadata to the plot updater, the select widgets are updated right away
+    if filtered is not None:
+        c_e_f, c_e_s, c_n_f, c_n_s = filtered
+        plot_updater.publish(df_n=c_n_s, df_e=c_e_s, df_n_f=c_n_f, df_e_f=c_e_f, flow_labels=store.edge_labels())
 
 ##### -------------------- Parameterized Class for Select Widgets and Plots -------------------- #####
 class PlotUpdater(param.Parameterized):
     # chosen intersection (n) and road (e) from select widget
     selected_option_n = param.Integer(default=None)
-    selected_option_e = param.String(default=None)
+    selected_option_e = param.Integer(default=None)    # edge id
     # current (soon to be past) intersection (n) and road (e)
     cur_n = param.Integer(default=0)
-    cur_e = param.String(default=None)
-    # select widget options
-    options_n = param.List()
-    options_e = param.List()
+    cur_e = param.Integer(default=None)
+    # select widget options (roads are "(u, v, key)" label: edge id)
+    options_n = param.List(default=[])
+    options_e = param.Dict(default={})
     # matplotlib plot
     plot_pane = param.ClassSelector(class_=pn.pane.Matplotlib)
     # markdown pane
@@ -122,73 +105,34 @@ class PlotUpdater(param.Parameterized):
     df_e = pd.DataFrame()
     df_n_f = pd.DataFrame()
     df_e_f = pd.DataFrame()
+    # "(u, v, key)" label of the edge ids of the node flows
+    flow_labels = {}
 
-    def __init__(self, file_path_n, file_path_e, file_path_n_f, file_path_e_f, **params):
+    def __init__(self, **params):
         super().__init__(**params)
-        # file paths
-        self.file_path_n = file_path_n
-        self.file_path_e = file_path_e
-        self.file_path_n_f = file_path_n_f
-        self.file_path_e_f = file_path_e_f
         # plot pane
         self.plot_pane = pn.pane.Matplotlib(self.create_placeholder_plot(), width=900, height=300)
         # markdown pane
         self.metadata_markdown_pane = pn.pane.Markdown('''
                                                         Metadata:
                                                        ''', width=200)
-        # update functions
-        self.update_options_n()
-        self.update_options_e()
-        self.update_options_n_f()
-        self.update_options_e_f()
-        # function to update pandas dfs and select widget options
-        self.watch_file(self.file_path_n, self.update_options_n)
-        self.watch_file(self.file_path_e, self.update_options_e)
-        self.watch_file(self.file_path_n_f, self.update_options_n_f)
-        self.watch_file(self.file_path_e_f, self.update_options_e_f)
 
     def create_placeholder_plot(self):
         # placeholder needed to avoid Attribute error
         fig, ax = plt.subplots(1, 3, figsize=(15, 5))
         ax[0].text(0.1, 0.5, 'Select an option above')
         return fig
-    
-    def update_options_n(self, options=None):
-        # Update node options in select widget given dataframe file
-        if options is not None:
-            self.options_n = options
-        else:
-            try:
-                self.df_n = pd.read_csv(self.file_path_n)
-                self.options_n = self.df_n['Node'].unique().tolist()
-            except Exception as e:
-                print(f'Error reading Structural Node CSV file: {e}')
-    
-    def update_options_n_f(self):
-        # Update dataframe
-        try:
-            self.df_n_f = pd.read_csv(self.file_path_n_f)
-        except Exception as e:
-            print(f'Error reading Functional Node CSV file: {e}')
-
-    def update_options_e(self, options=None):
-        # Update edge options in select widget given dataframe file
-        if options is not None:
-            self.options_e = options
-        else:
-            try:
-                self.df_e = pd.read_csv(self.file_path_e)
-                self.df_e_f = pd.read_csv(self.file_path_e_f)
-                self.options_e = self.df_e['Edge'].unique().tolist()
-            except Exception as e:
-                print(f'Error reading Edge CSV file: {e}')
-    
-    def update_options_e_f(self):
-        # Update dataframe
-        try:
-            self.df_e_f = pd.read_csv(self.file_path_e_f)
-        except Exception as e:
-            print(f'Error reading Functional Edge CSV file: {e}')
+
+    def publish(self, df_n, df_e, df_n_f, df_e_f, flow_labels):
+        # Update the pandas dfs with the metadata of the explored region, then the select widget options
+        self.df_n, self.df_e, self.df_n_f, self.df_e_f = df_n, df_e, df_n_f, df_e_f
+        self.flow_labels = flow_labels
+
+        # the structural edge metadata has the (u, v, key) of its edges
+        edge_labels = get_edge_labels(self.df_e)
+
+        self.options_n = self.df_n['Node'].unique().tolist()
+        self.options_e = {edge_labels.get(e, str(e)): e for e in self.df_e['Edge'].unique().tolist()}
 
     # Update plot when the selected options changes
     @param.depends('selected_option_n', 'selected_option_e', watch=True)
@@ -199,7 +143,7 @@ class PlotUpdater(param.Parameterized):
             
             # get plots
             filtered_df_n = self.df_n_f[self.df_n_f['Node'] ==  self.selected_option_n]
-            fig = display_data(filtered_df_n)
+            fig = display_data(filtered_df_n, labels=self.flow_labels)   # node flow is keyed by edge id
             
             # get markdown
             filtered_df_n_s = self.df_n[self.df_n['Node'] == self.selected_option_n]
@@ -209,7 +153,7 @@ class PlotUpdater(param.Parameterized):
             self.cur_n = self.selected_option_n
 
         # Plots chosen edge info
-        elif self.selected_option_e and not self.df_e_f.empty:
+        elif self.selected_option_e is not None and not self.df_e_f.empty:
 
             # get plots
             filtered_df_e = self.df_e_f[self.df_e_f['Edge'] == self.selected_option_e]
@@ -223,46 +167,25 @@ class PlotUpdater(param.Parameterized):
         self.plot_pane.object = fig
         self.metadata_markdown_pane.object = markdown_pane
 
-    def watch_file(self, file_path, update_func):
-        # Reload file to update node/edge options if files are modified
-        def _watch():
-            last_modified = 0
-            while True:
-                try:
-                    current_modified = os.path.getmtime(file_path)
-                    if current_modified != last_modified:
-                        last_modified = current_modified
-                        update_func()
-                    time.sleep(5)   # check every five seconds
-                except KeyboardInterrupt:
-                    print('Stopped watching file.')
-                    break
-        watcher_thread = threading.Thread(target=_watch, daemon=True)
-        watcher_thread.start()
-
-##### -------------------- Initialize plot updater with CSV files -------------------- #####
-plot_updater = PlotUpdater(file_path_n=os.path.join(metadata_dir, c_n_s_file),  # structural node metadata
-                           file_path_e=os.path.join(metadata_dir, c_e_s_file),  # structural edge metadata
-                           file_path_n_f=os.path.join(metadata_dir, c_n_f_file),    # functional node metadata
-                           file_path_e_f=os.path.join(metadata_dir, c_e_f_file)     # functional edge metadata
-                           )
-
 ##### -------------------- Create Select Widgets and Link to Events -------------------- #####
-# Create the Select widgets
-node_select = pn.widgets.Select(name='Intersections', options=plot_updater.options_n)
-edge_select = pn.widgets.Select(name='Roads', options=plot_updater.options_e)
+def create_select_widgets(plot_updater):
+    # Create the Select widgets (the options are empty until a region is explored)
+    node_select = pn.widgets.Select(name='Intersections', options=plot_updater.options_n)
+    edge_select = pn.widgets.Select(name='Roads', options=plot_updater.options_e)
+
+    # Link Select widgets to the parameters
+    node_select.param.watch(lambda event: setattr(plot_updater, 'selected_option_n', event.new), 'value')
+    edge_select.param.watch(lambda event: setattr(plot_updater, 'selected_option_e', event.new), 'value')
 
-# Link Select widgets to the parameters
-node_select.param.watch(lambda event: setattr(plot_updater, 'selected_option_n', event.new), 'value')
-edge_select.param.watch(lambda event: setattr(plot_updater, 'selected_option_e', event.new), 'value')
+    # Link the select widgets to the options parameters
+    def update_select_options(event):
+        node_select.options = plot_updater.options_n
+        edge_select.options = plot_updater.options_e
 
-# Link the select widgets to the options parameters
-def update_select_options(event):
-    node_select.options = plot_updater.options_n
-    edge_select.options = plot_updater.options_e
+    # Update select options
+    plot_updater.param.watch(update_select_options, ['options_n', 'options_e'])
 
-# Update select options
-plot_updater.param.watch(update_select_options, ['options_n', 'options_e'])
+    return node_select, edge_select
 
 
 
@@ -12,13 +12,29 @@ Author: Ana Uribe
 import numpy as np
 import osmnx as ox
 import os
+import threading
+import time
 import pandas as pd
 
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('agg')
 
-from .visualization import plot_map, plot_speed_stats, plot_boxplot, plot_flow
+from .visualization import plot_map, plot_roads, plot_speed_stats, plot_boxplot, plot_flow
+from .generate_metadata.storage import (read_table,
+                                        find_table,
+                                        table_columns,
+                                        parse_value,
+                                        ci_type,
+                                        boxplot_type,
+                                        edge_flow_type,
+                                        node_flow_type,
+                                        edge_list_type,
+                                        coords_type,
+                                       )
+from .generate_metadata.graph_cache import GraphCache
+from .generate_metadata.region_index import get_region_index
+from .generate_metadata.snapshot import read_pointer, get_snapshot_dir
 
 ########################################## DATA UPLOAD ########################################## 
 
@@ -34,41 +50,339 @@ generalized_path = os.path.join(current_file_dir, '..', '..', 'data', 'output')
 # Normalize the path to ensure it's in the correct format
 metadata_dir  = os.path.normpath(generalized_path)
 
-e_f_file = 'edge_f.csv'
-e_s_file = 'edge_s.csv'
-n_f_file = 'node_f.csv'
-n_s_file = 'node_s.csv'
-
-c_e_f_file = 'c_edge_f.csv'
-c_e_s_file = 'c_edge_s.csv'
-c_n_f_file = 'c_node_f.csv'
-c_n_s_file = 'c_node_s.csv'
-
-# create pandas df for each file
-e_f = pd.read_csv(os.path.join(metadata_dir, e_f_file))
-e_s = pd.read_csv(os.path.join(metadata_dir, e_s_file))
-n_f = pd.read_csv(os.path.join(metadata_dir, n_f_file))
-n_s = pd.read_csv(os.path.join(metadata_dir, n_s_file))
+# road network graphs are cached in ../../data/graph_cache by tile (see generate_metadata/graph_cache.py)
+graph_cache_dir = os.path.normpath(os.path.join(current_file_dir, '..', '..', 'data', 'graph_cache'))
+
+# metadata tables are Parquet files (older outputs are read from the CSV files with the same name)
+e_f_file = 'edge_f.parquet'
+e_s_file = 'edge_s.parquet'
+n_f_file = 'node_f.parquet'
+n_s_file = 'node_s.parquet'
+
+# nested columns of the metadata tables
+e_f_types = {'Avg_speed_CI': ci_type, 'Travel_time_CI': ci_type, 'Boxplot_speed': boxplot_type, 'Boxplot_time': boxplot_type, 'Flow': edge_flow_type}
+n_f_types = {**e_f_types, 'Flow': node_flow_type}
+n_s_types = {'OSM_edges': edge_list_type}
+e_s_types = {'Geometry': coords_type}
+nested_cols = list(set(e_f_types) | set(n_s_types) | set(e_s_types))
+
+# edges are saved as integer edge ids, with the (u, v, key) of each edge in the edge structural file
+edge = 'Edge'
+edge_keys = ['u', 'v', 'key']
+edge_pattern = r'\((-?\d+), (-?\d+), (-?\d+)\)'   # older files save edges as "(u, v, key)" strings
+
+########################################## CONVERSION READER ########################################## 
+
+def get_edge_key_df(edge_col):
+    '''
+    IN: edge_col (pandas Series) - edges as "(u, v, key)" strings
+
+    OUT: key_df (pandas DataFrame) - u, v, key int columns with the same index as edge_col
+    '''
+    key_df = edge_col.astype(str).str.extract('^' + edge_pattern + '$').astype(np.int64)
+    key_df.columns = edge_keys
+
+    return key_df
+
+def replace_edge_strs(col, edge_id_map):
+    '''
+    IN: col (pandas Series) - strings with "(u, v, key)" edges in them (flow dicts, lists of edges)
+        edge_id_map (dict) - (u, v, key): edge id
+
+    OUT: (pandas Series) col with every edge in edge_id_map (and its quotes) replaced by its edge id
+    '''
+    def to_id(match):
+        e = edge_id_map.get((int(match[1]), int(match[2]), int(match[3])))
+        return match[0] if e is None else str(e)
+
+    return col.str.replace("'?" + edge_pattern + "'?", to_id, regex=True)
+
+def convert_legacy_metadata(e_f, e_s, n_f, n_s):
+    '''
+    Converts older metadata files, where edges are saved as "(u, v, key)" strings, to integer edge ids.
+    Every edge referenced by the files gets an id, in order of appearance.
+
+    OUT: e_f, e_s, n_f, n_s (pandas dfs) - metadata with edge ids (e_s also gets the u, v, key columns)
+         edge_id_df (pandas df) - Edge, u, v, key of every edge
+    '''
+    # get the (u, v, key) of every edge referenced by the files
+    edge_strs = pd.concat([e_s[edge], e_f[edge], n_f['Flow'], n_s['OSM_edges']]).dropna().astype(str)
+    key_df = edge_strs.str.extractall(edge_pattern).astype(np.int64).drop_duplicates().reset_index(drop=True)
+    key_df.columns = edge_keys
+
+    edge_id_df = key_df
+    edge_id_df.insert(0, edge, np.arange(len(key_df), dtype=np.int64))
+    edge_index = pd.MultiIndex.from_frame(edge_id_df[edge_keys])
+    edge_id_map = dict(zip(edge_index, edge_id_df[edge]))
+
+    # edge columns
+    e_s_keys = get_edge_key_df(e_s[edge])
+    e_s = pd.concat([e_s[[edge]], e_s_keys, e_s.drop(columns=edge)], axis=1)
+    e_s[edge] = edge_index.get_indexer(pd.MultiIndex.from_frame(e_s_keys))
+    e_f[edge] = edge_index.get_indexer(pd.MultiIndex.from_frame(get_edge_key_df(e_f[edge])))
+
+    # edges inside the node flow dicts and OSM edge lists
+    n_f['Flow'] = replace_edge_strs(n_f['Flow'], edge_id_map)
+    n_s['OSM_edges'] = replace_edge_strs(n_s['OSM_edges'], edge_id_map)
+
+    return e_f, e_s, n_f, n_s, edge_id_df
+
+def parse_nested_cols(df):
+    '''
+    CSV files save the nested columns (confidence intervals, boxplots, flows, edge lists) as strings, parse them
+    '''
+    for col in nested_cols:
+        if col in df.columns:
+            df[col] = df[col].map(parse_value)
+
+    return df
+
+def read_metadata(metadata_dir):
+    '''
+    Reads the edge/node metadata files, converting older files with "(u, v, key)" edge strings (see convert_legacy_metadata)
+
+    OUT: e_f, e_s, n_f, n_s (pandas dfs) - metadata with integer edge ids
+         edge_id_df (pandas df) - Edge, u, v, key of every edge
+    '''
+    e_f = read_table(find_table(os.path.join(metadata_dir, e_f_file)))
+    e_s = read_table(find_table(os.path.join(metadata_dir, e_s_file)))
+    n_f = read_table(find_table(os.path.join(metadata_dir, n_f_file)))
+    n_s = read_table(find_table(os.path.join(metadata_dir, n_s_file)))
+
+    if all(k in e_s.columns for k in edge_keys):
+        edge_id_df = e_s[[edge] + edge_keys]
+    else:
+        e_f, e_s, n_f, n_s, edge_id_df = convert_legacy_metadata(e_f, e_s, n_f, n_s)
+
+    e_f, e_s, n_f, n_s = parse_nested_cols(e_f), parse_nested_cols(e_s), parse_nested_cols(n_f), parse_nested_cols(n_s)
+
+    return e_f, e_s, n_f, n_s, edge_id_df
+
+def get_edge_labels(edge_id_df):
+    '''
+    Returns a dict with the "(u, v, key)" label of each edge id
+    '''
+    return {e: f'({u}, {v}, {k})' for e, u, v, k in edge_id_df[[edge] + edge_keys].itertuples(index=False, name=None)}
+
+########################################## METADATA STORE ########################################## 
+
+class MetadataStore:
+    '''
+    Edge/node metadata tables of metadata_dir (a version of the metadata), loaded on first use and shared by every
+    session of the server.
+
+    A table is read with only the columns that were asked for, and the other columns are read (and added to it)
+    the first time they are needed, so building the edge labels or the spatial index does not read the
+    functional metadata. Older files with "(u, v, key)" edge strings are read and converted all at once
+    (see convert_legacy_metadata). The columns of each file are read once, so the tables that are loaded can still be
+    queried after the snapshot directory of the store is pruned.
+    '''
+    files = {'edge_f': e_f_file, 'edge_s': e_s_file, 'node_f': n_f_file, 'node_s': n_s_file}
+    id_types = {edge: np.int64, 'Node': np.int64, 'u': np.int64, 'v': np.int64, 'key': np.int64}
+
+    def __init__(self, metadata_dir, version=None):
+        self.metadata_dir = metadata_dir
+        self.version = version          # None for an output directory without snapshots
+        self.lock = threading.RLock()   # sessions run in threads, a table is read once
+        self.legacy = None              # True if the files save edges as "(u, v, key)" strings
+        self.tables = {}                # name: dataframe with the columns read so far
+        self.columns = {}               # name: columns of the file
+        self.derived = {}               # edge index, edge labels, region index
+
+    def get_path(self, name):
+        return find_table(os.path.join(self.metadata_dir, self.files[name]))
+
+    def get_columns(self, name):
+        '''
+        Returns the columns of the file of the table (read once)
+        '''
+        with self.lock:
+            if name not in self.columns:
+                self.columns[name] = table_columns(self.get_path(name))
+
+        return self.columns[name]
+
+    def get_table(self, name, columns=None):
+        '''
+        IN: name (str) - 'edge_f', 'edge_s', 'node_f' or 'node_s'
+            columns (list) - columns that are needed (all if None), the columns that the table does not have are skipped
+
+        OUT: df (pandas DataFrame) - table with integer ids and its nested columns as python objects
+        '''
+        with self.lock:
+            if self.legacy is None:
+                self.legacy = not all(k in self.get_columns('edge_s') for k in edge_keys)
+
+            if self.legacy:
+                if not self.tables:
+                    e_f, e_s, n_f, n_s, edge_id_df = read_metadata(self.metadata_dir)
+                    self.tables.update(edge_f=e_f, edge_s=e_s, node_f=n_f, node_s=n_s)
+                    # the edges of the node flows that are not in edge_s also got ids
+                    self.derived['edge_ids'] = edge_id_df
+                all_cols = self.tables[name].columns.tolist()
+            else:
+                all_cols = self.get_columns(name)
+
+            cols = all_cols if columns is None else [c for c in columns if c in all_cols]
+
+            # read the columns that are not loaded yet, and keep the columns in the order of the file
+            df = self.tables.get(name)
+            missing = [c for c in cols if df is None or c not in df.columns]
+            if missing:
+                new_df = read_table(self.get_path(name), columns=missing,
+                                    dtype={c: t for c, t in self.id_types.items() if c in missing},
+                                    nested_cols=nested_cols)
+                df = new_df if df is None else pd.concat([df, new_df], axis=1)
+                df = df[[c for c in all_cols if c in df.columns]]
+                self.tables[name] = df
+
+        return df if df.columns.tolist() == cols else df[cols]
+
+    # typed accessors
+    def edge_f(self, columns=None):
+        return self.get_table('edge_f', columns)
+
+    def edge_s(self, columns=None):
+        return self.get_table('edge_s', columns)
+
+    def node_f(self, columns=None):
+        return self.get_table('node_f', columns)
+
+    def node_s(self, columns=None):
+        return self.get_table('node_s', columns)
+
+    def get_derived(self, name, func):
+        with self.lock:
+            if name not in self.derived:
+                value = func()
+                self.derived.setdefault(name, value)
+
+        return self.derived[name]
+
+    def edge_ids(self):
+        '''
+        Returns the Edge, u, v, key of every edge
+        '''
+        return self.get_derived('edge_ids', lambda: self.edge_s([edge] + edge_keys))
+
+    def edge_index(self):
+        '''
+        Returns the (u, v, key) of the edges (in the order of edge_ids) as a pandas MultiIndex
+        '''
+        return self.get_derived('edge_index', lambda: pd.MultiIndex.from_frame(self.edge_ids()[edge_keys]))
+
+    def edge_id_map(self):
+        '''
+        Returns a dict with the edge id of each (u, v, key)
+        '''
+        return self.get_derived('edge_id_map', lambda: dict(zip(self.edge_index(), self.edge_ids()[edge])))
+
+    def edge_labels(self):
+        '''
+        Returns a dict with the "(u, v, key)" label of each edge id
+        '''
+        return self.get_derived('edge_labels', lambda: get_edge_labels(self.edge_ids()))
+
+    def region_index(self):
+        '''
+        Returns the spatial index of the edge geometries and node coordinates (None for older files without them)
+        '''
+        return self.get_derived('region_index', lambda: get_region_index(self.edge_s([edge, 'Geometry']),
+                                                                         self.node_s(['Node', 'x', 'y'])))
+
+    def load(self):
+        '''
+        Reads everything the region queries use (all the tables, the edge index and labels, the spatial index)
+        '''
+        for name in self.files:
+            self.get_table(name)
+        self.edge_id_map()
+        self.edge_labels()
+        self.region_index()
+
+########################################## METADATA VERSIONS ########################################## 
+
+# the pipeline publishes each version of the metadata as a snapshot and swaps a pointer file to it
+# (see generate_metadata/snapshot.py), the pointer is checked every reload_interval seconds
+reload_interval = 5
+
+# nothing is read until a table is used
+store_lock = threading.Lock()
+current_version = read_pointer(metadata_dir)
+metadata_store = MetadataStore(get_snapshot_dir(metadata_dir, current_version), version=current_version)
+
+def get_metadata_store():
+    '''
+    Returns the metadata store of the current version (the version in the pointer file). If the watcher has not
+    swapped in that version yet, a store of it (read on first use) is swapped in now, so a query never reads an
+    old version that may have been pruned.
+    A query should get the store once and use it until it finishes, the store can be swapped while it runs.
+    '''
+    global metadata_store
+
+    version = read_pointer(metadata_dir)
+    with store_lock:
+        if version is not None and version != metadata_store.version:
+            metadata_store = MetadataStore(get_snapshot_dir(metadata_dir, version), version=version)
+
+        return metadata_store
+
+def watch_metadata_versions():
+    '''
+    Loads each new version of the metadata in the background and swaps it in for the next queries.
+    The queries that already have the old store finish with it, and it is freed when the last one is done.
+    '''
+    global metadata_store
+
+    last_version = metadata_store.version
+    while True:
+        version = read_pointer(metadata_dir)
+        if version is not None and version != last_version and version != metadata_store.version:
+            last_version = version
+            try:
+                print(f'Loading map metadata version {version}')
+                new_store = MetadataStore(get_snapshot_dir(metadata_dir, version), version=version)
+                new_store.load()
+
+                with store_lock:
+                    # the pointer can have moved on while the version was loading (get_metadata_store has the newer one)
+                    if read_pointer(metadata_dir) == version:
+                        metadata_store = new_store
+                print(f'Map metadata version {version} loaded')
+            except Exception as e:
+                # keep the old version until the pointer changes again
+                print(f'Error loading map metadata version {version}: {e}')
+
+        time.sleep(reload_interval)
+
+# the watcher runs from the start, so an idle server keeps up with the versions the pipeline publishes
+watcher_thread = threading.Thread(target=watch_metadata_versions, daemon=True)
+watcher_thread.start()
+
 ########################################## FUNCTIONS ########################################## 
 
 POINT_RANGE = 0.05
 network_type = 'drive'
 
-def get_metadata(m, bb):
+graph_cache = GraphCache(graph_cache_dir, network_type=network_type)
+
+def get_metadata(m, bb, store=None):
     '''
     IN: m (ipyleaflet map)
         bb (boundig box)
+        store (MetadataStore) - metadata to query (the current version if None)
 
-    DESCRIPTION: get the OSMnx road network within the bounding box,
-                 and return the road network and all the related metadata
+    DESCRIPTION: get the road network within the bounding box (from the spatial index of the metadata,
+                 or the OSMnx graph for older metadata files), and return the road network and all the related metadata
 
-    OUT: m_plus (ipyleaflet map) map with OSMnx road network 
-         metadata_df (pandas df) OSM and computed metadata
+    OUT: c_e_f, c_e_s, c_n_f, c_n_s (pandas dfs) functional and structural metadata of the edges and nodes in the
+                                                 bounding box (None if there is no bounding box), the road network
+                                                 is added to m
     '''
 
     # Determine if bounding box or point
     if bb == None:
-        return
+        return None
     else:
         if isinstance(bb[0], float):  # Handle single point shape
             lat_coord = bb[1]
@@ -90,33 +404,49 @@ def get_metadata(m, bb):
 
     # print(min_lat, min_long, max_lat, max_long)
 
-    # get OSMnx graph from bounding box
-    G = ox.graph_from_bbox(north=max_lat, 
-                           south=min_lat,
-                           east=max_long,
-                           west=min_long,
-                           network_type=network_type)
-    
-    # add OSMnx graph to map and return it 
-    plot_map(ox_map=G, m=m)
-
-    # save edge/node information from OSMnx graph
-    osm_nodes, osm_edges = ox.graph_to_gdfs(G)
-
-    # get list of edges/nodes from OSMnx graph
-    osm_nodes_list = list(osm_nodes.index)
-    osm_edges['Edge'] = list(zip(osm_edges.index.get_level_values('u'), osm_edges.index.get_level_values('v'), osm_edges.index.get_level_values('key')))
-    osm_edges_list = list(osm_edges['Edge'])
+    if store is None:
+        store = get_metadata_store()
+
+    region_index = store.region_index()
+    if region_index is not None:
+        # edges and nodes of the metadata in the bounding box, from the spatial index
+        osm_edges_list, osm_nodes_list = region_index.query(north=max_lat, south=min_lat, east=max_long, west=min_long)
+
+        # add the edges and nodes to map
+        e_s = store.edge_s([edge] + edge_keys + ['Geometry'])
+        n_s = store.node_s(['Node', 'x', 'y'])
+        region_e_s = e_s[e_s['Edge'].isin(osm_edges_list)]
+        region_n_s = n_s[n_s['Node'].isin(osm_nodes_list)]
+        plot_roads(roads=zip(region_e_s['u'], region_e_s['v'], region_e_s['Geometry']),
+                   nodes=zip(region_n_s['Node'], region_n_s['x'], region_n_s['y']),
+                   m=m)
+    else:
+        # older metadata files have no geometries, get OSMnx graph from bounding box (stitched from the cached tiles)
+        G = graph_cache.get_graph(north=max_lat, 
+                                  south=min_lat,
+                                  east=max_long,
+                                  west=min_long,
+                                  retain_all=False,
+                                  truncate_by_edge=False)
+        
+        # add OSMnx graph to map and return it 
+        plot_map(ox_map=G, m=m)
+
+        # save edge/node information from OSMnx graph
+        osm_nodes, osm_edges = ox.graph_to_gdfs(G)
+
+        # get list of nodes and edge ids from OSMnx graph (the (u, v, key) index of the edges is joined to the edge ids)
+        osm_nodes_list = osm_nodes.index.to_numpy()
+        osm_edge_rows = store.edge_index().get_indexer(osm_edges.index)
+        osm_edges_list = store.edge_ids()[edge].to_numpy()[osm_edge_rows[osm_edge_rows >= 0]]
 
     # print(osm_edges_list[0:2])
     # print(osm_nodes_list[0:5])
 
-    # Convert tuples to strings
-    osm_edges_list_str = [str(value) for value in osm_edges_list]
-
     # get computed metadata for the edges and nodes in the list
-    c_e_f = e_f[e_f['Edge'].isin(osm_edges_list_str)]
-    c_e_s = e_s[e_s['Edge'].isin(osm_edges_list_str)]
+    e_f, e_s, n_f, n_s = store.edge_f(), store.edge_s(), store.node_f(), store.node_s()
+    c_e_f = e_f[e_f['Edge'].isin(osm_edges_list)]
+    c_e_s = e_s[e_s['Edge'].isin(osm_edges_list)]
     c_n_f = n_f[n_f['Node'].isin(osm_nodes_list)]
     c_n_s = n_s[n_s['Node'].isin(osm_nodes_list)]
 
@@ -125,18 +455,16 @@ def get_metadata(m, bb):
     # print(c_n_f.head(3))
     # print(c_n_s.head(3))
 
-    # save filtered dataframes
-    c_e_f.to_csv(os.path.join(metadata_dir, c_e_f_file), index=None)
-    c_e_s.to_csv(os.path.join(metadata_dir, c_e_s_file), index=None)
-    c_n_f.to_csv(os.path.join(metadata_dir, c_n_f_file), index=None)
-    c_n_s.to_csv(os.path.join(metadata_dir, c_n_s_file), index=None)
+    # the filtered dataframes are handed to the plot updater of the session in memory
+    return c_e_f, c_e_s, c_n_f, c_n_s
 
-def display_data(filtered_df):
+def display_data(filtered_df, labels=None):
     # filtered_df has either 4 rows (one per time bin) or one row with all values
+    # labels (dict) - legend label of each flow key (edge ids of the node flow)
     fig, axs = plt.subplots(1,3, figsize=(15, 5))
     plot_boxplot(axs[0], filtered_df, p=1)
     plot_boxplot(axs[1], filtered_df, p=0)
-    plot_flow(axs[2], filtered_df)
+    plot_flow(axs[2], filtered_df, labels)
 
     fig.tight_layout()
     plt.close(fig)
@@ -0,0 +1,8 @@
+'''
+File name: modules/metadata/generate_metadata/__init__.py
+
+Description: scripts that generate the map metadata (run them one at a time, see map_metadata_documentation.md).
+
+             The dashboard imports the storage functions from here:
+             from .generate_metadata.storage import read_table
+'''
@@ -0,0 +1,144 @@
+'''
+File name: edge_index
+
+DESCRIPTION: Contains the edge id helpers shared by the scripts: the compact integer edge id map of the
+             (u, v, key) edges, the lookup of edge ids, the alignment of the edge ids of a new batch (or shard)
+             with saved ones, and the index of the edge vectors saved by get_map_matching.py.
+
+             They are kept apart from the aggregation functions of utils.py, so changing the aggregation
+             does not change the code of the map matching and trajectory segment stages of the pipeline.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import json
+import numpy as np
+import pandas as pd
+import os
+
+########################################## VARIABLES ##########################################
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.json'))
+
+########################################## LOAD IN CONSTANTS ##########################################
+# dictionary with constants
+j_file = open(constants_path)
+constants_dict = json.load(j_file)
+j_file.close()
+
+# get metadata column names
+edge = constants_dict['metadata cols']['edge']
+edge_keys = constants_dict['metadata cols']['edge keys']
+
+########################################## EDGE INDEX ##########################################
+def get_edge_key_cols(edge_col):
+    '''
+    IN: edge_col (pandas Series) - edges as tuples or as strings like "(65296334, 65362651, 0)" (older files)
+
+    OUT: key_df (pandas DataFrame) - u, v, key columns (Int64, missing edges are <NA>) with the same index as edge_col
+    '''
+    key_df = edge_col.astype(str).str.extract(r'^\((-?\d+), (-?\d+), (-?\d+)\)$')
+    key_df.columns = edge_keys
+
+    return key_df.astype('Int64')
+
+def get_edge_key_df(e_df):
+    '''
+    Returns the u, v, key columns of an edge df, parsing them from the edge column if the df doesn't have them
+    '''
+    if all(k in e_df.columns for k in edge_keys):
+        return e_df[edge_keys].astype('Int64')
+    else:
+        return get_edge_key_cols(e_df[edge])
+
+def get_edge_id_map(edges):
+    '''
+    IN: edges (list) - unique (u, v, key) edge tuples
+
+    OUT: edge_id_df (pandas DataFrame) - compact edge id map with columns:
+                                            Edge - integer id of the edge (0, 1, 2, ...)
+                                            u, v, key - int64 keys of the edge
+    '''
+    key_df = pd.DataFrame(list(edges), columns=edge_keys, dtype=np.int64)
+    key_df.insert(0, edge, np.arange(len(key_df), dtype=np.int64))
+
+    return key_df
+
+def get_edge_ids(edges, edge_id_df):
+    '''
+    IN: edges (array-like) - (u, v, key) edge tuples (or None)
+        edge_id_df (pandas DataFrame) - compact edge id map (see get_edge_id_map)
+
+    OUT: ids (pandas array) - Int64 id of each edge (<NA> for None or edges not in the map)
+    '''
+    # look up each distinct edge once
+    codes, unique_edges = pd.factorize(pd.Series(edges, dtype=object))
+
+    id_index = pd.MultiIndex.from_frame(edge_id_df[edge_keys])
+    rows = id_index.get_indexer(pd.MultiIndex.from_tuples(list(unique_edges), names=edge_keys)) if len(unique_edges) else np.array([], dtype=int)
+
+    unique_ids = pd.array(edge_id_df[edge].to_numpy()[rows], dtype='Int64')
+    unique_ids[rows < 0] = pd.NA
+
+    ids = unique_ids.take(codes, allow_fill=True)
+
+    return ids
+
+def align_edge_ids(edge_id_df, stored_edge_id_df):
+    '''
+    IN: edge_id_df (pandas DataFrame) - edge id map of a new batch (see get_edge_id_map)
+        stored_edge_id_df (pandas DataFrame) - edge id map of the saved metadata
+
+    OUT: id_map (pandas Series) - batch edge id: saved edge id of the same (u, v, key),
+                                  edges that are not saved get new ids after the largest saved id
+    '''
+    stored_index = pd.MultiIndex.from_frame(stored_edge_id_df[edge_keys].astype(np.int64))
+    rows = stored_index.get_indexer(pd.MultiIndex.from_frame(edge_id_df[edge_keys].astype(np.int64)))
+
+    is_new = rows < 0
+    first_new_id = stored_edge_id_df[edge].max() + 1 if len(stored_edge_id_df) else 0
+
+    ids = stored_edge_id_df[edge].to_numpy(dtype=np.int64)[rows]
+    ids[is_new] = first_new_id + np.arange(is_new.sum())
+
+    return pd.Series(ids, index=edge_id_df[edge].to_numpy(dtype=np.int64))
+
+class EdgeVectorIndex:
+    '''
+    Index of the edge vectors saved by get_map_matching.py:
+        vectors - contiguous (number of edges, 2) float64 array with the [x, y] vector of each edge
+        index - hash index keyed by (u, v, key) that gives the row of each edge in vectors
+        ids - hash index keyed by the edge id that gives the row of each edge in vectors
+    '''
+
+    def __init__(self, edge_df):
+        edge_df = edge_df.dropna(subset=[edge]).drop_duplicates(subset=[edge])
+
+        if 'Vector_x' in edge_df.columns:
+            vectors = edge_df[['Vector_x', 'Vector_y']].to_numpy(dtype=np.float64)
+        else:
+            # older files save the vector as a "[x, y]" string
+            vectors = edge_df['Vector'].str.strip('[]').str.split(',', expand=True).to_numpy(dtype=np.float64)
+
+        self.vectors = np.ascontiguousarray(vectors)
+        self.index = pd.MultiIndex.from_frame(get_edge_key_df(edge_df))
+        self.ids = pd.Index(edge_df[edge])
+
+    def get_rows(self, key_df):
+        '''
+        Returns the row in self.vectors of each (u, v, key) in key_df (-1 if the edge is not in the index)
+        '''
+        return self.index.get_indexer(pd.MultiIndex.from_frame(key_df))
+
+    def get_vectors(self, edges):
+        '''
+        IN: edges (array-like) - edge ids
+
+        OUT: e_vectors (numpy array) - (len(edges), 2) array with the vector of each edge (NaN if the edge is not in the index)
+        '''
+        rows = self.ids.get_indexer(edges)
+
+        e_vectors = np.full((len(rows), 2), np.nan)
+        e_vectors[rows >= 0] = self.vectors[rows[rows >= 0]]
+
+        return e_vectors
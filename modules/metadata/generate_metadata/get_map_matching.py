@@ -6,6 +6,14 @@ DESCRIPTION: For each point of a trajectory with the following info:
              
              Perform map matching for the points using the Python package OSMnx s.t. each point 
              is associated with an edge (road) and node (intersection). 
+
+             The simplified graph of the bounding box of all the points (plus an overlap, larger than the edge and
+             node buffers) is built once, so every edge has the same (u, v, key) and geometry for all the points.
+             The points are split into square tiles (tile size degrees, from constants.json) that are matched in
+             worker processes. Each worker gets only the sub-graph of its tile (the edges and nodes of G in the
+             bounding box of the tile's points plus the overlap), and builds its nearest edge/node index on it.
+             The edges and nodes of the tiles are combined, and the edges and nodes of the points are put back in
+             their original order.
              
 Author: Ana Uribe
 '''
@@ -15,12 +23,21 @@ import os
 import pandas as pd
 import numpy as np
 import ast
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from mappymatch.utils.crs import LATLON_CRS
 
 import osmnx as ox
+import shapely
+
+from edge_index import get_edge_id_map, get_edge_ids
+from graph_cache import GraphCache
+from nearest import NearestIndex
+from storage import save_table, read_table, edge_list_type, coords_type
 
 ########################################## VARIABLES ##########################################
-constants_path = '/Users/bean/Documents/masters-project/map-metadata/constants.json'
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.json'))
 
 ########################################## LOAD IN DATA ##########################################
 # dictionary with constants
@@ -41,6 +58,7 @@ longitude = constants_dict['trajectory cols']['longitude col name']
 
 # get metadata column names
 edge = constants_dict['metadata cols']['edge']
+edge_keys = constants_dict['metadata cols']['edge keys']
 node = constants_dict['metadata cols']['node']
 
 osm_edge_cols = constants_dict['metadata cols']['OSM edge col names']
@@ -49,11 +67,24 @@ osm_edge_new_cols = constants_dict['metadata cols']['OSM edge new col names']
 osm_node_cols = constants_dict['metadata cols']['OSM node col names']
 osm_node_new_cols = constants_dict['metadata cols']['OSM node new col names']
 
+# node coordinates and edge geometries are saved with the OSM information, so the dashboard needs no graph
+node_coords = constants_dict['metadata cols']['node coords']
+edge_geometry = constants_dict['metadata cols']['edge geometry']
+
 # get map matching values
 network_type = constants_dict['map matching vals']['network type']
+tile_size = constants_dict['map matching vals']['tile size']          # degrees
+tile_overlap = constants_dict['map matching vals']['tile overlap']    # degrees
+n_workers = constants_dict['map matching vals']['workers']            # 0 to use all the cores
 
-# load in trajectory df
-df = pd.read_csv(os.path.join(processed_dir, trajectory_w_metadata_file_name))
+# road network graphs are cached on disk by tile
+graph_cache_dir = constants_dict['graph cache']['directory']
+graph_tile_size = constants_dict['graph cache']['tile size']          # degrees
+graph_offline = constants_dict['graph cache']['offline']              # 1 to only use cached tiles
+
+# points farther than these from every edge/node get no edge/node
+edge_max_dist = constants_dict['map matching vals']['edge max distance']    # meters
+node_max_dist = constants_dict['map matching vals']['node max distance']    # meters
 
 ########################################## HELPER FUNCTIONS ########################################## 
 def get_vector(x1, y1, x2, y2):
@@ -64,6 +95,9 @@ def get_vector(x1, y1, x2, y2):
     vector = [vector_x, vector_y]
     return vector
 
+def get_graph_cache(network_type):
+    return GraphCache(graph_cache_dir, network_type=network_type, tile_size=graph_tile_size, offline=graph_offline)
+
 def get_graph_from_bb(latitude, longitude, network_type, verbose=False):
     
     n = max(latitude)
@@ -72,7 +106,7 @@ def get_graph_from_bb(latitude, longitude, network_type, verbose=False):
     e = max(longitude)
     w = min(longitude)
 
-    G = ox.graph_from_bbox(n, s, e, w, network_type=network_type, simplify=True, retain_all=True, truncate_by_edge=True)
+    G = get_graph_cache(network_type).get_graph(n, s, e, w, retain_all=True, truncate_by_edge=True)
     # G = ox.project_graph(G=G, to_crs= LATLON_CRS)
 
     if verbose:
@@ -81,53 +115,55 @@ def get_graph_from_bb(latitude, longitude, network_type, verbose=False):
     
     return G
 
-def exclude_edges_nodes(l, d):
-    idx = l[0]
-    dist = l[1]
+def get_node_coords(G, node_ids):
+    '''
+    IN: G (ox graph)
+        node_ids (set) - OSM ids of nodes
 
-    new_list = []
+    OUT: node_coords (dict) - (x, y) of each node
 
-    # create new list of indexes, replace vals that have a dist > d
-    for i, cur_d in zip(idx, dist):
-        if cur_d > d:
-            new_list.append(None)
-        else:
-            new_list.append(i)
-    
-    return new_list
+    Nodes that are not in G are looked up in the node table of the graph cache (built from an OSM extract),
+    and geocoded (one request per node) only if they are not in it either
+    '''
+    node_coords = {x: (G.nodes[x]['x'], G.nodes[x]['y']) for x in node_ids if x in G.nodes}
 
-def assign_edges_nodes(G, latitude, longitude):
+    missing = [x for x in node_ids if x not in node_coords]
+    if missing:
+        table_df = get_graph_cache(network_type).get_node_coords(missing).dropna()
+        node_coords.update(zip(table_df.index, zip(table_df['x'], table_df['y'])))
+
+    for x in missing:
+        if x not in node_coords:
+            if graph_offline:
+                raise KeyError(f'Node {x} is not in the graph or in the node table of the graph cache')
+            node_data = ox.geocoder.geocode_to_gdf(query=[f"N{x}"], by_osmid=True)
+            node_coords[x] = (node_data.geometry.x.iloc[0], node_data.geometry.y.iloc[0])
+
+    return node_coords
+
+def assign_edges_nodes(G, latitude, longitude, index=None):
     ''' 
     IN: G (ox graph)
         latitude (list) - latitude values of each point in the dataset (trajectory)
         longitude (list) - longitude values of each point in the dataset
+        index (NearestIndex) - nearest edge/node index of G (built if None)
     
-    OUT: new_edge_list (list) - edges corresponding to each point in the dataset (if point is >10 meters away, returns None for that point)
-         new_node_list (list) - nodes corresponding to each point in the dataset (if point is >40 meters away, returns None for that point)
-         edges_and_vectors (dict) - contains two keys with ordered values that correspond to eachother: 
+    OUT: new_edge_list (list) - edges corresponding to each point in the dataset (if point is >edge max distance meters away, returns None for that point)
+         new_node_list (list) - nodes corresponding to each point in the dataset (if point is >node max distance meters away, returns None for that point)
+         edges_and_vectors (dict) - contains three keys with ordered values that correspond to eachother: 
                                         Edge that has a list of all the unique edges
-                                        Vector that has a list of the vector for each unique edge
+                                        Vector_x, Vector_y that have the x and y components of the vector of each unique edge
          unique_n (list) - unique nodes in new_nodes_list
          unique_n_dict (dict) - key values are individual nodes, with the edges that correspond to this node as the values
         
     '''
-    # use OSMNx to get the nearest graph edges for each lat/long point in the trajectory
-    edge_list = ox.distance.nearest_edges(G, 
-                                          longitude, 
-                                          latitude, 
-                                          interpolate=None, 
-                                          return_dist=True
-                                         )
-    
-    node_list = ox.distance.nearest_nodes(G, 
-                                          longitude,
-                                          latitude, 
-                                          return_dist=True
-                                         )
-    
-    # filter out edges and nodes that are too far away for a specific point
-    new_edge_list = exclude_edges_nodes(edge_list, 10)
-    new_node_list = exclude_edges_nodes(node_list, 40)
+    if index is None:
+        index = NearestIndex(G)
+
+    # get the nearest graph edge and node for each lat/long point in the trajectory (in one batch each),
+    # points that are too far away get None
+    new_edge_list = index.nearest_edges(latitude, longitude, max_dist=edge_max_dist)[0].tolist()
+    new_node_list = index.nearest_nodes(latitude, longitude, max_dist=node_max_dist)[0].tolist()
 
     # get unique edge and node lists
     unique_e = set(new_edge_list)
@@ -135,39 +171,34 @@ def assign_edges_nodes(G, latitude, longitude):
 
     # get the vector of each edge
     edges_and_vectors = {'Edge': [],
-                         'Vector': []}
+                         'Vector_x': [],
+                         'Vector_y': []}
 
     # get a list of all the edges for each node
     unique_n_dict = {value: [] for value in unique_n}
 
+    # get the location of the nodes of the edges
+    node_coords = get_node_coords(G, {x for e in unique_e if e is not None for x in e[:2]})
+
     for e in unique_e:
+        # points that are too far from every edge have no edge
+        if e is None:
+            continue
+
         # grab nodes for this edge
         u = e[0]
         v = e[1]
 
         # get the location of each node
-        try:
-            node_data = G.nodes[u]
-            u_x = node_data['x']
-            u_y = node_data['y']
-        except:
-            node_data = ox.geocoder.geocode_to_gdf(query=[f"N{u}"], by_osmid=True)
-            u_x = node_data.geometry.x.iloc[0]
-            u_y = node_data.geometry.y.iloc[0]
-        try:
-            node_data = G.nodes[v]
-            v_x = node_data['x']
-            v_y = node_data['y']
-        except:
-            node_data = ox.geocoder.geocode_to_gdf(query=[f"N{v}"], by_osmid=True)
-            v_x = node_data.geometry.x.iloc[0]
-            v_y = node_data.geometry.y.iloc[0]
-        
+        u_x, u_y = node_coords[u]
+        v_x, v_y = node_coords[v]
+
         # get the edge vector for this vector
         vector = get_vector(x1=u_x, y1=u_y, x2=v_x, y2=v_y)
 
         edges_and_vectors['Edge'].append(e)
-        edges_and_vectors['Vector'].append(vector)
+        edges_and_vectors['Vector_x'].append(vector[0])
+        edges_and_vectors['Vector_y'].append(vector[1])
 
         # add edge to the corresponding nodes
         try:
@@ -179,51 +210,229 @@ def assign_edges_nodes(G, latitude, longitude):
 
     return new_edge_list, new_node_list, edges_and_vectors, unique_n, unique_n_dict
 
-def compute_OSM_node_vals(x, vals_list):
-    if x is np.nan or str(x) == 'nan':
-        return None, None
-    else:
-        val_1 = nodes.loc[int(x)][vals_list[0]]
-        val_2 = nodes.loc[int(x)][vals_list[1]]
-        val_3 = unique_n_dict[x]
+def get_tiles(latitude, longitude, size):
+    '''
+    IN: latitude, longitude (numpy arrays) - coordinates of the points
+        size (float) - side of a tile in degrees
+
+    OUT: tiles (list) - row numbers of the points of each tile (that has points)
+    '''
+    if len(latitude) == 0:
+        return []
+
+    tile_lat = np.floor((latitude - latitude.min()) / size).astype(np.int64)
+    tile_long = np.floor((longitude - longitude.min()) / size).astype(np.int64)
+
+    tile_num = pd.factorize(pd.MultiIndex.from_arrays([tile_lat, tile_long]))[0]
+    order = np.argsort(tile_num, kind='stable')
+    splits = np.cumsum(np.bincount(tile_num))[:-1]
+
+    return np.split(order, splits)
+
+class TileGraphs:
+    '''
+    Cuts the graph of a tile out of the graph of all the points, so every tile has the same (u, v, key) edges:
+        G (ox graph) - simplified graph of all the points
+        edge_u, edge_v (numpy arrays) - nodes of each edge of G
+        edge_bounds (numpy array) - (min x, min y, max x, max y) of the geometry of each edge
+        nodes (numpy array) - OSM id of each node of G, in the order of G
+        node_xy (numpy array) - (x, y) of each node
+    '''
+
+    def __init__(self, G):
+        nodes, edges = ox.graph_to_gdfs(G)
+
+        self.G = G
+        self.edge_u = edges.index.get_level_values(0).to_numpy()
+        self.edge_v = edges.index.get_level_values(1).to_numpy()
+        self.edge_bounds = shapely.bounds(edges.geometry.to_numpy())
+        self.nodes = nodes.index.to_numpy()
+        self.node_xy = np.column_stack([nodes['x'].to_numpy(dtype=float), nodes['y'].to_numpy(dtype=float)])
+
+    def get_graph(self, latitude, longitude):
+        '''
+        Returns the sub-graph of G (a copy) with the edges and nodes in the bounding box of the points plus the tile overlap.
+        An edge is in the bounding box if its geometry's bounds are, so a long edge that crosses the tile is kept
+        even if its nodes are outside it. The nodes and edges keep their order in G, so the nearest edge of a point
+        (the first of the ties, like the two directions of a two-way road) is the same as in G
+        '''
+        n, s = latitude.max() + tile_overlap, latitude.min() - tile_overlap
+        e, w = longitude.max() + tile_overlap, longitude.min() - tile_overlap
+
+        b = self.edge_bounds
+        in_bbox = (b[:, 0] <= e) & (b[:, 2] >= w) & (b[:, 1] <= n) & (b[:, 3] >= s)
+        x, y = self.node_xy[:, 0], self.node_xy[:, 1]
+        node_in_bbox = (x >= w) & (x <= e) & (y >= s) & (y <= n)
+
+        keep = node_in_bbox | np.isin(self.nodes, np.concatenate([self.edge_u[in_bbox], self.edge_v[in_bbox]]))
+        tile_nodes = self.nodes[keep].tolist()
+        node_set = set(tile_nodes)
+
+        # a copy, so only the tile (not all of G) is sent to a worker
+        H = self.G.__class__(**self.G.graph)
+        H.add_nodes_from((x, self.G.nodes[x]) for x in tile_nodes)
+        H.add_edges_from((u, v, k, d) for u in tile_nodes for v, kd in self.G.adj[u].items() if v in node_set for k, d in kd.items())
+
+        return H
+
+def match_points(G, latitude, longitude):
+    '''
+    IN: G (ox graph) - graph of the points
+        latitude, longitude (numpy arrays) - coordinates of the points
+
+    OUT: e (list) - (u, v, key) edge of each point (None if it's too far from every edge)
+         n (list) - node of each point (None if it's too far from every node)
+         unique_n_df (pandas DataFrame) - OSM values of the nodes of the points (and their edges)
+         unique_e_df (pandas DataFrame) - edge, vector and OSM values of the edges of the points
+    '''
+    # tiles without roads have no edge/node for any point
+    if len(G.edges) == 0:
+        unique_n_df = pd.DataFrame(columns=['Node'] + osm_node_new_cols[:2] + node_coords + [osm_node_new_cols[2]])
+        unique_e_df = pd.DataFrame(columns=['Edge', 'Vector_x', 'Vector_y'] + osm_edge_new_cols + [edge_geometry])
+        return [None] * len(latitude), [None] * len(latitude), unique_n_df, unique_e_df
+
+    # get edges, nodes for each point
+    e, n, edges_vectors, unique_n, unique_n_dict = assign_edges_nodes(G, latitude, longitude)
+
+    # get the OSM node and edge features you want for each edge (tags that no node/edge of the graph has are empty)
+    nodes, edges = ox.graph_to_gdfs(G)
+    node_vals = nodes.reindex(columns=osm_node_cols + ['x', 'y']).set_axis(osm_node_new_cols[:2] + node_coords, axis=1)
+    edge_vals = edges.reindex(columns=osm_edge_cols + ['geometry']).set_axis(osm_edge_new_cols + [edge_geometry], axis=1)
+
+    # join the OSM values to the nodes (by osmid) and to the edges (by u, v, key) of the points
+    unique_n_df = pd.DataFrame({'Node': [x for x in unique_n if x is not None]})
+    unique_n_df = unique_n_df.join(node_vals, on='Node')
+    unique_n_df[osm_node_new_cols[2]] = unique_n_df['Node'].map(unique_n_dict)
+
+    unique_e_df = pd.DataFrame(edges_vectors, columns=['Edge', 'Vector_x', 'Vector_y'])
+    unique_e_df.index = pd.MultiIndex.from_tuples(unique_e_df['Edge'], names=edge_vals.index.names)
+    unique_e_df = unique_e_df.join(edge_vals).reset_index(drop=True)
+    unique_e_df[edge_geometry] = [list(g.coords) for g in unique_e_df[edge_geometry]]
+
+    return e, n, unique_n_df, unique_e_df
+
+def match_tile(tile):
+    '''
+    Runs match_points on the graph and the (latitude, longitude) of the points of a tile, in a worker process
+    '''
+    G, latitude, longitude = tile
+
+    return match_points(G, latitude, longitude)
+
+def match_tiles(tiles, workers):
+    '''
+    IN: tiles (iterable) - (graph, latitude, longitude) of each tile
+        workers (int) - number of worker processes
+
+    OUT: results (list) - match_tile of each tile, in order
+
+    At most two tiles per worker are waiting at a time, so only their graphs are copied to the workers at once
+    '''
+    if workers <= 1:
+        return [match_tile(tile) for tile in tiles]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for tile in tiles:
+            pending.append(executor.submit(match_tile, tile))
+            if len(pending) >= 2 * workers:
+                results.append(pending.popleft().result())
+        results += [f.result() for f in pending]
 
-        return val_1, val_2, val_3
-   
-def compute_OSM_edge_vals(x, vals_list):
-    vals = edges.loc[x][vals_list]
-    return vals
+    return results
+
+def get_node_edges(nodes, edges):
+    '''
+    Returns the edges (of the points of every tile) that start or end at each node, like unique_n_dict of assign_edges_nodes
+    '''
+    node_edges = {x: [] for x in nodes}
+    for e in edges:
+        for x in set(e[:2]):
+            if x in node_edges:
+                node_edges[x].append(e)
+
+    return [node_edges[x] for x in nodes]
 
 ########################################## MAIN ##########################################
-# grab latitude/longitude columns
-lat_col = df[latitude]
-long_col = df[longitude]
+def get_match_graph(lat_min, lat_max, long_min, long_max):
+    '''
+    Returns the TileGraphs of the simplified graph of the bounding box of the points plus the tile overlap
+    '''
+    G = get_graph_from_bb([lat_min - tile_overlap, lat_max + tile_overlap],
+                          [long_min - tile_overlap, long_max + tile_overlap], network_type=network_type)
+
+    return TileGraphs(G)
+
+def map_match(df, tile_graphs=None):
+    '''
+    IN: df (pandas DataFrame) - trajectory points with their metadata
+        tile_graphs (TileGraphs) - graph that covers all the points (built from the bounding box of the points if None),
+                                   so the shards of a file can share one graph
+
+    OUT: df (pandas DataFrame) - trajectory points with their edge (edge id) and node
+         unique_n_df (pandas DataFrame) - OSM values of the matched nodes (and their edge ids)
+         unique_e_df (pandas DataFrame) - edge id, u, v, key, vector and OSM values of the matched edges
+    '''
+    # grab latitude/longitude columns
+    lat_col = df[latitude].to_numpy(dtype=float)
+    long_col = df[longitude].to_numpy(dtype=float)
+
+    # simplified graph of all the points (plus the overlap), so the edges are the same in every tile
+    if tile_graphs is None:
+        tile_graphs = get_match_graph(lat_col.min(), lat_col.max(), long_col.min(), long_col.max())
+
+    # split the points into tiles
+    tiles = get_tiles(lat_col, long_col, tile_size)
+    workers = min(len(tiles), n_workers or os.cpu_count() or 1)
+    print(f'Matching {len(df)} points in {len(tiles)} tiles with {workers} workers')
+
+    # each tile is matched against its own sub-graph (cut when the tile is sent to a worker)
+    tile_inputs = ((tile_graphs.get_graph(lat_col[rows], long_col[rows]), lat_col[rows], long_col[rows]) for rows in tiles)
+    results = match_tiles(tile_inputs, workers)
+    print('Finished getting edge and node information')
+
+    # put the edges and nodes of the points back in the original order
+    e = np.empty(len(df), dtype=object)
+    n = np.empty(len(df), dtype=object)
+    for rows, (tile_e, tile_n, _, _) in zip(tiles, results):
+        e[rows] = pd.Series(tile_e, dtype=object).to_numpy()
+        n[rows] = pd.Series(tile_n, dtype=object).to_numpy()
+
+    # combine the OSM values of the edges and nodes of the tiles (tiles without edges/nodes would change the dtypes)
+    n_dfs = [r[2] for r in results if len(r[2])] or [results[0][2]]
+    e_dfs = [r[3] for r in results if len(r[3])] or [results[0][3]]
+    unique_e_df = pd.concat(e_dfs, ignore_index=True).drop_duplicates(subset=['Edge']).reset_index(drop=True)
+    unique_n_df = pd.concat(n_dfs, ignore_index=True).drop_duplicates(subset=['Node']).reset_index(drop=True)
+    unique_n_df[osm_node_new_cols[2]] = get_node_edges(unique_n_df['Node'], unique_e_df['Edge'])
+
+    unique_n_df['Node'] = unique_n_df['Node'].astype(int)
 
-# get osmnx graph segment that corresponds
-print('Getting Graph from bounding box')
-G = get_graph_from_bb(lat_col, long_col, network_type=network_type, verbose=True)
+    # give every edge a compact integer id, and keep its (u, v, key) as int64 columns
+    edge_id_df = get_edge_id_map(unique_e_df['Edge'])
+    unique_e_df = pd.concat([edge_id_df, unique_e_df.drop(columns=['Edge']).reset_index(drop=True)], axis=1)
 
-# get edges, nodes for each point
-e, n, edges_vectors, unique_n, unique_n_dict = assign_edges_nodes(G, lat_col, long_col)
-print('Finished getting edge and node information')
+    # save the edges of each node as edge ids
+    edge_ids = dict(zip(edge_id_df[edge_keys].itertuples(index=False, name=None), edge_id_df[edge]))
+    unique_n_df[osm_node_new_cols[2]] = [[edge_ids[x] for x in l] for l in unique_n_df[osm_node_new_cols[2]]]
 
-# get the OSM node and edge features you want for each edge
-nodes, edges = ox.graph_to_gdfs(G)
+    # add edges (edge ids), nodes to df
+    df[edge] = get_edge_ids(e, edge_id_df)
+    df[node] = pd.array(n, dtype='Int64')
 
-unique_n_df = pd.DataFrame(unique_n, columns=['Node']).dropna(subset=['Node'])
-unique_e_df = pd.DataFrame(edges_vectors, columns=['Edge', 'Vector']).dropna(subset=['Edge'])
+    return df, unique_n_df, unique_e_df
 
-print('Starting to get the OSM node values for each edge and node')
-unique_n_df[osm_node_new_cols] = unique_n_df['Node'].apply(lambda x: pd.Series(compute_OSM_node_vals(x, osm_node_cols)))
-unique_e_df[osm_edge_new_cols] = unique_e_df['Edge'].apply(lambda x: pd.Series(compute_OSM_edge_vals(x, osm_edge_cols)))
+def main():
+    # load in trajectory df
+    df = read_table(os.path.join(processed_dir, trajectory_w_metadata_file_name))
 
-unique_n_df['Node'] = unique_n_df['Node'].astype(int)
+    df, unique_n_df, unique_e_df = map_match(df)
 
-# add edges, nodes to df
-df[edge] = e
-df[node] = n
+    # save df to processed data
+    save_table(df, os.path.join(processed_dir, out_file_name))
 
-# save df to processed data
-df.to_csv(os.path.join(processed_dir, out_file_name), index=False)
+    save_table(unique_n_df, os.path.join(processed_dir, osm_node_info_file), nested_types={osm_node_new_cols[2]: edge_list_type})
+    save_table(unique_e_df, os.path.join(processed_dir, osm_edge_info_file), nested_types={edge_geometry: coords_type})
 
-unique_n_df.to_csv(os.path.join(processed_dir, osm_node_info_file), index=False)
-unique_e_df.to_csv(os.path.join(processed_dir, osm_edge_info_file), index=False)
+if __name__ == '__main__':
+    main()
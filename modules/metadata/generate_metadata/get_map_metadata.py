@@ -9,22 +9,36 @@ DESCRIPTION: Given datasets with the following information:
              Compute metadata (speed statistics, driving (oneways) and turn directions, road and intersection flows)
              for each of the edges and nodes.
 
+             Besides the metadata tables, the mergeable state of the functional metadata of each (edge/node, time bin) is saved
+             (counts, sums, sums of squared deviations, min/max, quantile sketches and flow counts). Running with --update
+             folds a new batch of trajectory segments into the saved state and recomputes only the edges and nodes the
+             batch touches, instead of recomputing the metadata of the full history:
+                python get_map_metadata.py --update
+
+             The box plots are computed from mergeable quantile sketches (sketch.py), so the state of an edge/node does not
+             grow with its number of trajectory segments.
+
              Imports functions from utils.py
 
 Author: Ana Uribe
 '''
 ########################################## IMPORTS ##########################################
+import argparse
 import json
 import numpy as np
 import pandas as pd
 import os
 import ast
 
-from collections import Counter
-from scipy.stats import t
+from utils import calc_confidence_intervals
+from edge_index import align_edge_ids
+from sketch import QuantileSketch
+from storage import save_table, read_table, export_csv, ci_type, boxplot_type, edge_flow_type, node_flow_type, edge_list_type, coords_type, sketch_type
+from snapshot import publish_snapshot
 
 ########################################## VARIABLES ##########################################
-constants_path = '/Users/bean/Documents/masters-project/map-metadata/constants.json'
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.json'))
 
 ########################################## LOAD IN DATA ##########################################
 # dictionary with constants
@@ -50,10 +64,15 @@ n_s = constants_dict['map metadata out']['node structural']
 n_f = constants_dict['map metadata out']['node functional']
 e_s = constants_dict['map metadata out']['edge structural']
 e_f = constants_dict['map metadata out']['edge functional']
+n_state = constants_dict['map metadata state']['node state']
+e_state = constants_dict['map metadata state']['edge state']
+csv_export = constants_dict['csv export']
+snapshot_versions = constants_dict['snapshot versions']
 
 # metadata column names
 time_bin = constants_dict['metadata cols']['time bin']
 edge = constants_dict['metadata cols']['edge']
+edge_keys = constants_dict['metadata cols']['edge keys']
 node = constants_dict['metadata cols']['node']
 avg_speed = constants_dict['metadata cols']['avg speed']
 max_speed = constants_dict['metadata cols']['max speed']
@@ -64,234 +83,500 @@ flow = constants_dict['metadata cols']['flow']
 avg_speed_ci = constants_dict['metadata cols']['avg speed CI']
 travel_time_ci = constants_dict['metadata cols']['travel time CI']
 traj_count = constants_dict['metadata cols']['count']
+compass_dir = constants_dict['metadata cols']['compass directions']
+osm_node_new_cols = constants_dict['metadata cols']['OSM node new col names']
+edge_geometry = constants_dict['metadata cols']['edge geometry']
+
+# types of the nested columns
+f_types = {avg_speed_ci: ci_type, travel_time_ci: ci_type, 'Boxplot_speed': boxplot_type, 'Boxplot_time': boxplot_type}
+e_f_types = {**f_types, flow: edge_flow_type}
+n_f_types = {**f_types, flow: node_flow_type}
+n_s_types = {osm_node_new_cols[2]: edge_list_type}
+e_s_types = {edge_geometry: coords_type}
+state_types = {f'{avg_speed}_sketch': sketch_type, f'{travel_time}_sketch': sketch_type}
+e_state_types = {**state_types, flow: edge_flow_type}
+n_state_types = {**state_types, flow: node_flow_type}
 
-
-# load files as pandas dataframes
-n_df = pd.read_csv(os.path.join(processed_dir, n_file_name))
-e_df = pd.read_csv(os.path.join(processed_dir, e_file_name))
-
-osm_n_df = pd.read_csv(os.path.join(processed_dir, osm_n_file))
-osm_e_df = pd.read_csv(os.path.join(processed_dir, osm_e_file))
-osm_e_df = osm_e_df[['Edge','OSM_oneway','OSM_lanes','OSM_name','OSM_highway','OSM_maxspeed','OSM_length']]# don't need to save vector
 ########################################## HELPER FUNCTIONS ##########################################
-def compute_oneway(x):
-   set_x = set(x)
-   if set_x == {np.NaN}:
+def compute_oneway(fl):
+   '''
+   Returns whether an edge is a oneway given the counts (dict) of the compass directions of its trajectory segments:
+   None if there are no compass directions, False if there are positive and negative ones, True otherwise
+   '''
+   if not fl:
       return None
-   elif '-' in set_x and '+' in set_x:
+   elif '-' in fl and '+' in fl:
       return False
    else:
       return True
    
-def compute_street_count(x):
-   set_x = set(x)
-   return len(set_x)
+def compute_street_count(fl, count):
+   '''
+   Returns the number of different edges (compass directions) of the trajectory segments of a node given their counts (dict)
+   and the number of trajectory segments (the segments without an edge count as one more value, like NaN did)
+   '''
+   return len(fl) + int(count > sum(fl.values()))
    
-def calc_confidence_interval(data, alpha=0.05):
+def get_ci_cols(n, mean, var, alpha=0.05):
+   '''
+   IN: n, mean, var (numpy arrays) - number of values, mean and variance (ddof=1) of each group
 
-    k = len(data)
-    df = k - 1
+   OUT: c_i (numpy array) - (lower bound, upper bound) tuple of the t-distribution confidence interval of each group,
+                            NaN for groups with less than two values
+   '''
+   lower_bound, upper_bound = calc_confidence_intervals(n, mean, var, alpha)
+   has_ci = n > 1
 
-    confidence_level = 1 - alpha
+   c_i = np.full(len(n), np.nan, dtype=object)
+   for i, lb, ub in zip(np.flatnonzero(has_ci), lower_bound[has_ci].tolist(), upper_bound[has_ci].tolist()):
+      c_i[i] = (lb, ub)
 
-    X_bar = np.mean(data)
-    s = np.std(data, ddof=1)  # TODO: check ddof
+   return c_i
 
+def group_lists(values, row_num, n_rows):
+   '''
+   Returns a list with the values (in order) that belong to each row number in range(n_rows)
+   '''
+   order = np.argsort(row_num, kind='stable')
+   splits = np.cumsum(np.bincount(row_num, minlength=n_rows))[:-1]
 
-    t_score = t.ppf((1 + confidence_level) / 2, df)
+   return [l.tolist() for l in np.split(values[order], splits)]
 
-    standard_error = s / np.sqrt(k)
-    margin_of_error = t_score * standard_error
+def get_flow_col(s, row_num, n_rows):
+   '''
+   Returns the counts (dict) of each value of s (compass direction of the trajectory segments) for each row,
+   in the order the values first appear
+   '''
+   has_val = s.notna().to_numpy()
+   # tolist keeps edge ids (node case) as ints
+   counts = pd.DataFrame({'row': row_num[has_val], 'val': s[has_val].tolist()}).groupby(['row', 'val'], sort=False).size()
 
-    lower_bound = round(X_bar - margin_of_error, 2)
-    upper_bound = round(X_bar + margin_of_error, 2)
+   fl = [{} for _ in range(n_rows)]
+   for (r, v), c in counts.items():
+      fl[r][v] = c
 
-    c_i = (lower_bound, upper_bound)
-    
-    return c_i, X_bar
+   return fl
 
-def get_functional_row(s):
-   # get flow
-   fl = Counter(s['Compass_dir'])
-   key_to_delete = np.NaN
-   try:
-      del fl[key_to_delete]
-   except:
-      pass
+def merge_counts(fls):
+   '''
+   Merges count dicts (flows), keeping the order in which the keys first appear
+   '''
+   merged = {}
+   for fl in fls:
+      for k, c in fl.items():
+         merged[k] = merged.get(k, 0) + c
 
-   # get box plot for speed
-   # Convert to pandas Series
-   data_series = pd.Series(s[avg_speed].dropna())
+   return merged
 
-   # Calculate summary statistics
-   if data_series.empty or len(data_series) < 4:  # at least 4 data points needed to calculate quartiles:
-      summary_stats = {'points': list(s[avg_speed].dropna())}
-   else:
-      summary_stats = {
-         'whislo': data_series.min(),
-         'q1': data_series.quantile(0.25),
-         'med': data_series.median(),
-         'q3': data_series.quantile(0.75),
-         'whishi': data_series.max(),
-         'fliers': list(data_series[(data_series < data_series.quantile(0.25) - 1.5 * (data_series.quantile(0.75) - data_series.quantile(0.25))) | 
-                                 (data_series > data_series.quantile(0.75) + 1.5 * (data_series.quantile(0.75) - data_series.quantile(0.25)))])
-      }
-   
-   # get box plot for time
-   # Convert to pandas Series
-   data_series = pd.Series(s[travel_time].dropna())
-   # print(data_series)
-   # Calculate summary statistics
-   if data_series.empty or len(data_series) < 4:  # at least 4 data points needed to calculate quartiles:
-      summary_stats_t = {'points': list(s[travel_time].dropna())}
-   else:
-      summary_stats_t = {
-         'whislo': data_series.min(),
-         'q1': data_series.quantile(0.25),
-         'med': data_series.median(),
-         'q3': data_series.quantile(0.75),
-         'whishi': data_series.max(),
-         'fliers': list(data_series[(data_series < data_series.quantile(0.25) - 1.5 * (data_series.quantile(0.75) - data_series.quantile(0.25))) | 
-                                 (data_series > data_series.quantile(0.75) + 1.5 * (data_series.quantile(0.75) - data_series.quantile(0.25)))])
-      }
-
-   # get average speed vales
-   a_s_col = s[avg_speed]
-   a_s_no_nan = a_s_col.dropna()
-   if len(a_s_no_nan) == 0:
-      avg_ci = np.NAN
-      avg_s = np.NAN
-   elif len(a_s_no_nan) == 1:
-      avg_ci = np.NAN
-      avg_s = int(round(a_s_no_nan.item()))
-   else:
-      avg_ci, avg_s = calc_confidence_interval(a_s_no_nan)
-      avg_s = int(round(avg_s))
-
-   # get travel time values
-   tt_col = s[travel_time]
-   tt_no_nan = tt_col.dropna()
-   if len(tt_no_nan) == 0:
-      travel_t_ci = np.NAN
-      travel_t = np.NAN
-   elif len(tt_no_nan) == 1:
-      travel_t_ci = np.NAN
-      travel_t = round(tt_no_nan.item(), 4)
-   else:
-      travel_t_ci, travel_t = calc_confidence_interval(tt_no_nan)
-      round(travel_t, 4)
-
-   # get max speed values
-   max_no_nan = s[max_speed].dropna()
-   min_no_nan = s[min_speed].dropna()
-   if len(max_no_nan) == 0:
-      max_s = np.NAN
-   elif len(max_no_nan) == 1:
-      max_s = max_no_nan.item()
-   else:
-      max_s = int(round(max(max_no_nan)))
-    
-   # get min speed values
-   min_no_nan = s[min_speed].dropna()
-   if len(min_no_nan) == 0:
-      min_s = np.NAN
-   elif len(min_no_nan) == 1:
-      min_s = min_no_nan.item()
-   else:
-      min_s = int(round(min(min_no_nan)))
+def get_stat_state(values, row_num, n_rows, col):
+   '''
+   IN: values (numpy array) - values (no NaN) of the trajectory segments
+       row_num (numpy array) - state row each value belongs to
+       n_rows (int) - number of state rows
+       col (str) - name of the values column
 
-   return avg_s, avg_ci, max_s, min_s, travel_t, travel_t_ci, dict(fl), summary_stats, summary_stats_t
+   OUT: state (dict) - state columns of the values: number (_n), sum (_sum), sum of squared deviations from the mean (_ss),
+                       min (_min), max (_max) and the quantile sketch of the values (_sketch, state of the box plots)
+   '''
+   n = np.bincount(row_num, minlength=n_rows)
+   total = np.bincount(row_num, weights=values, minlength=n_rows)
+   with np.errstate(divide='ignore', invalid='ignore'):
+      mean = total / n
+   ss = np.bincount(row_num, weights=(values - mean[row_num]) ** 2, minlength=n_rows)
+
+   min_max = pd.Series(values).groupby(row_num).agg(['min', 'max']).reindex(range(n_rows))
+
+   return {f'{col}_n': n,
+           f'{col}_sum': total,
+           f'{col}_ss': ss,
+           f'{col}_min': min_max['min'].to_numpy(),
+           f'{col}_max': min_max['max'].to_numpy(),
+           f'{col}_sketch': [QuantileSketch.from_values(l) for l in group_lists(values, row_num, n_rows)],
+          }
+
+def get_state_df(df, val):
+   '''
+   IN: df (pandas DataFrame) - trajectory segments
+       val (str) - edge or node column name
+
+   OUT: state_df (pandas DataFrame) - mergeable state of the functional metadata of each (edge/node, time bin) with trajectory segments:
+                                         Count - number of trajectory segments
+                                         Avg_speed_*, Travel_time_* - state of the values (see get_stat_state)
+                                         Max_speed_n, Max_speed_max - number of max speeds and their max
+                                         Min_speed_n, Min_speed_min - number of min speeds and their min
+                                         Flow - counts of the compass directions
+   '''
+   v_df = df[df[val].notna()]
 
-def get_functional_metadata(df, val):
+   # one state row for each (edge/node, time bin) pair
+   counts = v_df.groupby([val, time_bin], sort=True).size()
+   state_index = counts.index
+   n_rows = len(state_index)
+   row_num = state_index.get_indexer(pd.MultiIndex.from_arrays([v_df[val], v_df[time_bin]]))
+
+   state = {val: state_index.get_level_values(0), time_bin: state_index.get_level_values(1), traj_count: counts.to_numpy()}
+
+   for c in [avg_speed, travel_time]:
+      has_val = v_df[c].notna().to_numpy()
+      state.update(get_stat_state(v_df[c].to_numpy(dtype=float)[has_val], row_num[has_val], n_rows, c))
+
+   for c, agg in [(max_speed, 'max'), (min_speed, 'min')]:
+      stats = v_df[c].groupby(row_num).agg(['count', agg]).reindex(range(n_rows))
+      state[f'{c}_n'] = stats['count'].fillna(0).to_numpy(dtype=int)
+      state[f'{c}_{agg}'] = stats[agg].to_numpy()
+
+   state[flow] = get_flow_col(v_df[compass_dir], row_num, n_rows)
+
+   return pd.DataFrame(state)
+
+def merge_states(state_df, keys):
+   '''
+   Merges the state rows of state_df that have the same keys (the states of two batches, or all the time bins of an edge/node),
+   returns one state row for each key, sorted by key
+   '''
+   state_df = state_df.reset_index(drop=True)
+   g = state_df.groupby(keys, sort=True)
+
+   merged = g[[traj_count, f'{max_speed}_n', f'{min_speed}_n']].sum()
+   merged[f'{max_speed}_max'] = g[f'{max_speed}_max'].max()
+   merged[f'{min_speed}_min'] = g[f'{min_speed}_min'].min()
+
+   for c in [avg_speed, travel_time]:
+      n, total = state_df[f'{c}_n'], state_df[f'{c}_sum']
+      merged[f'{c}_n'] = g[f'{c}_n'].sum()
+      merged[f'{c}_sum'] = g[f'{c}_sum'].sum()
+
+      # sum of squared deviations: each part's own plus its count times the squared distance of its mean to the merged mean
+      with np.errstate(divide='ignore', invalid='ignore'):
+         dev = np.where(n > 0, n * (total / n - g[f'{c}_sum'].transform('sum') / g[f'{c}_n'].transform('sum')) ** 2, 0)
+      merged[f'{c}_ss'] = (state_df[f'{c}_ss'] + dev).groupby([state_df[k] for k in keys], sort=True).sum().to_numpy()
+
+      merged[f'{c}_min'] = g[f'{c}_min'].min()
+      merged[f'{c}_max'] = g[f'{c}_max'].max()
+      merged[f'{c}_sketch'] = g[f'{c}_sketch'].agg(QuantileSketch.merge_all)
+
+   merged[flow] = g[flow].agg(merge_counts)
+
+   # merging over the edges/nodes only drops the time bins
+   merged = merged.reset_index()
+   return merged[[c for c in state_df.columns if c in merged.columns]]
+
+def get_state_table(state_df):
+   '''
+   Returns state_df with its quantile sketches as dicts, to save it
+   '''
+   return state_df.assign(**{f'{c}_sketch': state_df[f'{c}_sketch'].map(QuantileSketch.to_dict) for c in [avg_speed, travel_time]})
+
+def read_state(path):
+   '''
+   Reads a saved state with its quantile sketches as QuantileSketch objects
+   (states saved with the values of the trajectory segments instead of sketches are converted)
+   '''
+   state_df = read_table(path)
+
+   for c in [avg_speed, travel_time]:
+      if f'{c}_values' in state_df.columns:
+         state_df = state_df.rename(columns={f'{c}_values': f'{c}_sketch'})
+         state_df[f'{c}_sketch'] = state_df[f'{c}_sketch'].map(QuantileSketch.from_values)
+      else:
+         state_df[f'{c}_sketch'] = state_df[f'{c}_sketch'].map(QuantileSketch.from_dict)
+
+   return state_df
+
+def concat_states(state_dfs):
+   '''
+   Concatenates state dfs, skipping the empty ones (so they don't change the dtypes of the columns)
+   '''
+   non_empty = [d for d in state_dfs if len(d)]
+
+   return pd.concat(non_empty, ignore_index=True) if non_empty else state_dfs[0].iloc[:0]
 
+def get_empty_states(index, columns):
+   '''
+   Returns state rows without trajectory segments for the (edge/node, time bin) pairs in index
+   '''
+   empty = pd.DataFrame(index=index, columns=[c for c in columns if c not in index.names]).reset_index()
+   for c in empty.columns:
+      if c == flow:
+         empty[c] = [{} for _ in range(len(empty))]
+      elif c.endswith('_sketch'):
+         empty[c] = [QuantileSketch() for _ in range(len(empty))]
+      elif c == traj_count or c.endswith('_n'):
+         empty[c] = 0
+      elif c not in index.names:
+         empty[c] = np.nan
+
+   return empty[columns]
+
+def get_functional_df(state_df, val):
+   '''
+   Derives the functional metadata of every edge/node from the merged (edge/node, time bin) states.
+   Edges/nodes with less than 7 trajectory segments get one row computed with all their segments regardless of time bin (time bin 3),
+   the rest get one row for each time bin, empty time bins included.
+   '''
    # define columns
    cols = [val, time_bin, avg_speed, avg_speed_ci, max_speed, min_speed, travel_time, travel_time_ci, flow, 'Boxplot_speed', 'Boxplot_time', traj_count]
-   # list to append new rows
-   rows = []
    # define time bins (for functional vals)
-   unique_time_bins = [-1, 1, 0, 2]
-   # get unique values
-   unique_vals = np.unique(df[val].dropna())
-
-   # for every unique val (edge/node)
-   for v in unique_vals:
-      # create subset df
-      v_df = df[df[val] == v]
-      # check size of df
-      if len(v_df) < 7:
-         # compute all trajectories together regardless of time bin
-         avg_s, avg_ci, max_s, min_s, travel_t, travel_t_ci, fl, boxplot_stats, boxplot_stats_t = get_functional_row(v_df)
-         new_row = [v, 3, avg_s, avg_ci, max_s, min_s, travel_t, travel_t_ci, fl, boxplot_stats, boxplot_stats_t, len(v_df)]
-         rows.append(new_row)
-      else:
-         # make a row for each time bin
-         for b in unique_time_bins:
-            # create subset df
-            b_df = v_df[v_df[time_bin] == b]
-            avg_s, avg_ci, max_s, min_s, travel_t, travel_t_ci, fl, boxplot_stats, boxplot_stats_t = get_functional_row(b_df)
-            new_row = [v, b, avg_s, avg_ci, max_s, min_s, travel_t, travel_t_ci, fl, boxplot_stats, boxplot_stats_t, len(b_df)]
-            rows.append(new_row)
-
-   functional_df = pd.DataFrame(rows, columns=cols)
+   unique_time_bins = np.array([-1, 1, 0, 2])
+
+   # rows of the functional df: (v, 3) for small edges/nodes, (v, b) for each time bin b for the rest
+   v_counts = state_df.groupby(val)[traj_count].sum()
+   small = state_df[val].isin(v_counts.index[v_counts < 7]).to_numpy()
+   small_state = merge_states(state_df[small].assign(**{time_bin: 3}), [val, time_bin])
+
+   big_v = v_counts.index[v_counts >= 7]
+   big_index = pd.MultiIndex.from_arrays([np.repeat(big_v, len(unique_time_bins)), np.tile(unique_time_bins, len(big_v))], names=[val, time_bin])
+   big_state = state_df[~small].set_index([val, time_bin])
+   empty_state = get_empty_states(big_index.difference(big_state.index), list(state_df.columns))
+   big_state = concat_states([big_state.reset_index(), empty_state]).set_index([val, time_bin]).loc[big_index].reset_index()
+
+   # edges/nodes in order, time bins in the order above
+   rows = concat_states([small_state, big_state])
+   bin_order = pd.Series(np.arange(len(unique_time_bins)), index=unique_time_bins).reindex(rows[time_bin]).fillna(0).to_numpy()
+   rows = rows.iloc[np.lexsort([bin_order, rows[val].to_numpy()])].reset_index(drop=True)
+   n_rows = len(rows)
+
+   # get average speed and travel time values from the states
+   with np.errstate(divide='ignore', invalid='ignore'):
+      a_s_n = rows[f'{avg_speed}_n'].to_numpy(dtype=int)
+      a_s_mean = rows[f'{avg_speed}_sum'].to_numpy(dtype=float) / a_s_n
+      a_s_var = np.where(a_s_n > 1, rows[f'{avg_speed}_ss'].to_numpy(dtype=float) / (a_s_n - 1), np.nan)
+
+      tt_n = rows[f'{travel_time}_n'].to_numpy(dtype=int)
+      tt_mean = rows[f'{travel_time}_sum'].to_numpy(dtype=float) / tt_n
+      tt_var = np.where(tt_n > 1, rows[f'{travel_time}_ss'].to_numpy(dtype=float) / (tt_n - 1), np.nan)
+
+   avg_s = np.round(a_s_mean)
+   avg_ci = get_ci_cols(a_s_n, a_s_mean, a_s_var)
+
+   travel_t = np.where(tt_n == 1, np.round(tt_mean, 4), tt_mean)
+   travel_t_ci = get_ci_cols(tt_n, tt_mean, tt_var)
+
+   # get box plots from the quantile sketches of each row
+   boxplot_stats = [s.boxplot() for s in rows[f'{avg_speed}_sketch']]
+   boxplot_stats_t = [s.boxplot() for s in rows[f'{travel_time}_sketch']]
+
+   # get max and min speed values
+   max_n, min_n = rows[f'{max_speed}_n'].to_numpy(), rows[f'{min_speed}_n'].to_numpy()
+   max_s = np.where(max_n == 1, rows[f'{max_speed}_max'], np.round(rows[f'{max_speed}_max']))
+   min_s = np.where(min_n == 1, rows[f'{min_speed}_min'], np.round(rows[f'{min_speed}_min']))
+
+   functional_df = pd.DataFrame({cols[0]: rows[val],
+                                 cols[1]: rows[time_bin].to_numpy(dtype=int),
+                                 cols[2]: avg_s,
+                                 cols[3]: avg_ci,
+                                 cols[4]: max_s,
+                                 cols[5]: min_s,
+                                 cols[6]: travel_t,
+                                 cols[7]: travel_t_ci,
+                                 cols[8]: rows[flow],
+                                 cols[9]: boxplot_stats,
+                                 cols[10]: boxplot_stats_t,
+                                 cols[11]: rows[traj_count].to_numpy(dtype=int),
+                                })
    return functional_df
 
-def get_edge_metadata(df, val):
+def get_functional_metadata(df, val):
+   '''
+   Returns the functional metadata of every edge/node (see get_functional_df) and the (edge/node, time bin) states it was derived from
+   '''
+   state_df = get_state_df(df, val)
+
+   return get_functional_df(state_df, val), state_df
+
+def add_edge_structural(osm_e_df, state_df, val):
+   '''
+   Adds the computed structural metadata (oneway, number of trajectory segments) of each edge to the OSM edge information
+   '''
+   totals = merge_states(state_df, [val]).set_index(val)
+
+   osm_e_df['Oneway'] = osm_e_df[val].map(totals[flow].map(compute_oneway))
+   osm_e_df[traj_count] = osm_e_df[val].map(totals[traj_count]).astype('Int64')
+
+   return osm_e_df
+
+def add_node_structural(osm_n_df, state_df, val):
+   '''
+   Adds the computed structural metadata (street count, number of trajectory segments) of each node to the OSM node information
+   '''
+   totals = merge_states(state_df, [val]).set_index(val)
+   street_count = pd.Series([compute_street_count(fl, c) for fl, c in zip(totals[flow], totals[traj_count])], index=totals.index)
+
+   osm_n_df['Street_count'] = osm_n_df[val].map(street_count).fillna(0).astype(int)
+   osm_n_df[traj_count] = osm_n_df[val].map(totals[traj_count]).fillna(0).astype(int)
+
+   return osm_n_df
+
+def get_edge_metadata(df, val, osm_e_df):
    '''
    Using the saved osm information as well as the trajectory segment information, 
-   return the edge structural and functional data:
-      structural - Edge,Vector,     Oneway,Trajectory_count,      OSM_oneway,OSM_lanes,OSM_name,OSM_highway,OSM_maxspeed,OSM_length,
+   return the edge structural and functional data, and the edge states:
+      structural - Edge,u,v,key,      OSM_oneway,OSM_lanes,OSM_name,OSM_highway,OSM_maxspeed,OSM_length,Geometry,      Oneway,Count
       functional - Edge, speed, speed CI, box_plots info, travel_time, CIs, trajectory_count
    '''
-   ### Compute functional metadata
-   e_f_df = get_functional_metadata(df, val)
+   e_f_df, e_state_df = get_functional_metadata(df, val)
+   e_s_df = add_edge_structural(osm_e_df, e_state_df, val)
 
-   ### Compute structural metadata
-   # compute oneway and total num of trajectories columns
-   oneway_col = df.groupby(val).agg({'Compass_dir': [compute_oneway]})
-   num_traj_col = e_f_df.groupby(val).agg({traj_count: ['sum']})
-   
-   def grab_s_data(x):
-      oneway = oneway_col.xs(x).item()
-      t_count = num_traj_col.xs(x).item()
+   return e_s_df, e_f_df, e_state_df
 
-      return oneway, t_count
-   
-   osm_e_df[['Oneway', traj_count]] = osm_e_df[val].apply(lambda x: pd.Series(grab_s_data(x)))
-   
-   return osm_e_df, e_f_df
+def get_node_metadata(df, val, osm_n_df):
+   '''
+   Using the saved osm information as well as the trajectory segment information, 
+   return the node structural and functional data, and the node states
+   '''
+   n_f_df, n_state_df = get_functional_metadata(df, val)
+   n_s_df = add_node_structural(osm_n_df, n_state_df, val)
+
+   return n_s_df, n_f_df, n_state_df
 
-def get_node_metadata(df, val):
-   ### Compute functional metadata
-   n_f_df = get_functional_metadata(df, val)
+def splice_rows(old_df, new_df, val, sort=False):
+   '''
+   Replaces the rows of old_df of the edges/nodes in new_df with the rows of new_df.
+   The edges/nodes keep their position (new ones go at the end), or the rows are sorted by val if sort is True.
+   '''
+   df = pd.concat([old_df[~old_df[val].isin(new_df[val])], new_df], ignore_index=True)
+
+   if sort:
+      order = np.argsort(df[val].to_numpy(), kind='stable')
+   else:
+      old_pos = pd.Series(np.arange(len(old_df)), index=old_df[val]).groupby(level=0).min()
+      new_pos = pd.Series(len(old_df) + np.arange(len(new_df)), index=new_df[val]).groupby(level=0).min()
+      pos = df[val].map(old_pos).fillna(df[val].map(new_pos)).to_numpy()
+      order = np.argsort(pos, kind='stable')
+
+   return df.iloc[order].reset_index(drop=True)
+
+def update_state(old_state_df, batch_state_df, val):
+   '''
+   Folds the state of a new batch into the saved state, returns the new state (sorted by edge/node, time bin)
+   and the edges/nodes of the batch
+   '''
+   batch_v = batch_state_df[val].unique()
+   touched = old_state_df[val].isin(batch_v)
+
+   merged = merge_states(pd.concat([old_state_df[touched], batch_state_df], ignore_index=True), [val, time_bin])
+   state_df = splice_rows(old_state_df, merged, val, sort=True)
 
-   ### Compute structural metadata
-   # compute street count and total num of trajectories columns
-   street_count_col = df.groupby(val).agg({'Compass_dir': [compute_street_count]})
-   num_traj_col = n_f_df.groupby(val).agg({traj_count: ['sum']})
+   return state_df, batch_v
 
-   def grab_s_data(x):
-      try:
-         st_count = street_count_col.xs(x).item()
-         t_count = num_traj_col.xs(x).item()
-      except Exception as e:
-         st_count = 0
-         t_count = 0
-         print('Exception: x: ', x) #TODO: figure out why there's one nan value being passed
-      return st_count, t_count
+def update_edge_metadata(df, val, osm_e_df, e_s_df, e_f_df, e_state_df):
+   '''
+   IN: df (pandas DataFrame) - edge trajectory segments of a new batch
+       val (str) - edge column name
+       osm_e_df (pandas DataFrame) - OSM edge information of the batch
+       e_s_df, e_f_df, e_state_df (pandas DataFrames) - saved edge structural, functional metadata and state
 
-   osm_n_df[val].dropna()
-   osm_n_df[['Street_count', traj_count]] = osm_n_df[val].apply(lambda x: pd.Series(grab_s_data(x)))
+   OUT: e_s_df, e_f_df, e_state_df (pandas DataFrames) - updated edge metadata and state
+   '''
+   e_state_df, batch_v = update_state(e_state_df, get_state_df(df, val), val)
+   batch_state = e_state_df[e_state_df[val].isin(batch_v)]
 
-   return osm_n_df, n_f_df
+   # functional rows of the edges of the batch
+   e_f_df = splice_rows(e_f_df, get_functional_df(batch_state, val), val, sort=True)
 
+   # structural rows of the edges of the batch (saved OSM values) and of the new edges
+   s_rows = pd.concat([e_s_df[e_s_df[val].isin(batch_v)], osm_e_df[~osm_e_df[val].isin(e_s_df[val])]], ignore_index=True)
+   s_rows = add_edge_structural(s_rows[osm_e_df.columns].copy(), batch_state, val)
+   e_s_df = splice_rows(e_s_df, s_rows, val)
+
+   return e_s_df, e_f_df, e_state_df
+
+def update_node_metadata(df, val, osm_n_df, n_s_df, n_f_df, n_state_df):
+   '''
+   IN: df (pandas DataFrame) - node trajectory segments of a new batch
+       val (str) - node column name
+       osm_n_df (pandas DataFrame) - OSM node information of the batch
+       n_s_df, n_f_df, n_state_df (pandas DataFrames) - saved node structural, functional metadata and state
+
+   OUT: n_s_df, n_f_df, n_state_df (pandas DataFrames) - updated node metadata and state
+   '''
+   n_state_df, batch_v = update_state(n_state_df, get_state_df(df, val), val)
+   batch_state = n_state_df[n_state_df[val].isin(batch_v)]
+
+   # functional rows of the nodes of the batch
+   n_f_df = splice_rows(n_f_df, get_functional_df(batch_state, val), val, sort=True)
+
+   # structural rows of the nodes of the batch and of the new nodes, adding the edges of the batch to the edges of each node
+   edges_col = osm_node_new_cols[2]
+   s_rows = pd.concat([n_s_df[n_s_df[val].isin(batch_v) | n_s_df[val].isin(osm_n_df[val])],
+                       osm_n_df[~osm_n_df[val].isin(n_s_df[val])]], ignore_index=True)[osm_n_df.columns]
+   batch_edges = osm_n_df.set_index(val)[edges_col]
+   s_rows[edges_col] = [l + [e for e in batch_edges.get(v, []) if e not in l] for v, l in zip(s_rows[val], s_rows[edges_col])]
+   s_rows = add_node_structural(s_rows, batch_state, val)
+   n_s_df = splice_rows(n_s_df, s_rows, val)
+
+   return n_s_df, n_f_df, n_state_df
+
+def align_batch_edge_ids(e_s_df, e_df, n_df, osm_e_df, osm_n_df):
+   '''
+   Replaces the edge ids of a new batch (trajectory segments, compass directions of the nodes and OSM information)
+   with the saved edge ids of the same (u, v, key), new edges get new ids
+   '''
+   id_map = align_edge_ids(osm_e_df, e_s_df)
+
+   e_df[edge] = e_df[edge].map(id_map).astype('Int64')
+   n_df[compass_dir] = n_df[compass_dir].map(id_map).astype('Int64')
+   osm_e_df[edge] = osm_e_df[edge].map(id_map)
+   osm_n_df[osm_node_new_cols[2]] = [[int(id_map[e]) for e in l] for l in osm_n_df[osm_node_new_cols[2]]]
+
+   return e_df, n_df, osm_e_df, osm_n_df
 
 ########################################## MAIN ##########################################
-# get the edge/node functional and structural metadata 
-e_s_df, e_f_df = get_edge_metadata(e_df, val=edge)
-n_s_df, n_f_df = get_node_metadata(n_df, val=node)
-
-# # save all four dataframes to csv
-e_s_df.to_csv(os.path.join(out_dir, e_s), index=False)
-e_f_df.to_csv(os.path.join(out_dir, e_f), index=False)
-n_s_df.to_csv(os.path.join(out_dir, n_s), index=False)
-n_f_df.to_csv(os.path.join(out_dir, n_f), index=False)
\ No newline at end of file
+def main(update=False):
+   '''
+   Computes the map metadata of the trajectory segments, or folds them into the saved metadata if update is True
+   '''
+   # load files as pandas dataframes (edges are edge ids, node compass directions are the edge ids of the last point)
+   n_df = read_table(os.path.join(processed_dir, n_file_name), dtype={node: 'Int64', compass_dir: 'Int64'})
+   e_df = read_table(os.path.join(processed_dir, e_file_name), dtype={edge: 'Int64'})
+
+   osm_n_df = read_table(os.path.join(processed_dir, osm_n_file))
+   osm_e_df = read_table(os.path.join(processed_dir, osm_e_file),
+                         columns=['Edge'] + edge_keys + ['OSM_oneway','OSM_lanes','OSM_name','OSM_highway','OSM_maxspeed','OSM_length', edge_geometry])# don't need to read vector
+
+   state_paths = [os.path.join(out_dir, e_state), os.path.join(out_dir, n_state)]
+   if update and not all(os.path.exists(p) for p in state_paths):
+      print('No saved metadata state, computing the metadata of the batch')
+      update = False
+
+   if update:
+      # saved metadata and state
+      e_s_df = read_table(os.path.join(out_dir, e_s))
+      e_f_df = read_table(os.path.join(out_dir, e_f))
+      n_s_df = read_table(os.path.join(out_dir, n_s))
+      n_f_df = read_table(os.path.join(out_dir, n_f))
+      e_state_df = read_state(state_paths[0])
+      n_state_df = read_state(state_paths[1])
+
+      # fold the batch into the saved metadata
+      e_df, n_df, osm_e_df, osm_n_df = align_batch_edge_ids(e_s_df, e_df, n_df, osm_e_df, osm_n_df)
+      e_s_df, e_f_df, e_state_df = update_edge_metadata(e_df, edge, osm_e_df, e_s_df, e_f_df, e_state_df)
+      n_s_df, n_f_df, n_state_df = update_node_metadata(n_df, node, osm_n_df, n_s_df, n_f_df, n_state_df)
+   else:
+      # get the edge/node functional and structural metadata 
+      e_s_df, e_f_df, e_state_df = get_edge_metadata(e_df, val=edge, osm_e_df=osm_e_df)
+      n_s_df, n_f_df, n_state_df = get_node_metadata(n_df, val=node, osm_n_df=osm_n_df)
+
+   # save all four dataframes
+   save_table(e_s_df, os.path.join(out_dir, e_s), nested_types=e_s_types)
+   save_table(e_f_df, os.path.join(out_dir, e_f), nested_types=e_f_types)
+   save_table(n_s_df, os.path.join(out_dir, n_s), nested_types=n_s_types)
+   save_table(n_f_df, os.path.join(out_dir, n_f), nested_types=n_f_types)
+   save_table(get_state_table(e_state_df), state_paths[0], nested_types=e_state_types)
+   save_table(get_state_table(n_state_df), state_paths[1], nested_types=n_state_types)
+
+   # also export them to csv
+   if csv_export:
+      for file_name in [e_s, e_f, n_s, n_f]:
+         export_csv(os.path.join(out_dir, file_name))
+
+   # publish a snapshot of the metadata for the dashboard (it reloads the tables when the version changes)
+   version = publish_snapshot(out_dir, [e_s, e_f, n_s, n_f], keep=snapshot_versions)
+   print(f'Published map metadata version {version}')
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Compute the edge and node metadata of the trajectory segments')
+   parser.add_argument('--update', action='store_true', help='fold the trajectory segments into the saved metadata')
+   args = parser.parse_args()
+
+   main(update=args.update)
\ No newline at end of file
@@ -7,9 +7,10 @@ DESCRIPTION: For each point of a trajectory with the following info:
              Calculate:
                 speed, compass direction, day, day type, time type, time bin
 
+             If the file has no speed or heading columns, they are derived from consecutive points of each trip.
+
 TODO: 
 1. figure out how you would get the column names for a new trajectory file
-2. code getting the heading and speed for each point accounting for trip ID(currently, we just use the columns already there)
 
 Author: Ana Uribe
 '''
@@ -22,8 +23,11 @@ import numpy as np
 import datetime
 from geopy.distance import geodesic as GD
 
+from storage import save_table
+
 ########################################## VARIABLES ##########################################
-constants_path = '/Users/bean/Documents/masters-project/map-metadata/constants.json'
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.json'))
 
 ########################################## LOAD IN DATA ##########################################
 # dictionary with constants
@@ -47,6 +51,7 @@ speed = constants_dict['trajectory cols']['speed col name']
 heading = constants_dict['trajectory cols']['heading col name']
 latitude = constants_dict['trajectory cols']['latitude col name']
 longitude = constants_dict['trajectory cols']['longitude col name']
+trip_id = constants_dict['trajectory cols']['trip id']
 
 # get metadata column names
 compass_dir = constants_dict['metadata cols']['compass directions']
@@ -56,9 +61,6 @@ time_type = constants_dict['metadata cols']['time type']
 time_bin = constants_dict['metadata cols']['time bin']
 
 
-# upload data as pandas dataframe
-df = pd.read_csv(os.path.join(in_dir, in_file_name))
-
 ########################################## HELPER FUNCTIONS ########################################## 
 def return_datetime_type(p):
    ''' 
@@ -223,23 +225,171 @@ def get_time_bin(d, t):
       bin = d + t
       return bin
 
+########################################## VECTORIZED FUNCTIONS ########################################## 
+# bearing edges between compass directions (same bins as HEADING_DICT in constants.py and get_compass_dir)
+compass_bins = [22.5, 67.5, 112.5, 157.5, 202.5, 247.5, 292.5, 337.5]
+compass_labels = np.array(['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW', 'N'], dtype=object)
+
+def get_datetime_col(col):
+   '''
+   IN: col (pandas Series) - timestamps as str (year-month-day hour-minute-seconds) or datetime.datetime
+
+   OUT: dt_col (pandas Series) - timestamps parsed once as datetime64 values
+   '''
+   dt_col = pd.to_datetime(col, format='%Y-%m-%d %H:%M:%S')
+
+   if dt_col.isna().any():
+      raise TypeError('Timestamp column has values that are not of type datetime.datetime or str')
+
+   return dt_col
+
+def get_compass_dir_col(heading_col):
+   '''
+   IN: heading_col (pandas Series) - bearing of each point in degrees (0-360)
+
+   OUT: c_dir (numpy array) - compass direction of each point, binned like get_compass_dir (NaN bearings stay NaN)
+   '''
+   h = heading_col.to_numpy(dtype=float)
+   missing = np.isnan(h)
+
+   if ((h[~missing] < 0) | (h[~missing] > 360)).any():
+      raise ValueError('Bearing not within bearing values (0-360).')
+
+   # index of the bin each bearing falls in, bins are [left, right)
+   c_dir = compass_labels[np.digitize(h, compass_bins)]
+   c_dir[missing] = np.nan
+
+   return c_dir
+
+def get_time_cols(dt_col):
+   '''
+   IN: dt_col (pandas Series) - datetime64 timestamps (see get_datetime_col)
+
+   OUT: d, d_type, t_type (numpy arrays) - day (1 - Monday, 7 - Sunday), day type (1 - week day, 0 - weekend),
+                                           and time type (1 - day, -1 - night) of each point, same values as
+                                           get_day, get_day_type and get_time_type
+   '''
+   d = dt_col.dt.dayofweek.to_numpy() + 1
+   hour = dt_col.dt.hour.to_numpy()
+
+   d_type = np.where(d <= 5, 1, 0)
+   t_type = np.where((4 <= hour) & (hour <= 18), 1, -1)
+
+   return d, d_type, t_type
+
+# mean radius of the earth in miles (haversine distance)
+earth_radius = 3958.8
+
+def get_distance_col(lat_1, lat_2, long_1, long_2):
+   '''
+   IN: lat_1, lat_2, long_1, long_2 (numpy arrays) - latitude and longitude coordinates for pairs of points: (lat_1, long_1), (lat_2, long_2)
+
+   OUT: dif (numpy array) - haversine distance in miles between each pair of points
+   '''
+   lat_1, lat_2, long_1, long_2 = map(np.radians, (lat_1, lat_2, long_1, long_2))
+
+   a = np.sin((lat_2 - lat_1) / 2)**2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((long_2 - long_1) / 2)**2
+   dif = 2 * earth_radius * np.arcsin(np.sqrt(a))
+
+   return dif
+
+def get_bearing_col(lat_1, lat_2, long_1, long_2):
+   '''
+   IN: lat_1, lat_2, long_1, long_2 (numpy arrays) - latitude and longitude coordinates for pairs of points: (lat_1, long_1), (lat_2, long_2)
+
+   OUT: bearing (numpy array) - initial bearing in degrees (0-360, zero is North) going from the first to the second point
+   '''
+   lat_1, lat_2, long_1, long_2 = map(np.radians, (lat_1, lat_2, long_1, long_2))
+
+   x = np.sin(long_2 - long_1) * np.cos(lat_2)
+   y = np.cos(lat_1) * np.sin(lat_2) - np.sin(lat_1) * np.cos(lat_2) * np.cos(long_2 - long_1)
+   bearing = np.degrees(np.arctan2(x, y)) % 360
+
+   return bearing
+
+def get_speed_heading_cols(df, dt_col):
+   '''
+   IN: df (pandas DataFrame) - trajectory points with trip id, latitude and longitude columns
+       dt_col (pandas Series) - datetime64 timestamps of the points (see get_datetime_col)
+
+   OUT: speed_col, heading_col (numpy arrays) - speed (miles per hour) and heading (degrees) of each point, in the order of df
+
+   Each point gets the speed and heading from the previous point of the same trip to itself.
+   The first point of a trip uses the pair it forms with the next point, and a trip with one point gets NaN.
+   Headings of points that did not move are NaN.
+   '''
+   # sort points by trip and time, keeping the order to put the values back
+   trip_codes = pd.factorize(df[trip_id])[0]
+   t = dt_col.to_numpy().astype('datetime64[ns]').astype(np.int64) / 3.6e12     # hours
+   order = np.lexsort((t, trip_codes))
+
+   trip_codes = trip_codes[order]
+   t = t[order]
+   lat = df[latitude].to_numpy(dtype=float)[order]
+   long = df[longitude].to_numpy(dtype=float)[order]
+
+   # consecutive pairs of points that belong to the same trip
+   same_trip = trip_codes[1:] == trip_codes[:-1]
+
+   d_dif = get_distance_col(lat_1=lat[:-1], lat_2=lat[1:], long_1=long[:-1], long_2=long[1:])
+   t_dif = t[1:] - t[:-1]
+
+   with np.errstate(divide='ignore', invalid='ignore'):
+      pair_speed = np.where(same_trip & (t_dif > 0), d_dif / t_dif, np.nan)
+   pair_heading = np.where(same_trip & (d_dif > 0), get_bearing_col(lat_1=lat[:-1], lat_2=lat[1:], long_1=long[:-1], long_2=long[1:]), np.nan)
+
+   # first point of each trip takes the pair ahead of it, every other point the pair behind it
+   first_point = np.r_[True, ~same_trip]
+
+   speed_col = np.empty(len(order))
+   heading_col = np.empty(len(order))
+   for col, pair_val in ((speed_col, pair_speed), (heading_col, pair_heading)):
+      back = np.r_[np.nan, pair_val]
+      ahead = np.r_[pair_val, np.nan]
+      col[order] = np.where(first_point, ahead, back)
+
+   return speed_col, heading_col
+
 ########################################## MAIN ########################################## 
-# if needed, generate speed and heading columns
-if speed_bool == 0:
-   print('Calculating speed')
-   # osmnx.distance.euclidean might be useful
+def add_trajectory_metadata(df):
+   '''
+   IN: df (pandas DataFrame) - trajectory points
+
+   OUT: df (pandas DataFrame) - trajectory points with speed and heading (if they need to be calculated),
+                                compass direction, day, day type, time type and time bin columns
+   '''
+   # parse the timestamps once
+   dt_col = get_datetime_col(df[timestamp])
+
+   # if needed, generate speed and heading columns
+   if speed_bool == 0 or heading_bool == 0:
+      speed_col, heading_col = get_speed_heading_cols(df, dt_col)
+
+   if speed_bool == 0:
+      print('Calculating speed')
+      df[speed] = speed_col
+
+   if heading_bool == 0:
+      print('Calculating heading')
+      df[heading] = heading_col
+
+   # generate compass directions, day type, time type columns
+   df[compass_dir] = get_compass_dir_col(df[heading])
+   df[day], df[day_type], df[time_type] = get_time_cols(dt_col)
+
+   # generate time bin column
+   df[time_bin] = df[day_type] + df[time_type]
+
+   return df
 
-if heading_bool == 0:
-   print('Calculating heading')
+def main():
+   # upload data as pandas dataframe
+   df = pd.read_csv(os.path.join(in_dir, in_file_name))
 
-# generate compass directions, day type, time type columns
-df[compass_dir] = df[heading].apply(get_compass_dir)
-df[day] = df[timestamp].apply(get_day)
-df[day_type] = df[timestamp].apply(get_day_type)
-df[time_type] = df[timestamp].apply(get_time_type)
+   df = add_trajectory_metadata(df)
 
-# generate time bin column
-df[time_bin] = df[day_type] + df[time_type]
+   # save new df to the processed data
+   save_table(df, os.path.join(processed_dir, out_file_name))
 
-# save new df to the processed data
-df.to_csv(os.path.join(processed_dir, out_file_name), index=False)
\ No newline at end of file
+if __name__ == '__main__':
+   main()
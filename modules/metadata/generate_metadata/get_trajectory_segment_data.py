@@ -21,12 +21,12 @@ import os
 import pandas as pd
 import numpy as np
 
-from collections import Counter
-import ast
-
-from get_trajectory_metadata import time_difference, distance_difference
+from get_trajectory_metadata import get_datetime_col, get_distance_col
+from edge_index import EdgeVectorIndex
+from storage import save_table, read_table
 ########################################## VARIABLES ##########################################
-constants_path = '/Users/bean/Documents/masters-project/map-metadata/constants.json'
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.json'))
 
 ########################################## LOAD IN DATA ##########################################
 # dictionary with constants
@@ -55,18 +55,13 @@ day_type = constants_dict['metadata cols']['day type']
 time_type = constants_dict['metadata cols']['time type']
 time_bin = constants_dict['metadata cols']['time bin']
 edge = constants_dict['metadata cols']['edge']
+edge_keys = constants_dict['metadata cols']['edge keys']
 node = constants_dict['metadata cols']['node']
 avg_speed = constants_dict['metadata cols']['avg speed']
 max_speed = constants_dict['metadata cols']['max speed']
 min_speed = constants_dict['metadata cols']['min speed']
 travel_time = constants_dict['metadata cols']['travel time']
 
-# load in trajectory df
-df = pd.read_csv(os.path.join(processed_dir, trajectory_w_metadata_map_matching_file))
-
-# load in edge file
-edge_vector_df = pd.read_csv(os.path.join(processed_dir, edge_info_file))
-
 ########################################## HELPER FUNCTIONS ##########################################
 def get_vector(x1, y1, x2, y2):
     # Calculate the vector components
@@ -76,172 +71,165 @@ def get_vector(x1, y1, x2, y2):
     vector = [vector_x, vector_y]
     return vector
 
-def get_trip_segment_metadata(df):
+def get_trip_segment_metadata(df, edge_vector_index):
+    '''
+    IN: df (pandas DataFrame) - trajectory points with their edge (edge id) and node
+        edge_vector_index (EdgeVectorIndex) - vectors of the edges
 
-    # get unique trip_ids
-    unique_trip_ids = np.unique(df[trip_id])
+    OUT: edge_df, node_df (pandas DataFrames) - edge and node trajectory segments
+    '''
 
     # define df cols
     e_cols = [trip_id, edge, avg_speed, max_speed, min_speed, compass_dir, day_type, time_type, travel_time]
     n_cols = [trip_id, node, avg_speed, max_speed, min_speed, compass_dir, day_type, time_type, travel_time]
 
     # get edge and node df
-    edge_df = get_e_n_df(df, unique_trip_ids=unique_trip_ids, cols=e_cols, val = edge)
-    node_df = get_e_n_df(df, unique_trip_ids=unique_trip_ids, cols=n_cols, val = node)
+    edge_df = get_e_n_df(df, cols=e_cols, val = edge, edge_vector_index=edge_vector_index)
+    node_df = get_e_n_df(df, cols=n_cols, val = node)
 
     return edge_df, node_df
 
-def get_e_n_df(df, unique_trip_ids, cols, val):
-
-    # create row list to append values
-    rows = []
-
-    # for every unique trip id
-    for trip in unique_trip_ids:
-
-        # create subset df
-        t_df = df[df[trip_id] == trip]
-
-        # get unique edges/nodes
-        unique_e_n = np.unique(t_df[val].dropna())
-        # print(f't_df: {t_df.head(3)}')
-        # print(f'length of d_df: {len(t_df)}')
-        # for every unique edge/node
-        for v in unique_e_n:
-            # print(f'current v: {v}')
-
-            if val == node:
-                v_vector = None
-            else:
-                v_vector = edge_vector_df[edge_vector_df['Edge'] == v]['Vector'].item()
-
-            v_df = t_df[t_df[val] == v]     # create subset df
-
-            avg_speed, max_speed, min_speed, c_dir, d_type, t_type, travel_t = get_e_n_segment_metadata(v_df, v_vector)     # get metadata
-
-            if val == node:
-                v = int(v)
-            else:
-                v = ast.literal_eval(v)
+def get_e_n_df(df, cols, val, edge_vector_index=None):
+    '''
+    IN: df (pandas DataFrame) - trajectory points with their edge and node
+        cols (list) - column names of the returned df
+        val (str) - edge or node column name
+        edge_vector_index (EdgeVectorIndex) - vectors of the edges (edge case)
 
-            new_row = trip, v, avg_speed, max_speed, min_speed, c_dir, d_type, t_type, travel_t
-            rows.append(new_row)
+    OUT: new_df (pandas DataFrame) - one row per trajectory segment (trip id, edge/node pair), sorted by trip id then edge/node
 
-    new_df = pd.DataFrame(rows, columns=cols)
+    All the segments are computed at once: the points are grouped by [trip id, edge/node] and
+    every statistic is a groupby aggregation over those groups.
+    '''
+    # points that belong to a trip and were matched to an edge/node, keeping their original order
+    v_df = df[df[trip_id].notna() & df[val].notna()].reset_index(drop=True)
+    v_df['_t'] = get_datetime_col(v_df[timestamp])
+    v_df['_pos'] = np.arange(len(v_df))
+
+    keys = [trip_id, val]
+    groups = v_df.groupby(keys, sort=True)
+
+    # speed statistics
+    seg_df = groups[speed].agg(['size', 'mean', 'max', 'min'])
+    one_point = (seg_df['size'] == 1).to_numpy()
+
+    # first and last points (first row with the min/max timestamp) of each trajectory segment
+    first_idx = groups['_t'].idxmin().to_numpy()
+    last_idx = groups['_t'].idxmax().to_numpy()
+
+    ### compass directions (vector or edge id)
+    if val == node:
+        # node case: edge of the last point
+        c_dir = v_df[edge].array.take(last_idx)
+        c_dir[one_point] = pd.NA
+    else:
+        # edge case: sign of the dot product between the edge and the trajectory segment vectors
+        v_vectors = edge_vector_index.get_vectors(seg_df.index.get_level_values(val))
+        segment_vectors = np.column_stack(get_vector(x1=v_df[longitude].to_numpy()[first_idx],
+                                                     y1=v_df[latitude].to_numpy()[first_idx],
+                                                     x2=v_df[longitude].to_numpy()[last_idx],
+                                                     y2=v_df[latitude].to_numpy()[last_idx]))
+        dot_product = np.einsum('ij,ij->i', v_vectors, segment_vectors)
+
+        c_dir = np.select([dot_product > 0, dot_product < 0], ['+', '-'], 'p').astype(object)
+        c_dir[np.isnan(dot_product)] = np.nan
+        c_dir[one_point] = np.nan
+
+    ### day type, time type
+    d_type = get_most_frequent_values(v_df, keys, day_type).reindex(seg_df.index).to_numpy()
+    t_type = get_most_frequent_values(v_df, keys, time_type).reindex(seg_df.index).to_numpy()
+
+    ### travel time
+    travel_t = get_travel_time(v_df, first_idx, last_idx)
+    travel_t[one_point] = np.nan
+
+    # edge/node values (nodes are saved as ints)
+    v = seg_df.index.get_level_values(val)
+    if val == node:
+        v = v.astype(int)
+
+    new_df = pd.DataFrame({cols[0]: seg_df.index.get_level_values(trip_id),
+                           cols[1]: v,
+                           cols[2]: round_col(seg_df['mean']),
+                           cols[3]: round_col(seg_df['max']),
+                           cols[4]: round_col(seg_df['min']),
+                           cols[5]: c_dir,
+                           cols[6]: d_type,
+                           cols[7]: t_type,
+                           cols[8]: travel_t,
+                          })
 
     # calculate time_bin col
     new_df[time_bin] = new_df[day_type] + new_df[time_type]
 
     return new_df
 
-def get_travel_time(df, h_d=False):
+def get_travel_time(df, first_idx, last_idx, h_d=False):
     ''' 
-    Returns travel time in minutes
+    Returns travel time in minutes of each trajectory segment given the rows of its first and last points
     h_d (bool) - False if you just want the time difference between the first and last point,
                  True if you want the time difference divided by the length of the intersection/road
     '''
-    # get first and last points of that trajectory segment
-    first_point = df.loc[df[timestamp] == min(df[timestamp])]
-    last_point = df.loc[df[timestamp] == max(df[timestamp])]
-
-    f_lat = list(first_point[latitude])[0]
-    f_long = list(first_point[longitude])[0]
-    f_timestamp = list(first_point[timestamp])[0]
-
-    l_lat = list(last_point[latitude])[0]
-    l_long = list(last_point[longitude])[0]
-    l_timestamp = list(last_point[timestamp])[0]
+    t = df['_t'].to_numpy()
 
     # get the time difference between the first and last point
-    time_dif = time_difference(p_1=f_timestamp, p_2=l_timestamp, units='minutes')
+    time_dif = (t[last_idx] - t[first_idx]) / np.timedelta64(1, 'm')
 
     if h_d:
         # get the distance between the first and last point
-        distance = distance_difference(lat_1=f_lat, lat_2=l_lat, long_1=f_long, long_2=l_long)
+        lat = df[latitude].to_numpy()
+        long = df[longitude].to_numpy()
+        distance = get_distance_col(lat_1=lat[first_idx], lat_2=lat[last_idx], long_1=long[first_idx], long_2=long[last_idx])
         # compute travel time
-        tt = np.divide(time_dif, distance)   # if want minutes/miles
-        travel_time = round(tt, 4)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tt = np.divide(time_dif, distance)   # if want minutes/miles
+        travel_time = np.round(tt, 4)
     else:
         # compute travel time
-        travel_time = round(time_dif, 4)
+        travel_time = np.round(time_dif, 4)
     
     return travel_time
 
-def get_e_n_segment_metadata(df, v_vector):
-    if len(df) == 1:
-        one_speed = int(round(df[speed].item()))
-        d_type = df[day_type].item()
-        t_type = df[time_type].item()
-        return one_speed, one_speed, one_speed, np.NaN, d_type, t_type, np.NaN
-    
-    else:
-        ### get speed statistics
-        # check if nan value:
-        try:
-            avg_speed = int(round(np.mean(df[speed])))
-            max_speed = int(round(max(df[speed])))
-            min_speed = int(round(min(df[speed])))
-        except Exception as e:
-            avg_speed, max_speed, min_speed = np.NaN, np.NaN, np.NaN
-            print(e)
-
-        ### get compass directions (vector or edge name)
-
-        # get first and last points of that trajectory segment
-        first_point = df.loc[df[timestamp] == min(df[timestamp])]
-        last_point = df.loc[df[timestamp] == max(df[timestamp])]
-        if v_vector == None:
-            # node case:
-            c_dir = last_point['Edge'].item()
-            
-        else:
-            # edge case:
-            # get location of first and last points
-            f_lat = list(first_point[latitude])[0]
-            f_long = list(first_point[longitude])[0]
-            l_lat = list(last_point[latitude])[0]
-            l_long = list(last_point[longitude])[0]
-
-            # get vector of trajectory segment
-            segment_vector = get_vector(f_long, f_lat, l_long, l_lat)
-
-            # compute dot product
-            dot_product = np.vdot(ast.literal_eval(v_vector), segment_vector)
-
-            if dot_product > 0:
-                c_dir = '+'
-            elif dot_product < 0:
-                c_dir = '-'
-            else:
-                c_dir = 'p'
-
-        ### day type
-        d_type = get_most_frequent_value(df[day_type])
-        ### time type
-        t_type = get_most_frequent_value(df[time_type])
-
-        ### travel time
-        travel_t = get_travel_time(df)
-    
-    return avg_speed, max_speed, min_speed, c_dir, d_type, t_type, travel_t
+def get_most_frequent_values(df, keys, col):
+    '''
+    Returns the most frequent value of col for each group of keys (pandas Series indexed by keys).
+    Ties go to the value that appears first in the group.
+    '''
+    counts = df.groupby(keys + [col], sort=False, dropna=False)['_pos'].agg(['size', 'min']).reset_index()
+    counts = counts.sort_values(['size', 'min'], ascending=[False, True], kind='stable').drop_duplicates(keys)
 
+    most_frequent_vals = counts.set_index(keys)[col]
 
-def get_most_frequent_value(col):
-    
-    counter = Counter(col)
-    categories = list(counter.keys())
-    counts = list(counter.values())
+    return most_frequent_vals
 
-    max_idx = counts.index(max(counts))
-
-    most_frequent_val = categories[max_idx]
+def round_col(col):
+    '''
+    Rounds col to the nearest whole number, returns ints if there are no NaN values
+    '''
+    rounded = np.round(col.to_numpy(dtype=float))
 
-    return most_frequent_val
+    if np.isnan(rounded).any():
+        return rounded
+    else:
+        return rounded.astype(int)
 
 ########################################## MAIN ##########################################
-# get edge/node dataframes with trip segment metadata
-e_df, n_df = get_trip_segment_metadata(df)
+def main():
+    # load in trajectory df (edges are edge ids)
+    df = read_table(os.path.join(processed_dir, trajectory_w_metadata_map_matching_file),
+                    columns=[trip_id, timestamp, latitude, longitude, speed, day_type, time_type, edge, node],
+                    dtype={edge: 'Int64', node: 'Int64'})
+
+    # load in edge file and index the edge vectors
+    edge_vector_df = read_table(os.path.join(processed_dir, edge_info_file), columns=[edge, 'Vector_x', 'Vector_y'] + edge_keys)
+    edge_vector_index = EdgeVectorIndex(edge_vector_df)
+
+    # get edge/node dataframes with trip segment metadata
+    e_df, n_df = get_trip_segment_metadata(df, edge_vector_index)
+
+    # save edge and node dataframes
+    save_table(e_df, os.path.join(processed_dir, out_file_name_edge))
+    save_table(n_df, os.path.join(processed_dir, out_file_name_node))
 
-# save edge and node dataframes to csv
-e_df.to_csv(os.path.join(processed_dir, out_file_name_edge,), index=False)
-n_df.to_csv(os.path.join(processed_dir, out_file_name_node), index=False)
+if __name__ == '__main__':
+    main()
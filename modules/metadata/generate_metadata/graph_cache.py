@@ -0,0 +1,301 @@
+'''
+File name: graph_cache
+
+DESCRIPTION: On-disk cache of the OSMnx road network graphs, so the graphs are not downloaded from the Overpass API
+             every time they are needed, and the pipeline and the dashboard can run without network.
+
+             The world is split into a fixed grid of square tiles (tile size degrees). The graph of each tile is
+             downloaded once (unsimplified) and saved as a GraphML file. A bounding box is answered like
+             ox.graph_from_bbox answers it: the graphs of the tiles it covers and of a ring of one tile around them are
+             stitched, the buffered graph is simplified, and then it is truncated to the bounding box. So a road that
+             crosses the edge of the bounding box keeps the endpoints (and the (u, v, key) and geometry) it has in the
+             graph of the whole map, instead of ending where the bounding box cuts it.
+
+             Pre-seed the cache for a city (or bounding box):
+                python graph_cache.py --cache-dir ../../../data/graph_cache --place "Minneapolis, Minnesota, USA"
+                python graph_cache.py --cache-dir ../../../data/graph_cache --bbox 45.06 44.89 -93.19 -93.33
+
+             Or build it without network from a local OSM extract (.osm XML, or .osm.pbf with pyosmium installed):
+                python graph_cache.py --cache-dir ../../../data/graph_cache --extract minneapolis.osm.pbf
+             The graph of the extract is filtered to the network type, cut into the tiles of its bounding box, and
+             the coordinates of all its nodes are saved in a Parquet node table, used to look up nodes that are not
+             in a graph.
+
+             This file does not load the constants, so the dashboard can import it too.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import argparse
+import math
+import os
+import re
+import tempfile
+from collections import defaultdict
+
+import networkx as nx
+import osmnx as ox
+import pandas as pd
+
+########################################## VARIABLES ##########################################
+default_tile_size = 0.05    # degrees
+
+# ways of an extract that are not part of a network type, tag: regex of the excluded values
+# (same as the OSMnx network type filters, ox._overpass._get_osm_filter, the regexes are not anchored like in Overpass)
+network_filters = {
+    'drive': {
+        'highway': 'abandoned|bridleway|bus_guideway|construction|corridor|cycleway|elevator|escalator|footway|no|path|'
+                   'pedestrian|planned|platform|proposed|raceway|razed|service|steps|track',
+        'service': 'alley|driveway|emergency_access|parking|parking_aisle|private',
+        'access': 'private',
+        'area': 'yes',
+        'motor_vehicle': 'no',
+        'motorcar': 'no',
+    },
+    'all': {},
+}
+
+########################################## FUNCTIONS ##########################################
+def pbf_to_xml(pbf_path, xml_path):
+    '''
+    Writes the nodes and the highway ways of a PBF extract to an OSM XML file
+    (nodes that are not on a highway are removed with the isolated nodes by filter_network)
+    '''
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError('Reading a PBF extract needs pyosmium (pip install osmium), or convert it to .osm XML first')
+
+    writer = osmium.SimpleWriter(xml_path)
+
+    class HighwayHandler(osmium.SimpleHandler):
+        def node(self, n):
+            writer.add_node(n)
+
+        def way(self, w):
+            if 'highway' in w.tags:
+                writer.add_way(w)
+
+    HighwayHandler().apply_file(pbf_path)
+    writer.close()
+
+def filter_network(G, network_type):
+    '''
+    Removes the edges of G that are not part of the network type, or not highways (and the nodes left without edges)
+    '''
+    if network_type not in network_filters:
+        raise ValueError(f'Network type {network_type} is not supported for OSM extracts, use one of {list(network_filters)}')
+
+    exclude = {tag: re.compile(pattern) for tag, pattern in network_filters[network_type].items()}
+    G.remove_edges_from([(u, v, k) for u, v, k, d in G.edges(keys=True, data=True)
+                         if 'highway' not in d or any(tag in d and regex.search(str(d[tag])) for tag, regex in exclude.items())])
+    G.remove_nodes_from(list(nx.isolates(G)))
+
+    return G
+
+def graph_from_extract(path, network_type='drive'):
+    '''
+    Returns the unsimplified graph of the network type of a local OSM extract (.osm XML or .osm.pbf)
+    '''
+    # read the tags of the network filter too, and drop the ones OSMnx does not keep after filtering
+    useful_tags_way = ox.settings.useful_tags_way
+    filter_tags = [t for t in network_filters.get(network_type, {}) if t not in useful_tags_way]
+    ox.settings.useful_tags_way = list(useful_tags_way) + filter_tags
+    try:
+        if path.endswith('.pbf'):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                xml_path = os.path.join(tmp_dir, 'extract.osm')
+                pbf_to_xml(path, xml_path)
+                G = ox.graph_from_xml(xml_path, simplify=False, retain_all=True)
+        else:
+            G = ox.graph_from_xml(path, simplify=False, retain_all=True)
+    finally:
+        ox.settings.useful_tags_way = useful_tags_way
+
+    G = filter_network(G, network_type)
+    for _, _, d in G.edges(data=True):
+        for t in filter_tags:
+            d.pop(t, None)
+
+    # count the streets of each node in the whole network, like ox.graph_from_bbox does before truncating
+    nx.set_node_attributes(G, ox.stats.count_streets_per_node(G), name='street_count')
+
+    return G
+
+class GraphCache:
+    '''
+    Road network graphs cached by tile:
+        cache_dir (str) - directory of the GraphML files (one subdirectory for each network type and tile size)
+        network_type (str) - OSMnx network type of the graphs
+        tile_size (float) - side of a tile in degrees
+        offline (bool) - True to raise an error instead of downloading a tile that is not cached
+    '''
+
+    def __init__(self, cache_dir, network_type='drive', tile_size=default_tile_size, offline=False):
+        self.cache_dir = cache_dir
+        self.network_type = network_type
+        self.tile_size = tile_size
+        self.offline = offline
+        self.node_table = None
+
+    def get_tiles(self, north, south, east, west):
+        '''
+        Returns the (row, column) of the tiles that cover the bounding box
+        '''
+        rows = range(math.floor(south / self.tile_size), math.floor(north / self.tile_size) + 1)
+        cols = range(math.floor(west / self.tile_size), math.floor(east / self.tile_size) + 1)
+
+        return [(i, j) for i in rows for j in cols]
+
+    def get_tile_path(self, i, j):
+        return os.path.join(self.cache_dir, f'{self.network_type}_{self.tile_size}', f'{i}_{j}.graphml')
+
+    def get_node_table_path(self):
+        return os.path.join(self.cache_dir, f'{self.network_type}_{self.tile_size}', 'nodes.parquet')
+
+    def save_tile(self, G, i, j):
+        path = self.get_tile_path(i, j)
+
+        # write to a temporary file first, so a tile that is being saved (by another process) is never read
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        ox.save_graphml(G, tmp_path)
+        os.replace(tmp_path, path)
+
+    def get_tile(self, i, j):
+        '''
+        Returns the (unsimplified) graph of tile (i, j), downloading and saving it if it is not cached
+        '''
+        path = self.get_tile_path(i, j)
+        if os.path.exists(path):
+            return ox.load_graphml(path)
+
+        if self.offline:
+            raise FileNotFoundError(f'Tile {i}_{j} of the {self.network_type} graph is not cached in {self.cache_dir}, '
+                                    'seed the cache with graph_cache.py or turn off offline mode')
+
+        north, south = (i + 1) * self.tile_size, i * self.tile_size
+        east, west = (j + 1) * self.tile_size, j * self.tile_size
+        try:
+            G = ox.graph_from_bbox(north, south, east, west, network_type=self.network_type, simplify=False, retain_all=True, truncate_by_edge=True)
+        except ValueError:
+            # no roads in the tile
+            G = nx.MultiDiGraph(crs=ox.settings.default_crs)
+
+        self.save_tile(G, i, j)
+
+        return G
+
+    def get_graph(self, north, south, east, west, retain_all=True, truncate_by_edge=True):
+        '''
+        Returns the simplified graph of the bounding box, stitched from the graphs of its tiles and a ring of one tile
+        around them, simplified and then truncated to the bounding box (retain_all and truncate_by_edge like ox.graph_from_bbox)
+        '''
+        tiles = self.get_tiles(north, south, east, west)
+        buffer_tiles = self.get_tiles(north + self.tile_size, south - self.tile_size, east + self.tile_size, west - self.tile_size)
+
+        graphs = [self.get_tile(i, j) for i, j in tiles]
+        for i, j in buffer_tiles:
+            if (i, j) in tiles:
+                continue
+            # offline, the buffer ring can be outside of the cached area (like the edge of an extract)
+            if self.offline and not os.path.exists(self.get_tile_path(i, j)):
+                continue
+            graphs.append(self.get_tile(i, j))
+
+        # simplify the buffered graph first, so the roads that cross the bounding box keep their real endpoints
+        G = ox.simplify_graph(nx.compose_all(graphs))
+        G = ox.truncate.truncate_graph_bbox(G, north, south, east, west, truncate_by_edge=truncate_by_edge, retain_all=True)
+
+        if not retain_all:
+            G = ox.utils_graph.get_largest_component(G)
+
+        return G
+
+    def get_node_coords(self, node_ids):
+        '''
+        Returns a DataFrame with the x (longitude) and y (latitude) of the nodes, indexed by node id, from the node
+        table of the extract the cache was built from (NaN for nodes that are not in it, or if there is no table)
+        '''
+        if self.node_table is None:
+            path = self.get_node_table_path()
+            if os.path.exists(path):
+                self.node_table = pd.read_parquet(path).set_index('osmid')
+            else:
+                self.node_table = pd.DataFrame({'x': pd.Series(dtype=float), 'y': pd.Series(dtype=float)},
+                                               index=pd.Index([], dtype='int64', name='osmid'))
+
+        return self.node_table.reindex(pd.Index(node_ids, dtype='int64', name='osmid'))
+
+    def seed(self, north, south, east, west):
+        '''
+        Downloads the tiles of the bounding box that are not cached, returns the number of tiles of the bounding box
+        '''
+        tiles = self.get_tiles(north, south, east, west)
+        for n, (i, j) in enumerate(tiles):
+            self.get_tile(i, j)
+            print(f'Cached tile {n + 1}/{len(tiles)}')
+
+        return len(tiles)
+
+    def seed_from_extract(self, path):
+        '''
+        Builds the tiles and the node table of the cache from a local OSM extract, returns the number of tiles
+        Tiles of the bounding box of the extract without roads are saved empty, so they are not downloaded
+        '''
+        G = graph_from_extract(path, self.network_type)
+        print(f'Read {len(G.nodes)} nodes and {len(G.edges)} edges from {path}')
+
+        node_df = pd.DataFrame([(n, d['x'], d['y']) for n, d in G.nodes(data=True)], columns=['osmid', 'x', 'y'])
+        node_df['osmid'] = node_df['osmid'].astype('int64')
+
+        # the tile of each node, an edge is in the tiles of both its nodes (like truncate_by_edge)
+        tile_of = dict(zip(node_df['osmid'],
+                           zip((node_df['y'] / self.tile_size).apply(math.floor), (node_df['x'] / self.tile_size).apply(math.floor))))
+        tile_nodes = defaultdict(list)
+        tile_edges = defaultdict(list)
+        for n, t in tile_of.items():
+            tile_nodes[t].append(n)
+        for u, v, k in G.edges(keys=True):
+            for t in {tile_of[u], tile_of[v]}:
+                tile_edges[t].append((u, v, k))
+
+        tiles = self.get_tiles(node_df['y'].max(), node_df['y'].min(), node_df['x'].max(), node_df['x'].min()) if len(node_df) else []
+        for n, (i, j) in enumerate(tiles):
+            T = G.edge_subgraph(tile_edges[(i, j)]).copy()
+            T.add_nodes_from((x, G.nodes[x]) for x in tile_nodes[(i, j)])
+            T.graph.update(G.graph)
+            self.save_tile(T, i, j)
+            print(f'Cached tile {n + 1}/{len(tiles)}')
+
+        table_path = self.get_node_table_path()
+        os.makedirs(os.path.dirname(table_path), exist_ok=True)
+        node_df.to_parquet(table_path, index=False)
+        self.node_table = None
+
+        return len(tiles)
+
+########################################## MAIN ##########################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download the road network graph tiles of a place or bounding box into the cache')
+    parser.add_argument('--cache-dir', required=True, help='cache directory')
+    parser.add_argument('--place', default=None, help='place name to geocode, like "Minneapolis, Minnesota, USA"')
+    parser.add_argument('--bbox', nargs=4, type=float, default=None, metavar=('NORTH', 'SOUTH', 'EAST', 'WEST'), help='bounding box')
+    parser.add_argument('--extract', default=None, help='local OSM extract (.osm XML or .osm.pbf) to build the cache from, without network')
+    parser.add_argument('--network-type', default='drive', help='OSMnx network type')
+    parser.add_argument('--tile-size', type=float, default=default_tile_size, help='side of a tile in degrees')
+    args = parser.parse_args()
+
+    graph_cache = GraphCache(args.cache_dir, network_type=args.network_type, tile_size=args.tile_size)
+
+    if args.extract is not None:
+        graph_cache.seed_from_extract(args.extract)
+    elif args.place is not None:
+        west, south, east, north = ox.geocode_to_gdf(args.place).total_bounds
+    elif args.bbox is not None:
+        north, south, east, west = args.bbox
+    else:
+        parser.error('give an --extract, a --place or a --bbox')
+
+    if args.extract is None:
+        graph_cache.seed(north, south, east, west)
@@ -0,0 +1,132 @@
+'''
+File name: nearest
+
+DESCRIPTION: Nearest edge/node engine of a road network graph.
+
+             The graph is projected once to a metric CRS (the UTM zone of its nodes), the edge geometries are put in
+             an STRtree and the nodes in a KD-tree. Points (latitude, longitude) are projected with one pyproj call
+             per batch, and the nearest edge and node of every point of the batch are found with one tree query each,
+             with a max distance in meters (points farther than it from every edge/node get None). The index also
+             returns every edge within a radius of each point (the candidate edges of the HMM map matcher).
+
+             An index is built once per graph and can answer any number of batches, so the map matching of several
+             files (or the lookups of the dashboard) over the same graph reuse it.
+
+             This file does not load the constants, so the dashboard can import it too.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import numpy as np
+import osmnx as ox
+import shapely
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+from shapely import STRtree
+
+########################################## FUNCTIONS ##########################################
+class NearestIndex:
+    '''
+    Nearest edge/node index of a graph:
+        crs (pyproj CRS) - metric CRS the graph is projected to
+        edges (numpy array) - (u, v, key) of each edge, in the order of the edge tree
+        edge_lengths (numpy array) - length (meters) of the projected geometry of each edge
+        nodes (numpy array) - OSM id of each node, in the order of the node tree
+    '''
+
+    def __init__(self, G, crs=None):
+        nodes, edges = ox.graph_to_gdfs(G)
+
+        self.crs = nodes.estimate_utm_crs() if crs is None else crs
+        nodes = nodes.to_crs(self.crs)
+        edges = edges.to_crs(self.crs)
+
+        self.nodes = nodes.index.to_numpy()
+        self.node_tree = cKDTree(np.column_stack([nodes.geometry.x.to_numpy(), nodes.geometry.y.to_numpy()]))
+
+        self.edges = edges.index.to_numpy()
+        self.edge_tree = STRtree(edges.geometry.to_numpy())
+        self.edge_lengths = shapely.length(self.edge_tree.geometries)
+
+        self.transformer = Transformer.from_crs('EPSG:4326', self.crs, always_xy=True)
+
+    def project(self, latitude, longitude):
+        '''
+        Returns the x, y (meters, in the CRS of the index) of the points
+        '''
+        x, y = self.transformer.transform(np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float))
+
+        return np.atleast_1d(x), np.atleast_1d(y)
+
+    def nearest_nodes(self, latitude, longitude, max_dist=np.inf):
+        '''
+        IN: latitude, longitude (array-like) - coordinates of the points
+            max_dist (float) - meters
+
+        OUT: node_list (numpy array) - nearest node of each point (None if no node is within max_dist)
+             dist (numpy array) - distance (meters) to the nearest node of each point (inf if there is none)
+        '''
+        x, y = self.project(latitude, longitude)
+        node_list = np.full(len(x), None, dtype=object)
+        if len(self.nodes) == 0:
+            return node_list, np.full(len(x), np.inf)
+
+        # the KD-tree returns an infinite distance for the points without a node within the bound
+        dist, idx = self.node_tree.query(np.column_stack([x, y]), distance_upper_bound=np.nextafter(max_dist, np.inf))
+        found = np.isfinite(dist)
+        node_list[found] = self.nodes[idx[found]]
+
+        return node_list, dist
+
+    def nearest_edges(self, latitude, longitude, max_dist=None):
+        '''
+        IN: latitude, longitude (array-like) - coordinates of the points
+            max_dist (float) - meters (None for no limit)
+
+        OUT: edge_list (numpy array) - nearest (u, v, key) edge of each point (None if no edge is within max_dist)
+             dist (numpy array) - distance (meters) to the nearest edge of each point (inf if there is none)
+        '''
+        x, y = self.project(latitude, longitude)
+        edge_list = np.full(len(x), None, dtype=object)
+        dist = np.full(len(x), np.inf)
+        if len(self.edges) == 0:
+            return edge_list, dist
+
+        (point_idx, edge_idx), edge_dist = self.edge_tree.query_nearest(shapely.points(x, y), max_distance=max_dist,
+                                                                         return_distance=True, all_matches=True)
+
+        # the two directions of a two-way road are equally near, keep the first edge of the graph of the ties
+        order = np.lexsort((edge_idx, point_idx))
+        point_idx, edge_idx, edge_dist = point_idx[order], edge_idx[order], edge_dist[order]
+        first = np.flatnonzero(np.r_[True, point_idx[1:] != point_idx[:-1]])
+        point_idx, edge_idx, edge_dist = point_idx[first], edge_idx[first], edge_dist[first]
+
+        edge_list[point_idx] = self.edges[edge_idx]
+        dist[point_idx] = edge_dist
+
+        return edge_list, dist
+
+    def candidate_edges(self, latitude, longitude, radius):
+        '''
+        IN: latitude, longitude (array-like) - coordinates of the points
+            radius (float) - meters
+
+        OUT: point_idx (numpy array) - position of the point of each candidate (sorted)
+             edge_idx (numpy array) - position of the candidate edge in edges
+             dist (numpy array) - distance (meters) from the point to the edge
+             offset (numpy array) - distance (meters) along the edge from u to the closest location to the point
+
+        The candidates of a point are all the edges within radius of it
+        '''
+        x, y = self.project(latitude, longitude)
+        points = shapely.points(x, y)
+
+        point_idx, edge_idx = self.edge_tree.query(points, predicate='dwithin', distance=radius)
+        order = np.lexsort((edge_idx, point_idx))
+        point_idx, edge_idx = point_idx[order], edge_idx[order]
+
+        geoms = self.edge_tree.geometries.take(edge_idx)
+        dist = shapely.distance(points[point_idx], geoms)
+        offset = shapely.line_locate_point(geoms, points[point_idx])
+
+        return point_idx, edge_idx, dist, offset
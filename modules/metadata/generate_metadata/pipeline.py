@@ -0,0 +1,274 @@
+'''
+File name: pipeline
+
+DESCRIPTION: Runs the map metadata scripts as the stages of a small DAG:
+
+                get_trajectory_metadata -> get_map_matching -> get_trajectory_segment_data -> get_map_metadata
+
+             Each stage has input files, output files, the constants (parameters) it depends on and the scripts
+             it is made of. A stage depends on the stages that write its input files.
+
+             Before running a stage, its fingerprint is computed from the content hash of its input files, its
+             parameters and the code of its scripts. If the fingerprint is the same as the last time the stage ran
+             and its outputs were not changed, the stage is skipped. So changing only the aggregation
+             (get_map_metadata) re-runs only that stage, and a stage whose inputs come out the same is skipped too.
+
+             Run all the stages (or the given stages and the stages they depend on):
+                python pipeline.py [--constants constants.json] [--stages map_metadata] [--force] [--max-memory 4GB]
+
+             With --max-memory, the first three scripts run as one stage (sharded_segments) that processes the
+             input file in shards that fit in that memory (see sharding.py).
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+
+########################################## VARIABLES ##########################################
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(script_dir, 'constants.json'))
+
+# the cache of the stage fingerprints is saved in the processed directory
+cache_file_name = 'pipeline_cache.json'
+hash_chunk_size = 1 << 20
+
+########################################## HELPER FUNCTIONS ##########################################
+def load_json(path):
+    j_file = open(path)
+    d = json.load(j_file)
+    j_file.close()
+
+    return d
+
+class FileHashes:
+    '''
+    Content hashes (sha256) of files. A hash is only recomputed when the size or modification time of the file changes.
+        hashes - path: [size, modification time (ns), hash]
+    '''
+
+    def __init__(self, hashes=None):
+        self.hashes = hashes or {}
+
+    def get(self, path):
+        if not os.path.exists(path):
+            return None
+
+        stat = os.stat(path)
+        saved = self.hashes.get(path)
+        if saved is not None and saved[0] == stat.st_size and saved[1] == stat.st_mtime_ns:
+            return saved[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(hash_chunk_size), b''):
+                h.update(chunk)
+
+        self.hashes[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+
+        return self.hashes[path][2]
+
+class Stage:
+    '''
+    A stage of the pipeline:
+        name (str) - stage name
+        module (str) - script with the main() function that runs the stage
+        inputs (list) - input file paths
+        outputs (list) - output file paths
+        params (dict) - constants the stage depends on
+        code (list) - scripts the stage imports (besides its module), only those so editing another script does not re-run it
+        kwargs (dict) - arguments of the main() function
+    '''
+
+    def __init__(self, name, module, inputs, outputs, params, code=(), kwargs=None):
+        self.name = name
+        self.module = module
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.code = [module + '.py'] + list(code)
+        self.kwargs = kwargs or {}
+
+    def get_fingerprint(self, file_hashes):
+        '''
+        Returns the hash of the stage parameters, code and input files (None if an input file is missing)
+        '''
+        h = hashlib.sha256()
+        h.update(json.dumps(self.params, sort_keys=True).encode())
+
+        for path in [os.path.join(script_dir, c) for c in self.code] + self.inputs:
+            file_hash = file_hashes.get(path)
+            if file_hash is None:
+                return None
+            h.update(path.encode())
+            h.update(file_hash.encode())
+
+        return h.hexdigest()
+
+    def run(self):
+        # the scripts import each other as top level modules
+        if script_dir not in sys.path:
+            sys.path.insert(0, script_dir)
+
+        module = importlib.import_module(self.module)
+        module.main(**self.kwargs)
+
+def get_stages(constants_dict, max_memory=None):
+    '''
+    Returns the stages of the pipeline (in the order they run) given the constants.
+    If max_memory is given, the trajectory metadata, map matching and trajectory segments run as one stage
+    that processes the input file in shards (see sharding.py).
+    '''
+    in_dir = constants_dict['input directory']
+    processed_dir = constants_dict['processed directory']
+    out_dir = constants_dict['output directory']
+
+    def processed(file_name):
+        return os.path.join(processed_dir, file_name)
+
+    # every stage uses the column names
+    col_params = {'trajectory cols': constants_dict['trajectory cols'], 'metadata cols': constants_dict['metadata cols']}
+
+    trajectory_metadata = processed(constants_dict['trajectory metadata out'])
+    map_matching = processed(constants_dict['map matching out'])
+    osm_node_info = processed(constants_dict['OSM node info file'])
+    osm_edge_info = processed(constants_dict['OSM edge info file'])
+    segment_edge = processed(constants_dict['trajectory segment out']['edge df'])
+    segment_node = processed(constants_dict['trajectory segment out']['node df'])
+    map_metadata = [os.path.join(out_dir, f) for f in list(constants_dict['map metadata out'].values()) + list(constants_dict['map metadata state'].values())]
+
+    map_metadata_stage = Stage('map_metadata', 'get_map_metadata',
+                               inputs=[segment_edge, segment_node, osm_node_info, osm_edge_info],
+                               outputs=map_metadata,
+                               params={**col_params, 'csv export': constants_dict['csv export'],
+                                       'snapshot versions': constants_dict['snapshot versions']},
+                               code=['utils.py', 'edge_index.py', 'storage.py', 'sketch.py', 'snapshot.py'])
+
+    if max_memory is not None:
+        return [Stage('sharded_segments', 'sharding',
+                      inputs=[os.path.join(in_dir, constants_dict['input file name'])],
+                      outputs=[trajectory_metadata, map_matching, osm_node_info, osm_edge_info, segment_edge, segment_node],
+                      params={**col_params, 'map matching vals': constants_dict['map matching vals'], 'graph cache': constants_dict['graph cache'],
+                              'max memory': max_memory},
+                      code=['get_trajectory_metadata.py', 'get_map_matching.py', 'get_trajectory_segment_data.py', 'edge_index.py', 'storage.py',
+                            'graph_cache.py', 'nearest.py'],
+                      kwargs={'max_memory': max_memory}),
+                map_metadata_stage,
+               ]
+
+    return [Stage('trajectory_metadata', 'get_trajectory_metadata',
+                  inputs=[os.path.join(in_dir, constants_dict['input file name'])],
+                  outputs=[trajectory_metadata],
+                  params=col_params,
+                  code=['storage.py']),
+            Stage('map_matching', 'get_map_matching',
+                  inputs=[trajectory_metadata],
+                  outputs=[map_matching, osm_node_info, osm_edge_info],
+                  params={**col_params, 'map matching vals': constants_dict['map matching vals'], 'graph cache': constants_dict['graph cache']},
+                  code=['edge_index.py', 'storage.py', 'graph_cache.py', 'nearest.py']),
+            Stage('trajectory_segments', 'get_trajectory_segment_data',
+                  inputs=[map_matching, osm_edge_info],
+                  outputs=[segment_edge, segment_node],
+                  params=col_params,
+                  code=['get_trajectory_metadata.py', 'edge_index.py', 'storage.py']),
+            map_metadata_stage,
+           ]
+
+def get_run_order(stages, targets=None):
+    '''
+    IN: stages (list) - stages of the pipeline
+        targets (list) - names of the stages to run (all if None)
+
+    OUT: run_order (list) - target stages and the stages they depend on, each after the stages it depends on
+    '''
+    producers = {path: s for s in stages for path in s.outputs}
+    by_name = {s.name: s for s in stages}
+
+    unknown = set(targets or []) - set(by_name)
+    if unknown:
+        raise ValueError(f'Unknown stages: {sorted(unknown)}, the stages are: {list(by_name)}')
+
+    run_order = []
+    visiting = set()
+
+    def visit(s):
+        if s in run_order:
+            return
+        if s.name in visiting:
+            raise ValueError(f'Stage {s.name} depends on itself')
+        visiting.add(s.name)
+        for path in s.inputs:
+            if path in producers:
+                visit(producers[path])
+        visiting.discard(s.name)
+        run_order.append(s)
+
+    for s in (stages if targets is None else [by_name[t] for t in targets]):
+        visit(s)
+
+    return run_order
+
+########################################## FUNCTIONS ##########################################
+def run_pipeline(constants_path=constants_path, targets=None, force=False, max_memory=None):
+    '''
+    IN: constants_path (str) - constants file
+        targets (list) - names of the stages to run, with the stages they depend on (all if None)
+        force (bool) - True to run the stages even if they are cached
+        max_memory (str) - memory the road network graph and a shard can use (like 4GB), to process the input file in shards (None to process it at once)
+
+    Runs the stages that are not cached, returns the names of the stages that ran
+    '''
+    # the scripts load the constants when they are imported
+    constants_path = os.path.abspath(constants_path)
+    os.environ['MAP_METADATA_CONSTANTS'] = constants_path
+    constants_dict = load_json(constants_path)
+
+    cache_path = os.path.join(constants_dict['processed directory'], cache_file_name)
+    cache = load_json(cache_path) if os.path.exists(cache_path) else {'stages': {}, 'files': {}}
+    file_hashes = FileHashes(cache['files'])
+
+    ran = []
+    for stage in get_run_order(get_stages(constants_dict, max_memory), targets):
+        fingerprint = stage.get_fingerprint(file_hashes)
+        if fingerprint is None:
+            raise FileNotFoundError(f'Missing input file of stage {stage.name}: {[p for p in stage.inputs if not os.path.exists(p)]}')
+
+        saved = cache['stages'].get(stage.name, {})
+        outputs_unchanged = all(file_hashes.get(p) is not None and file_hashes.get(p) == saved.get('outputs', {}).get(p) for p in stage.outputs)
+
+        if not force and saved.get('fingerprint') == fingerprint and outputs_unchanged:
+            print(f'Skipping {stage.name} (cached)')
+            continue
+
+        print(f'Running {stage.name}')
+        start = time.time()
+        stage.run()
+        print(f'Finished {stage.name} in {time.time() - start:.1f} s')
+        ran.append(stage.name)
+
+        cache['stages'][stage.name] = {'fingerprint': fingerprint,
+                                       'outputs': {p: file_hashes.get(p) for p in stage.outputs}}
+
+        # save the cache after every stage, so a failed run keeps the stages that finished
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=1)
+
+    return ran
+
+########################################## MAIN ##########################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the map metadata pipeline, skipping the stages that are cached')
+    parser.add_argument('--constants', default=constants_path, help='constants file')
+    parser.add_argument('--stages', nargs='+', default=None, help='stages to run (with the stages they depend on)')
+    parser.add_argument('--force', action='store_true', help='run the stages even if they are cached')
+    parser.add_argument('--max-memory', default=None, help='process the input file in shards that fit in this memory (like 512MB, 4GB)')
+    args = parser.parse_args()
+
+    run_pipeline(args.constants, targets=args.stages, force=args.force, max_memory=args.max_memory)
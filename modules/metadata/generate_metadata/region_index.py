@@ -0,0 +1,66 @@
+'''
+File name: region_index
+
+DESCRIPTION: Spatial index of the edges and nodes of the map metadata, built from the edge geometries and node
+             coordinates saved in the structural metadata (edge_s Geometry, node_s x and y).
+
+             The edge geometries and the nodes are put in STRtrees (R-trees) once, and the edges and nodes of a
+             bounding box are found with one query each, without a road network graph.
+
+             This file does not load the constants, so the dashboard can import it too.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import numpy as np
+import shapely
+from shapely import STRtree
+
+########################################## FUNCTIONS ##########################################
+class RegionIndex:
+    '''
+    Spatial index of the edges and nodes of the map metadata:
+        edges (numpy array) - edge id of each edge geometry, in the order of the edge tree
+        nodes (numpy array) - node id of each node, in the order of the node tree
+    '''
+
+    def __init__(self, edge_ids, edge_coords, node_ids, node_x, node_y):
+        # edges and nodes without a location are left out
+        has_coords = np.array([isinstance(c, (list, tuple, np.ndarray)) and len(c) > 1 for c in edge_coords], dtype=bool)
+        self.edges = np.asarray(edge_ids)[has_coords]
+        coords = [np.asarray(c, dtype=float) for c, h in zip(edge_coords, has_coords) if h]
+
+        lengths = [len(c) for c in coords]
+        lines = shapely.linestrings(np.concatenate(coords) if coords else np.empty((0, 2)),
+                                    indices=np.repeat(np.arange(len(coords)), lengths))
+        self.edge_tree = STRtree(lines)
+
+        node_x, node_y = np.asarray(node_x, dtype=float), np.asarray(node_y, dtype=float)
+        has_xy = ~(np.isnan(node_x) | np.isnan(node_y))
+        self.nodes = np.asarray(node_ids)[has_xy]
+        self.node_tree = STRtree(shapely.points(node_x[has_xy], node_y[has_xy]))
+
+    def query(self, north, south, east, west):
+        '''
+        IN: north, south, east, west (floats) - bounding box
+
+        OUT: edge_list (numpy array) - ids of the edges that cross the bounding box
+             node_list (numpy array) - ids of the nodes in the bounding box
+        '''
+        box = shapely.box(west, south, east, north)
+
+        edge_idx = np.sort(self.edge_tree.query(box, predicate='intersects'))
+        node_idx = np.sort(self.node_tree.query(box, predicate='intersects'))
+
+        return self.edges[edge_idx], self.nodes[node_idx]
+
+def get_region_index(e_s, n_s, edge='Edge', geometry='Geometry', node='Node', coords=('x', 'y')):
+    '''
+    Returns the RegionIndex of the structural metadata, or None if they don't have the edge geometries and
+    node coordinates (older metadata files)
+    '''
+    if geometry not in e_s.columns or not all(c in n_s.columns for c in coords):
+        return None
+
+    return RegionIndex(e_s[edge].to_numpy(), e_s[geometry].to_numpy(),
+                       n_s[node].to_numpy(), n_s[coords[0]].to_numpy(), n_s[coords[1]].to_numpy())
@@ -0,0 +1,264 @@
+'''
+File name: sharding
+
+DESCRIPTION: Runs get_trajectory_metadata, get_map_matching and get_trajectory_segment_data on a trajectory file
+             that does not fit in memory.
+
+             The input CSV file is read in chunks, and the points of each chunk are partitioned by a hash of their
+             trip id into shards (temporary Parquet files in the processed directory). Every point of a trip ends up
+             in the same shard, so each shard is processed on its own: trajectory metadata, map matching and
+             trajectory segments. The results are then merged:
+                * the edge ids of each shard are matched to the ids of the shards before it through their (u, v, key)
+                * the OSM node and edge information of the shards is combined
+                * the trajectory points and segments of each shard are appended to the output files
+
+             The road network graph of the bounding box of the whole file is built once (the latitude and longitude
+             columns are read first) and every shard is matched against it, since the trips of a shard can be anywhere
+             in the file's region. The number of shards and the chunk size are chosen so the graph plus a shard (with
+             the copies made while processing it) fit in max memory:
+                python sharding.py --max-memory 4GB
+
+             The output files are the same as the ones of the three scripts, with the rows grouped by shard.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import argparse
+import json
+import math
+import os
+import re
+import tempfile
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from get_trajectory_metadata import add_trajectory_metadata
+from get_map_matching import map_match, get_match_graph
+from get_trajectory_segment_data import get_trip_segment_metadata
+from edge_index import EdgeVectorIndex, align_edge_ids
+from storage import TableWriter, save_table, read_table, edge_list_type, coords_type
+
+########################################## VARIABLES ##########################################
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.json'))
+
+# memory used while processing a shard, as a multiple of its size in the CSV file
+memory_factor = 8
+# memory used by the road network graph (with its GeoDataFrames and the graphs of the tiles), per edge
+graph_edge_bytes = 4 << 10
+# rows read at a time to find the bounding box of the points
+bbox_chunk_rows = 1 << 20
+# bytes read from the start of the CSV file to estimate the size of a line
+sample_size = 1 << 16
+
+memory_units = {'': 1, 'B': 1, 'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30, 'TB': 1 << 40}
+
+########################################## LOAD IN DATA ##########################################
+# dictionary with constants
+j_file = open(constants_path)
+constants_dict = json.load(j_file)
+j_file.close()
+
+# get dir paths
+in_dir = constants_dict['input directory']
+processed_dir = constants_dict['processed directory']
+in_file_name = constants_dict['input file name']
+
+# get file names
+trajectory_metadata_file = constants_dict['trajectory metadata out']
+map_matching_file = constants_dict['map matching out']
+osm_node_info_file = constants_dict['OSM node info file']
+osm_edge_info_file = constants_dict['OSM edge info file']
+segment_edge_file = constants_dict['trajectory segment out']['edge df']
+segment_node_file = constants_dict['trajectory segment out']['node df']
+
+# get trajectory df column names
+trip_id = constants_dict['trajectory cols']['trip id']
+latitude = constants_dict['trajectory cols']['latitude col name']
+longitude = constants_dict['trajectory cols']['longitude col name']
+
+# get metadata column names
+edge = constants_dict['metadata cols']['edge']
+node = constants_dict['metadata cols']['node']
+osm_node_new_cols = constants_dict['metadata cols']['OSM node new col names']
+edge_geometry = constants_dict['metadata cols']['edge geometry']
+
+########################################## HELPER FUNCTIONS ##########################################
+def parse_memory(max_memory):
+    '''
+    Returns the number of bytes of max_memory (int, or str like "512MB", "4GB")
+    '''
+    if isinstance(max_memory, (int, float)):
+        return int(max_memory)
+
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', str(max_memory).upper())
+    if match is None:
+        raise ValueError(f'Max memory should be a number of bytes or a size like "4GB", got {max_memory}')
+
+    return int(float(match.group(1)) * memory_units[match.group(2)])
+
+def get_bbox(path):
+    '''
+    Returns the min/max latitude and longitude of the points of the CSV file (reading only those columns)
+    '''
+    lat_min = long_min = math.inf
+    lat_max = long_max = -math.inf
+
+    for chunk in pd.read_csv(path, usecols=[latitude, longitude], chunksize=bbox_chunk_rows):
+        lat_min, lat_max = min(lat_min, chunk[latitude].min()), max(lat_max, chunk[latitude].max())
+        long_min, long_max = min(long_min, chunk[longitude].min()), max(long_max, chunk[longitude].max())
+
+    return lat_min, lat_max, long_min, long_max
+
+def get_graph_memory(tile_graphs):
+    '''
+    Returns the estimated bytes of the road network graph shared by the shards
+    '''
+    return len(tile_graphs.G.edges) * graph_edge_bytes
+
+def get_shard_sizes(path, max_memory, graph_bytes=0):
+    '''
+    IN: path (str) - CSV file path
+        max_memory (int) - bytes the graph and a shard can use while the shard is processed
+        graph_bytes (int) - bytes of the road network graph shared by the shards
+
+    OUT: n_shards (int) - number of shards the file is partitioned into
+         chunk_rows (int) - number of rows read at a time
+    '''
+    if graph_bytes >= max_memory:
+        raise ValueError(f'The road network graph of the input file needs about {graph_bytes} bytes, more than max memory ({max_memory} bytes)')
+
+    file_size = os.path.getsize(path)
+    shard_bytes = max(1, (max_memory - graph_bytes) // memory_factor)
+
+    # bytes of a line, from the start of the file
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+    line_bytes = max(1, len(sample) / max(1, sample.count(b'\n')))
+
+    n_shards = max(1, math.ceil(file_size / shard_bytes))
+    chunk_rows = max(1, int(shard_bytes / line_bytes))
+
+    return n_shards, chunk_rows
+
+def partition_csv(path, shard_dir, n_shards, chunk_rows):
+    '''
+    IN: path (str) - CSV file path
+        shard_dir (str) - directory the shards are saved in
+        n_shards (int) - number of shards
+        chunk_rows (int) - number of rows read at a time
+
+    OUT: shard_paths (list) - directory of each shard that has points, with one Parquet file for each chunk
+
+    Every point of a trip goes to the same shard (hash of the trip id)
+    '''
+    shard_paths = [os.path.join(shard_dir, f'shard_{i}') for i in range(n_shards)]
+    has_points = [False] * n_shards
+
+    for chunk_num, chunk in enumerate(pd.read_csv(path, chunksize=chunk_rows)):
+        # numeric trip ids are hashed as floats, so a trip hashes the same in chunks where its column is int or float (NaN)
+        trip_col = chunk[trip_id].astype(float) if is_numeric_dtype(chunk[trip_id]) else chunk[trip_id]
+        shard = pd.util.hash_pandas_object(trip_col, index=False).to_numpy() % n_shards
+
+        for i, part in chunk.groupby(shard, sort=False):
+            if not has_points[i]:
+                os.makedirs(shard_paths[i])
+                has_points[i] = True
+            save_table(part, os.path.join(shard_paths[i], f'part_{chunk_num}.parquet'))
+
+    return [p for p, h in zip(shard_paths, has_points) if h]
+
+def read_shard(shard_path):
+    '''
+    Returns the points of a shard, in the order they are in the CSV file
+    '''
+    part_files = sorted(os.listdir(shard_path), key=lambda f: int(re.search(r'\d+', f).group()))
+
+    return pd.concat([read_table(os.path.join(shard_path, f)) for f in part_files], ignore_index=True)
+
+def merge_node_info(n_dfs):
+    '''
+    Combines the OSM node information of the shards, the edges of a node are the edges found in any shard
+    '''
+    edges_col = osm_node_new_cols[2]
+    n_df = pd.concat(n_dfs, ignore_index=True)
+
+    node_edges = n_df.groupby(node, sort=False)[edges_col].agg(lambda x: list(dict.fromkeys(e for l in x for e in l)))
+    n_df = n_df.drop_duplicates(subset=[node]).reset_index(drop=True)
+    n_df[edges_col] = n_df[node].map(node_edges)
+
+    return n_df
+
+########################################## MAIN ##########################################
+def process_shard(df, e_info_df, tile_graphs):
+    '''
+    IN: df (pandas DataFrame) - trajectory points of a shard
+        e_info_df (pandas DataFrame) - OSM edge information of the shards processed before (None for the first shard)
+        tile_graphs (TileGraphs) - road network graph of the whole file
+
+    OUT: df (pandas DataFrame) - trajectory points with their metadata, edge (edge id) and node
+         n_df, e_df (pandas DataFrames) - OSM node and edge information of the shard
+         edge_df, node_df (pandas DataFrames) - edge and node trajectory segments of the shard
+
+    The edge ids of the shard are replaced with the ids of the same edges in e_info_df (new edges get new ids)
+    '''
+    df = add_trajectory_metadata(df)
+    df, n_df, e_df = map_match(df, tile_graphs)
+
+    if e_info_df is not None:
+        id_map = align_edge_ids(e_df, e_info_df)
+        df[edge] = df[edge].map(id_map).astype('Int64')
+        e_df[edge] = e_df[edge].map(id_map)
+        n_df[osm_node_new_cols[2]] = [[int(id_map[e]) for e in l] for l in n_df[osm_node_new_cols[2]]]
+
+    edge_df, node_df = get_trip_segment_metadata(df, EdgeVectorIndex(e_df))
+
+    return df, n_df, e_df, edge_df, node_df
+
+def main(max_memory='4GB'):
+    in_path = os.path.join(in_dir, in_file_name)
+    max_memory = parse_memory(max_memory)
+
+    # one graph for every shard (the trips of a shard can be anywhere in the region of the file)
+    tile_graphs = get_match_graph(*get_bbox(in_path))
+    graph_bytes = get_graph_memory(tile_graphs)
+
+    n_shards, chunk_rows = get_shard_sizes(in_path, max_memory, graph_bytes)
+    print(f'Partitioning {in_file_name} into {n_shards} shards ({chunk_rows} rows at a time, about {graph_bytes >> 20} MB for the graph)')
+
+    e_info_df = None
+    n_info_dfs = []
+
+    with tempfile.TemporaryDirectory(dir=processed_dir) as shard_dir, \
+         TableWriter(os.path.join(processed_dir, trajectory_metadata_file)) as t_writer, \
+         TableWriter(os.path.join(processed_dir, map_matching_file)) as m_writer, \
+         TableWriter(os.path.join(processed_dir, segment_edge_file)) as e_writer, \
+         TableWriter(os.path.join(processed_dir, segment_node_file)) as n_writer:
+
+        shard_paths = partition_csv(in_path, shard_dir, n_shards, chunk_rows)
+
+        for i, shard_path in enumerate(shard_paths):
+            print(f'Processing shard {i + 1}/{len(shard_paths)}')
+            df = read_shard(shard_path)
+
+            df, n_df, e_df, edge_df, node_df = process_shard(df, e_info_df, tile_graphs)
+
+            # map matching adds the edge and node columns to the trajectory metadata
+            t_writer.write(df.drop(columns=[edge, node]))
+            m_writer.write(df)
+            e_writer.write(edge_df)
+            n_writer.write(node_df)
+
+            # keep the OSM information of the edges and nodes found so far
+            e_info_df = e_df if e_info_df is None else pd.concat([e_info_df, e_df[~e_df[edge].isin(e_info_df[edge])]], ignore_index=True)
+            n_info_dfs.append(n_df)
+
+    save_table(merge_node_info(n_info_dfs), os.path.join(processed_dir, osm_node_info_file), nested_types={osm_node_new_cols[2]: edge_list_type})
+    save_table(e_info_df, os.path.join(processed_dir, osm_edge_info_file), nested_types={edge_geometry: coords_type})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the trajectory segments of a trajectory file in shards that fit in memory')
+    parser.add_argument('--max-memory', default='4GB', help='memory the road network graph and a shard can use while it is processed (bytes, or a size like 512MB, 4GB)')
+    args = parser.parse_args()
+
+    main(max_memory=args.max_memory)
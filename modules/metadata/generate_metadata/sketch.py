@@ -0,0 +1,143 @@
+'''
+File name: sketch
+
+DESCRIPTION: Mergeable quantile sketch (merging t-digest) of the speeds and travel times of an (edge/node, time bin),
+             used for the box plots of the map metadata.
+
+             A sketch keeps the values themselves (centroids of weight 1) until there are more than compression of
+             them, then it merges neighbouring values into centroids. Centroids near the min and max hold fewer values
+             (k1 scale function), so the quartiles and the fliers stay accurate while a sketch never has more than
+             compression centroids. Sketches of batches or workers are merged by pooling and compressing their
+             centroids. While a sketch is not compressed, its quartiles and box plot are exact.
+
+             This file does not load the constants, so the dashboard can import it too.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import numpy as np
+
+########################################## VARIABLES ##########################################
+default_compression = 100   # max number of centroids of a sketch
+
+########################################## FUNCTIONS ##########################################
+class QuantileSketch:
+    '''
+    Quantile sketch of a set of values:
+        means (numpy array) - mean of the values of each centroid (in the order they were added until the sketch is compressed)
+        weights (numpy array) - number of values of each centroid
+        min, max (float) - exact min and max of the values
+        compression (int) - max number of centroids kept
+    '''
+
+    def __init__(self, means=(), weights=None, min=np.nan, max=np.nan, compression=default_compression):
+        self.means = np.asarray(means, dtype=float)
+        self.weights = np.ones(len(self.means), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        self.min = min
+        self.max = max
+        self.compression = compression
+
+    @classmethod
+    def from_values(cls, values, compression=default_compression):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return cls(compression=compression)
+
+        sketch = cls(values, min=values.min(), max=values.max(), compression=compression)
+        sketch.compress()
+
+        return sketch
+
+    @classmethod
+    def merge_all(cls, sketches):
+        '''
+        Returns the sketch of the values of all the sketches
+        '''
+        sketches = [s for s in sketches if len(s.means)]
+        if not sketches:
+            return cls()
+        elif len(sketches) == 1:
+            return sketches[0]
+
+        sketch = cls(np.concatenate([s.means for s in sketches]), np.concatenate([s.weights for s in sketches]),
+                     min=min(s.min for s in sketches), max=max(s.max for s in sketches), compression=sketches[0].compression)
+        sketch.compress()
+
+        return sketch
+
+    @property
+    def n(self):
+        return int(self.weights.sum())
+
+    def compress(self):
+        '''
+        Merges neighbouring centroids if there are more than compression of them
+        '''
+        if len(self.means) <= self.compression:
+            return
+
+        order = np.argsort(self.means, kind='stable')
+        means, weights = self.means[order], self.weights[order]
+        total = weights.sum()
+
+        # k1 scale function: a centroid can only span one unit of k, so the centroids near the tails are smaller
+        def k(q):
+            return self.compression / (2 * np.pi) * np.arcsin(2 * min(q, 1.0) - 1)
+
+        new_means, new_weights = [means[0]], [weights[0]]
+        w_before = 0
+        k_lo = k(0.0)
+        for m, w in zip(means[1:].tolist(), weights[1:].tolist()):
+            if k((w_before + new_weights[-1] + w) / total) - k_lo <= 1:
+                new_weights[-1] += w
+                new_means[-1] += (m - new_means[-1]) * w / new_weights[-1]
+            else:
+                w_before += new_weights[-1]
+                k_lo = k(w_before / total)
+                new_means.append(m)
+                new_weights.append(w)
+
+        self.means = np.array(new_means, dtype=float)
+        self.weights = np.array(new_weights, dtype=np.int64)
+
+    def quantile(self, p):
+        '''
+        Returns the p quantile(s) of the values, interpolating linearly between the ranks of the centroids
+        (the same as numpy/pandas quantiles while the sketch holds the values themselves)
+        '''
+        order = np.argsort(self.means, kind='stable')
+        means, weights = self.means[order], self.weights[order]
+        n = weights.sum()
+
+        # rank (from 0) of the middle of each centroid, the min and max are at the first and last rank
+        centers = np.cumsum(weights) - (weights + 1) / 2
+        ranks = np.concatenate([[0], centers, [n - 1]])
+        vals = np.concatenate([[self.min], means, [self.max]])
+
+        return np.interp(np.asarray(p) * (n - 1), ranks, vals)
+
+    def boxplot(self):
+        '''
+        Returns the box plot summary statistics dict (whislo, q1, med, q3, whishi, fliers) of the values,
+        or the values themselves (points) if there are less than 4. Points and fliers are one value per centroid,
+        so they are the values themselves while the sketch is not compressed, and never more than compression values.
+        '''
+        # at least 4 data points needed to calculate quartiles
+        if self.n < 4:
+            return {'points': self.means.tolist()}
+
+        q1, med, q3 = self.quantile([0.25, 0.5, 0.75]).tolist()
+
+        # fliers are outside 1.5 times the interquartile range
+        iqr = q3 - q1
+        is_flier = (self.means < q1 - 1.5 * iqr) | (self.means > q3 + 1.5 * iqr)
+        fliers = self.means[is_flier].tolist()
+
+        return {'whislo': float(self.min), 'q1': q1, 'med': med, 'q3': q3, 'whishi': float(self.max), 'fliers': fliers}
+
+    def to_dict(self):
+        return {'means': self.means.tolist(), 'weights': self.weights.tolist(), 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d, compression=default_compression):
+        return cls(d['means'], d['weights'], min=d.get('min', np.nan), max=d.get('max', np.nan), compression=compression)
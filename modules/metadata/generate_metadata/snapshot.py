@@ -0,0 +1,99 @@
+'''
+File name: snapshot
+
+DESCRIPTION: Versioned snapshots of the map metadata tables, published atomically for the dashboard.
+
+             A snapshot is a directory versions/<version> in the output directory with a copy of the metadata tables.
+             The tables are copied to a temporary directory that is renamed to its version when it is complete, then
+             the pointer file (CURRENT) is replaced with one that has the new version. Both are atomic renames, so a
+             reader that follows the pointer always finds a complete snapshot, while the pipeline rewrites the tables
+             of the output directory. The oldest snapshots are deleted, keeping the last few versions.
+
+             Output directories without a pointer file (older outputs) are read directly.
+
+             This file does not load the constants, so the dashboard can import it too.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import os
+import shutil
+from datetime import datetime
+
+########################################## VARIABLES ##########################################
+pointer_file_name = 'CURRENT'
+versions_dir_name = 'versions'
+tmp_prefix = '.tmp-'
+
+########################################## FUNCTIONS ##########################################
+def fsync_file(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+def read_pointer(out_dir):
+    '''
+    Returns the current version of the output directory (None if it has no pointer file)
+    '''
+    try:
+        with open(os.path.join(out_dir, pointer_file_name)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def get_snapshot_dir(out_dir, version):
+    '''
+    Returns the directory of the version of the output directory (the output directory itself if version is None,
+    older outputs without snapshots)
+    '''
+    return out_dir if version is None else os.path.join(out_dir, versions_dir_name, version)
+
+def prune_snapshots(out_dir, keep):
+    '''
+    Deletes the snapshots of the output directory (and the temporary directories of failed publishes),
+    except the last keep versions and the current version
+    '''
+    versions_dir = os.path.join(out_dir, versions_dir_name)
+    current = read_pointer(out_dir)
+
+    versions = sorted(v for v in os.listdir(versions_dir) if not v.startswith(tmp_prefix))
+    old = [v for v in versions[:max(len(versions) - keep, 0)] if v != current]
+    # temporary directories of publishes that started before the last version (failed)
+    old += [v for v in os.listdir(versions_dir) if v.startswith(tmp_prefix) and versions and v[len(tmp_prefix):] < versions[-1]]
+
+    for v in old:
+        shutil.rmtree(os.path.join(versions_dir, v), ignore_errors=True)
+
+def publish_snapshot(out_dir, file_names, keep=3):
+    '''
+    IN: out_dir (str) - output directory
+        file_names (list) - metadata tables (in out_dir) of the snapshot
+        keep (int) - number of versions to keep
+
+    OUT: version (str) - version of the snapshot, now the current version of out_dir
+    '''
+    versions_dir = os.path.join(out_dir, versions_dir_name)
+    os.makedirs(versions_dir, exist_ok=True)
+
+    # versions sort by the time they were published
+    version = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    tmp_dir = os.path.join(versions_dir, tmp_prefix + version)
+    os.makedirs(tmp_dir)
+
+    for file_name in file_names:
+        path = os.path.join(tmp_dir, file_name)
+        shutil.copyfile(os.path.join(out_dir, file_name), path)
+        fsync_file(path)
+
+    os.rename(tmp_dir, os.path.join(versions_dir, version))
+
+    # swap the pointer
+    pointer_path = os.path.join(out_dir, pointer_file_name)
+    with open(pointer_path + '.tmp', 'w') as f:
+        f.write(version + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer_path + '.tmp', pointer_path)
+
+    prune_snapshots(out_dir, keep)
+
+    return version
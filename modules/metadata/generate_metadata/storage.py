@@ -0,0 +1,232 @@
+'''
+File name: storage
+
+DESCRIPTION: Columnar storage for the pipeline intermediates and the map metadata tables.
+
+             Tables are saved as compressed Parquet files with typed columns. The nested columns
+             (confidence intervals, boxplots, flow counts, lists of edges, edge geometries) are saved as struct/map/list
+             columns instead of strings, so they are read back as python objects without literal_eval.
+             Reading a table can be restricted to the columns that are needed (column projection), and the columns
+             of a table can be listed without reading it.
+
+             Paths ending in .csv are still written/read as CSV (nested columns are stringified like before).
+
+             TableWriter saves a table in parts (row groups), for the scripts that process the data in shards.
+
+             This file does not load the constants, so the dashboard can import it too.
+
+Author: Ana Uribe
+'''
+########################################## IMPORTS ##########################################
+import ast
+import os
+import numpy as np
+import pandas as pd
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+########################################## VARIABLES ##########################################
+compression = 'zstd'
+
+# nested column types
+ci_type = pa.struct([('lower', pa.float64()), ('upper', pa.float64())])     # (lower bound, upper bound)
+boxplot_type = pa.struct([('whislo', pa.float64()),
+                          ('q1', pa.float64()),
+                          ('med', pa.float64()),
+                          ('q3', pa.float64()),
+                          ('whishi', pa.float64()),
+                          ('fliers', pa.list_(pa.float64())),
+                          ('points', pa.list_(pa.float64())),
+                         ])
+edge_flow_type = pa.map_(pa.string(), pa.int64())   # counts of '+', '-', 'p'
+node_flow_type = pa.map_(pa.int64(), pa.int64())    # counts of edge ids
+edge_list_type = pa.list_(pa.int64())               # edge ids
+coords_type = pa.list_(pa.list_(pa.float64()))      # edge geometry, (x, y) of each point
+sketch_type = pa.struct([('means', pa.list_(pa.float64())),     # quantile sketch (metadata state)
+                         ('weights', pa.list_(pa.int64())),
+                         ('min', pa.float64()),
+                         ('max', pa.float64()),
+                        ])
+
+########################################## HELPER FUNCTIONS ##########################################
+def is_missing(x):
+    return x is None or (isinstance(x, float) and np.isnan(x))
+
+def to_arrow_value(x, arrow_type):
+    '''
+    Converts a python object (tuple, dict or list) of a nested column to the value pyarrow expects for arrow_type
+    '''
+    if is_missing(x):
+        return None
+    elif arrow_type == ci_type:
+        return {'lower': x[0], 'upper': x[1]}
+    elif pa.types.is_map(arrow_type):
+        return list(x.items())
+    elif pa.types.is_list(arrow_type):
+        return list(x)
+    else:
+        return x
+
+def from_arrow_value(x, arrow_type):
+    '''
+    Converts a value of a nested column read from a Parquet file back to the python object that was saved
+    '''
+    if x is None:
+        return np.nan
+    elif arrow_type == ci_type:
+        return (x['lower'], x['upper'])
+    elif pa.types.is_map(arrow_type):
+        return dict(x)
+    elif pa.types.is_struct(arrow_type):
+        # boxplot dicts only have some of the fields
+        return {k: v for k, v in x.items() if v is not None}
+    else:
+        return x
+
+def parse_value(x):
+    '''
+    Parses a stringified nested value of a CSV file
+    '''
+    if isinstance(x, str):
+        return ast.literal_eval(x)
+    else:
+        return x
+
+########################################## FUNCTIONS ##########################################
+def to_arrow_table(df, nested_types=None):
+    '''
+    IN: df (pandas DataFrame) - table to convert
+        nested_types (dict) - column name: pyarrow type of the nested (tuple/dict/list) columns of df
+
+    OUT: table (pyarrow Table) - df with typed nested columns, in the column order of df
+    '''
+    nested_types = {c: t for c, t in (nested_types or {}).items() if c in df.columns}
+    flat_df = df.drop(columns=list(nested_types))
+
+    # OSM attributes can mix lists and single values, save those columns as strings (like the CSV files)
+    for c in flat_df.columns[flat_df.dtypes == object]:
+        try:
+            pa.array(flat_df[c], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            flat_df[c] = flat_df[c].map(lambda x: None if is_missing(x) else str(x))
+
+    # typed arrays for the nested columns, the other columns keep their pandas dtypes
+    table = pa.Table.from_pandas(flat_df, preserve_index=False)
+    for c in df.columns:
+        if c in nested_types:
+            arr = pa.array([to_arrow_value(x, nested_types[c]) for x in df[c]], type=nested_types[c])
+            table = table.append_column(pa.field(c, nested_types[c]), arr)
+
+    # keep the column order of df
+    return table.select(list(df.columns))
+
+def save_table(df, path, nested_types=None):
+    '''
+    IN: df (pandas DataFrame) - table to save
+        path (str) - .parquet or .csv file path
+        nested_types (dict) - column name: pyarrow type of the nested (tuple/dict/list) columns of df
+
+    Saves df as a compressed Parquet file (or a CSV file if path ends in .csv)
+    '''
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+        return
+
+    pq.write_table(to_arrow_table(df, nested_types), path, compression=compression)
+
+def read_table(path, columns=None, dtype=None, nested_cols=None):
+    '''
+    IN: path (str) - .parquet or .csv file path
+        columns (list) - columns to read (all if None)
+        dtype (dict) - column name: dtype to cast columns to
+        nested_cols (list) - nested columns of a CSV file, parsed with literal_eval (Parquet files know their nested columns)
+
+    OUT: df (pandas DataFrame) - table with its nested columns as python objects (tuples, dicts, lists)
+    '''
+    if path.endswith('.csv'):
+        df = pd.read_csv(path, usecols=columns, dtype=dtype)
+        for c in nested_cols or []:
+            if c in df.columns:
+                df[c] = df[c].map(parse_value)
+        return df
+
+    table = pq.read_table(path, columns=columns)
+    nested = [f for f in table.schema if pa.types.is_nested(f.type)]
+
+    df = table.drop_columns([f.name for f in nested]).to_pandas()
+    for f in nested:
+        df[f.name] = [from_arrow_value(x, f.type) for x in table.column(f.name).to_pylist()]
+    df = df[table.column_names]
+
+    if dtype:
+        df = df.astype(dtype)
+
+    return df
+
+def table_columns(path):
+    '''
+    Returns the column names of the .parquet or .csv file at path, without reading its rows
+    '''
+    if path.endswith('.csv'):
+        return pd.read_csv(path, nrows=0).columns.tolist()
+
+    return pq.read_schema(path).names
+
+class TableWriter:
+    '''
+    Saves a table in parts (like save_table), so the full table never has to be in memory.
+    Each part is appended to the Parquet file as row groups (or to the CSV file if path ends in .csv).
+    The parts must have the same columns, they are cast to the types of the first part.
+    '''
+
+    def __init__(self, path, nested_types=None):
+        self.path = path
+        self.nested_types = nested_types
+        self.writer = None
+        self.n_rows = 0
+
+    def write(self, df):
+        if self.path.endswith('.csv'):
+            df.to_csv(self.path, index=False, mode='w' if self.n_rows == 0 else 'a', header=self.n_rows == 0)
+        else:
+            table = to_arrow_table(df, self.nested_types)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema, compression=compression)
+            else:
+                table = table.cast(self.writer.schema)
+            self.writer.write_table(table)
+
+        self.n_rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def export_csv(path, csv_path=None):
+    '''
+    Writes a CSV copy of the Parquet file at path (next to it if no csv_path is given)
+    '''
+    if csv_path is None:
+        csv_path = os.path.splitext(path)[0] + '.csv'
+
+    read_table(path).to_csv(csv_path, index=False)
+
+    return csv_path
+
+def find_table(path):
+    '''
+    Returns path, falling back to the .csv file with the same name if the .parquet file does not exist (older outputs)
+    '''
+    csv_path = os.path.splitext(path)[0] + '.csv'
+
+    if not os.path.exists(path) and os.path.exists(csv_path):
+        return csv_path
+    else:
+        return path
@@ -3,6 +3,8 @@ File name: utils
 
 DESCRIPTION: Contains functions that generate map metadata.
              Functions called by get_map_metadata.py
+
+             Also contains the node to edge index and the confidence intervals (the edge id helpers are in edge_index.py)
              
 Author: Ana Uribe
 '''
@@ -15,9 +17,13 @@ import os
 import ast
 from scipy.stats import t
 from collections import Counter
+from functools import lru_cache
+
+from edge_index import get_edge_key_df
 
 ########################################## VARIABLES ##########################################
-constants_path = '/Users/bean/Documents/masters-project/map-metadata/constants.json'
+# constants file next to this script (set MAP_METADATA_CONSTANTS to use another one)
+constants_path = os.environ.get('MAP_METADATA_CONSTANTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.json'))
 
 ########################################## LOAD IN CONSTANTS ##########################################
 # dictionary with constants
@@ -33,6 +39,7 @@ day_type = constants_dict['metadata cols']['day type']
 time_type = constants_dict['metadata cols']['time type']
 time_bin = constants_dict['metadata cols']['time bin']
 edge = constants_dict['metadata cols']['edge']
+edge_keys = constants_dict['metadata cols']['edge keys']
 node = constants_dict['metadata cols']['node']
 avg_speed = constants_dict['metadata cols']['avg speed']
 max_speed = constants_dict['metadata cols']['max speed']
@@ -44,47 +51,118 @@ avg_speed_ci = constants_dict['metadata cols']['avg speed CI']
 travel_time_ci = constants_dict['metadata cols']['travel time CI']
 traj_count = constants_dict['metadata cols']['count']
 
+########################################## NODE INDEX ##########################################
+class NodeEdgeIndex:
+    '''
+    Adjacency index from each node to the edges it belongs to, built once from the structural edge df.
+    Stored CSR-style:
+        nodes - sorted node ids
+        indptr, edge_idx - the edges of nodes[i] are the rows edge_idx[indptr[i]:indptr[i + 1]] of
+                           edges (edge tuples) and edge_dirs (compass directions of the edge)
+    '''
+
+    def __init__(self, e_df):
+        # one row per edge (first row of each edge), sorted by edge
+        e_df = e_df.dropna(subset=[edge]).drop_duplicates(subset=[edge])
+        e_df = e_df.iloc[np.argsort(e_df[edge].to_numpy(), kind='stable')]
+
+        key_df = get_edge_key_df(e_df)
+        u, v, k = (key_df[c].to_numpy(dtype=np.int64) for c in edge_keys)
+
+        self.edges = np.empty(len(e_df), dtype=object)
+        self.edges[:] = list(zip(u.tolist(), v.tolist(), k.tolist()))
+        self.edge_dirs = e_df[compass_dir].to_numpy(dtype=object)
+
+        # (node, edge row) pairs, self-loops only once
+        e_rows = np.arange(len(e_df))
+        not_loop = u != v
+        pair_nodes = np.concatenate([u, v[not_loop]])
+        pair_edges = np.concatenate([e_rows, e_rows[not_loop]])
+
+        order = np.lexsort((pair_edges, pair_nodes))
+        self.nodes, counts = np.unique(pair_nodes[order], return_counts=True)
+        self.indptr = np.concatenate([[0], np.cumsum(counts)])
+        self.edge_idx = pair_edges[order]
+
+    def get_edge_rows(self, n):
+        '''
+        Returns the rows (in self.edges) of the edges of node n
+        '''
+        i = np.searchsorted(self.nodes, n)
+        if i == len(self.nodes) or self.nodes[i] != n:
+            return self.edge_idx[:0]
+
+        return self.edge_idx[self.indptr[i]:self.indptr[i + 1]]
+
 ########################################## HELPER FUNCTIONS ##########################################
-def get_edges_of_node(n, e_df):
+def get_edges_of_node(n, node_edge_index):
     ''' 
-    Returns all the edges that correspond to a node
+    Returns all the edges that correspond to a node, and the directions of each edge
     '''
-    unique_edges = list(np.unique(e_df[edge]))
+    rows = node_edge_index.get_edge_rows(n)
 
-    node_edges = []
-    edge_dirs = []
+    node_edges = node_edge_index.edges[rows].tolist()
+    edge_dirs = node_edge_index.edge_dirs[rows].tolist()
     
-    for s in unique_edges:
+    return node_edges, edge_dirs
 
-        u_e = ast.literal_eval(s)
+@lru_cache(maxsize=None)
+def get_t_table(alpha, size):
+    '''
+    Returns the two-sided t critical values for degrees of freedom 0 to size - 1 (NaN for 0)
+    '''
+    confidence_level = 1 - alpha
+    t_table = t.ppf((1 + confidence_level) / 2, np.arange(size))
+    t_table.flags.writeable = False
 
-        if n == u_e[0] or n == u_e[1]:
-            node_edges.append(u_e)
-            edge_dirs.append(list(e_df[e_df[edge] == s][compass_dir])[0])   # we want all instances of dirs
-            # print(f'edge: {s} \t edge directions: {edge_dirs}')
-    
-    return node_edges, edge_dirs
+    return t_table
 
-def calc_confidence_interval(data, alpha=0.05):
+def get_t_scores(dof, alpha=0.05):
+    '''
+    Returns the t critical value of each degrees of freedom in dof, looked up in a table
+    that is computed once (and grown in powers of two when a bigger degrees of freedom shows up)
+    '''
+    dof = np.asarray(dof, dtype=int)
+    max_dof = int(dof.max()) if dof.size else 0
+    size = max(1024, 1 << int(max_dof).bit_length())
 
-    k = len(data)
-    df = k - 1
+    return get_t_table(alpha, size)[dof]
 
-    confidence_level = 1 - alpha
+def calc_confidence_intervals(n, mean, var, alpha=0.05):
+    '''
+    IN: n, mean, var (array-like) - number of values, mean, and variance (ddof=1) of each group
 
-    X_bar = np.mean(data)
-    s = np.std(data, ddof=1)  # TODO: check ddof
+    OUT: lower_bound, upper_bound (numpy arrays) - bounds of the t-distribution confidence interval of each group
+                                                  (rounded to 2 decimals, NaN for groups with less than two values)
+    '''
+    n = np.asarray(n, dtype=int)
+    mean = np.asarray(mean, dtype=float)
+    var = np.asarray(var, dtype=float)
 
+    lower_bound = np.full(n.shape, np.nan)
+    upper_bound = np.full(n.shape, np.nan)
 
-    t_score = t.ppf((1 + confidence_level) / 2, df)
+    has_ci = n > 1
+    t_score = get_t_scores(n[has_ci] - 1, alpha)
 
-    standard_error = s / np.sqrt(k)
+    standard_error = np.sqrt(var[has_ci]) / np.sqrt(n[has_ci])
     margin_of_error = t_score * standard_error
 
-    lower_bound = round(X_bar - margin_of_error, 2)
-    upper_bound = round(X_bar + margin_of_error, 2)
+    lower_bound[has_ci] = np.round(mean[has_ci] - margin_of_error, 2)
+    upper_bound[has_ci] = np.round(mean[has_ci] + margin_of_error, 2)
+
+    return lower_bound, upper_bound
 
-    c_i = (lower_bound, upper_bound)
+def calc_confidence_interval(data, alpha=0.05):
+
+    k = len(data)
+
+    X_bar = np.mean(data)
+    s2 = np.var(data, ddof=1)  # TODO: check ddof
+
+    lower_bound, upper_bound = calc_confidence_intervals([k], [X_bar], [s2], alpha)
+
+    c_i = (lower_bound.item(), upper_bound.item())
     
     return c_i, X_bar
 
@@ -170,10 +248,10 @@ def get_edge_functional_metadata(df):
 
     return int(round(avg_s)), avg_ci, int(round(max_s)), int(round(min_s)), round(travel_t, 4), travel_t_ci
 
-def get_node_structural_metadata(n, e_df):
+def get_node_structural_metadata(n, node_edge_index):
 
     # get all edges (and their directions) corresponding to current node
-    node_edges, edge_dirs = get_edges_of_node(n, e_df)
+    node_edges, edge_dirs = get_edges_of_node(n, node_edge_index)
 
     return node_edges, edge_dirs
 
@@ -256,14 +334,18 @@ def get_node_metadata_df(df, e_structural_df):
     # get unique values
     unique_vals = np.unique(df[node].dropna())
 
+    # index the edges of every node and the rows of every node once
+    node_edge_index = NodeEdgeIndex(e_structural_df)
+    node_rows = df.groupby(node).indices
+
     # for every unique value (edge or node)
     for v in unique_vals:
 
         # create subset df
-        v_df = df[df[node] == v]
+        v_df = df.iloc[node_rows[v]]
 
         # get structural values
-        e, dir = get_node_structural_metadata(n=v, e_df=e_structural_df)
+        e, dir = get_node_structural_metadata(n=v, node_edge_index=node_edge_index)
 
         new_s_row = [v, e, len(e), dir, len(v_df)]
         structural_rows.append(new_s_row)
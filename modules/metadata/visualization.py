@@ -17,7 +17,6 @@ import osmnx as ox
 import numpy as np
 import random
 import pandas as pd
-import ast
 
 import geopandas as gpd
 from mappymatch.utils.crs import LATLON_CRS
@@ -78,48 +77,61 @@ def plot_map(ox_map, m=None):
     if gdf.crs != LATLON_CRS:
         gdf = gdf.to_crs(LATLON_CRS)
 
-    for t in gdf.itertuples():
-        if t.geometry is not None:
-            l = [(lat, lon) for lon, lat in t.geometry.coords]
-            polyline = Polyline(
-                locations=l,
-                color="red",
-                fill=False,
-            )
-            popup_content = HTML()
-            popup_content.value = f"Edge from {t[1]} to {t[2]}"
-            popup = Popup(location=l[0], child=popup_content)
-            # def on_polyline_click(event, polyline=polyline, popup=popup):
-            #     # Remove existing popups
-            #     for layer in m.layers:
-            #         if isinstance(layer, Popup):
-            #             m.remove_layer(layer)
-            #     # Add new popup
-            #     m.add_layer(popup)
-            # polyline.on_click(on_polyline_click)
-
-            polyline.popup = popup
-            m.add_layer(polyline)
-            m.add_layer(popup)
+    roads = [(u, v, geometry.coords) for (u, v, _), geometry in zip(roads, gdf.geometry) if geometry is not None]
+    nodes = [(node, data['x'], data['y']) for node, data in tmap.nodes(data=True) if 'x' in data and 'y' in data]
+
+    return plot_roads(roads, nodes, m)
+
+def plot_roads(roads, nodes, m=None):
+    """
+    Plot roads and nodes on an ipyleaflet map.
+
+    Args:
+        roads: (u, v, coordinates) of each road, the coordinates are (long, lat) pairs.
+        nodes: (node, long, lat) of each node.
+        m: the map to add to
+
+    Returns:
+        The map with the roads and nodes plotted.
+    """
+    for u, v, coords in roads:
+        l = [(lat, lon) for lon, lat in coords]
+        polyline = Polyline(
+            locations=l,
+            color="red",
+            fill=False,
+        )
+        popup_content = HTML()
+        popup_content.value = f"Edge from {u} to {v}"
+        popup = Popup(location=l[0], child=popup_content)
+        # def on_polyline_click(event, polyline=polyline, popup=popup):
+        #     # Remove existing popups
+        #     for layer in m.layers:
+        #         if isinstance(layer, Popup):
+        #             m.remove_layer(layer)
+        #     # Add new popup
+        #     m.add_layer(popup)
+        # polyline.on_click(on_polyline_click)
+
+        polyline.popup = popup
+        m.add_layer(polyline)
+        m.add_layer(popup)
 
     # Plot nodes
-    for node, data in tmap.nodes(data=True):
-        if 'x' in data and 'y' in data:
-            lat = data['y']
-            long = data['x']
-            circle_marker = CircleMarker(location=[lat, long],
-                                         radius=5,
-                                         color="blue",
-                                         fill=True,
-                                         fill_color="blue",
-                                         fill_opacity=0.6,
-                                         )
-            popup_content = HTML()
-            popup_content.value = f"Node {node}"
-            popup = Popup(location=(lat, long), child=popup_content)
-            circle_marker.popup = popup
-            m.add_layer(circle_marker)
-            m.add_layer(popup)
+    for node, long, lat in nodes:
+        circle_marker = CircleMarker(location=[lat, long],
+                                     radius=5,
+                                     color="blue",
+                                     fill=True,
+                                     fill_color="blue",
+                                     fill_opacity=0.6,
+                                     )
+        popup_content = HTML()
+        popup_content.value = f"Node {node}"
+        popup = Popup(location=(lat, long), child=popup_content)
+        circle_marker.popup = popup
+        m.add_layer(circle_marker)
+        m.add_layer(popup)
             
     return m
 
@@ -140,6 +152,15 @@ def no_info_plot(ax, p):
 
     ax.text(0.5, 0.5, 'No Info')
 
+def get_time_bin_values(edge_data, col):
+    '''
+    Returns the values of col (boxplot/flow dicts read from the typed metadata columns) indexed by time bin,
+    without the time bins that have no value
+    '''
+    values = edge_data.drop_duplicates('Time_bin').set_index('Time_bin')[col]
+
+    return values[values.map(lambda x: isinstance(x, dict))]
+
 def plot_boxplot(ax, edge_data, p):
     # get current column
     if p == 1:
@@ -150,19 +171,20 @@ def plot_boxplot(ax, edge_data, p):
     # Define the time points and their corresponding labels
     time_points = [-1, 0, 1, 2, 3]
     time_labels = ['Weekend-Night', 'Weekday-Night', 'Weekend-Day', 'Weekday-Day', 'All']
-    
-    # Check if all 'Boxplot_speed' values are empty points or if there's no data for the edge
-    if edge_data.empty or all(ast.literal_eval(row[cur_col]) == {'points': []} for _, row in edge_data.iterrows()):
+
+    # box plot dict of each time bin (summary statistics, or the points of time bins with less than 4 values)
+    boxplots = get_time_bin_values(edge_data, cur_col)
+
+    # Check if there's no data for the edge, or all the time bins have no points
+    if not any('q1' in b or b.get('points') for b in boxplots):
         no_info_plot(ax, p)
         return
     
     for idx, time_point in enumerate(time_points):
-        row = edge_data[edge_data['Time_bin'] == time_point]
-        
-        if row.empty:
+        if time_point not in boxplots.index:
             continue
         
-        boxplot_speed = ast.literal_eval(row.iloc[0][cur_col])
+        boxplot_speed = boxplots[time_point]
         
         if 'q1' in boxplot_speed:
             ax.bxp([boxplot_speed], positions=[idx], showfliers=True)
@@ -213,17 +235,9 @@ def plot_speed_stats(ax, df, min_max):
     # Get all columns from df
     time_points=cur_df['Time_bin'] 
 
-    # Make confidence intervals var a list
+    # confidence intervals are (lower bound, upper bound) tuples read from the typed metadata columns
     confidence_intervals = list(confidence_intervals)
     
-    # Turn confidence intervals into tuple values
-    if type(confidence_intervals[0]) == tuple:
-        pass
-    elif type(confidence_intervals[0]) == float:
-        pass
-    else:
-        confidence_intervals = [tuple(map(float, s[1:-1].split(','))) for s in confidence_intervals]
-    
     # Calculate error bars using confidence intervals
     lower_errors = [np.abs(conf[0] - avg) for avg, conf in zip(avg_speeds, confidence_intervals)]
     upper_errors = [np.abs(conf[1] - avg) for avg, conf in zip(avg_speeds, confidence_intervals)]
@@ -249,13 +263,17 @@ def plot_speed_stats(ax, df, min_max):
     ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
     ax.grid(True)
 
-def plot_flow(ax, edge_data):
+def plot_flow(ax, edge_data, labels=None):
+    # labels (dict) - legend label of each flow key, keys without a label are shown as they are
     # Define the time points and their corresponding labels
     time_points = [-1, 0, 1, 2, 3]
     time_labels = ['Weekend-Night', 'Weekday-Night', 'Weekend-Day', 'Weekday-Day', 'All']
 
+    # flow counts of each time bin
+    flows = get_time_bin_values(edge_data, 'Flow')
+
     # Check if there's no data for the edge
-    if edge_data.empty:
+    if flows.empty:
         no_info_plot(ax, p=2)
         return
     
@@ -264,11 +282,7 @@ def plot_flow(ax, edge_data):
     
     # Collect all unique keys to assign colors
     unique_keys = set()
-    for idx, time_point in enumerate(time_points):
-        row = edge_data[edge_data['Time_bin'] == time_point]
-        if row.empty:
-            continue
-        flow_data = ast.literal_eval(row.iloc[0]['Flow'])
+    for flow_data in flows:
         unique_keys.update(flow_data.keys())
     
     # Create a color map for the unique keys
@@ -280,12 +294,10 @@ def plot_flow(ax, edge_data):
     bar_labels = {time_point: [] for time_point in time_points}
     
     for idx, time_point in enumerate(time_points):
-        row = edge_data[edge_data['Time_bin'] == time_point]
-        
-        if row.empty:
+        if time_point not in flows.index:
             continue
         
-        flow_data = ast.literal_eval(row.iloc[0]['Flow'])
+        flow_data = flows[time_point]
         
         for key, value in flow_data.items():
             bar_heights[time_point].append(value)
@@ -315,7 +327,8 @@ def plot_flow(ax, edge_data):
     
     # Create a legend with unique keys
     handles = [plt.Line2D([0], [0], color=color_map[key], lw=4) for key in unique_keys]
-    ax.legend(handles, unique_keys, loc='upper right')
+    legend_labels = [labels.get(key, key) if labels else key for key in unique_keys]
+    ax.legend(handles, legend_labels, loc='upper right')
 
     # Set y-axis to increment by whole values
     ax.yaxis.set_major_locator(MaxNLocator(integer=True))
@@ -208,6 +208,50 @@ def plot_matches_on_pyleaflet(matches: List[Match], crs=XY_CRS, map=None):
 
     return map
 
+def plot_path_on_pyleaflet(latitude, longitude, matches, paths, G, map=None):
+    """
+    Plots the points of a trace and the continuous paths of edges they were matched to
+    (by modules/map_matching/hmm_matcher.py) on an ipyleaflet map.
+
+    Args:
+    latitude, longitude: The coordinates of the points.
+    matches: The Edge and Distance of each point.
+    paths: The paths of (u, v, key) edges.
+    G: The road network graph of the edges.
+
+    Returns:
+        The map with the points and paths plotted.
+    """
+    mid_i = int(len(latitude) / 2)
+    map.center = (latitude[mid_i], longitude[mid_i])
+    map.zoom = 14
+
+    for lat, lon, m in zip(latitude, longitude, matches.itertuples()):
+        marker = Circle(
+            location=(lat, lon),
+            radius=5,
+            tooltip=f"road_id: {m.Edge}\ndistance: {m.Distance}",
+            color = "red" if m.Edge is not None else "gray",
+            fill_color = "red" if m.Edge is not None else "gray"
+            )
+        map.add_layer(marker)
+
+    for path in paths:
+        # edges without a geometry are straight lines between their nodes
+        locations = []
+        for u, v, key in path:
+            geometry = G.edges[u, v, key].get('geometry', LineString([(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])]))
+            locations += [(lat, lon) for lon, lat in geometry.coords]
+
+        polyline = Polyline(
+            locations=locations,
+            color="blue",
+            fill=False
+        )
+        map.add_layer(polyline)
+
+    return map
+
 def plot_traj_from_file(traj_filepath, crs, map=None):
     #TODO: Remove the crs from here, to be determined by the user
     """